@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from .config import settings
+from .utils import redis_client
+from .database import SessionLocal, dialect_insert
+from .models import ClickStat
+
+logger = logging.getLogger("echoid")
+
+COUNTERS_KEY = "analytics:{day}:{tenant_id}:{domain}"
+UNIQUES_KEY = "analytics:hll:{day}:{tenant_id}:{domain}"
+INDEX_KEY = "analytics:index:{day}" # "tenant_id|domain" members seen that day
+ROLLUP_LOCK_KEY = "analytics:rollup:lock"
+
+METRICS = ("sent", "clicks", "preview_hits", "verified")
+
+# User-Agent fragments of link preview fetchers (not real users)
+PREVIEW_BOT_MARKERS = (
+    "whatsapp", "facebookexternalhit", "facebot", "telegrambot", "twitterbot",
+    "slackbot", "discordbot", "skypeuripreview", "bot", "crawler", "spider", "preview",
+)
+
+def is_preview_bot(user_agent: str) -> bool:
+    user_agent = (user_agent or "").lower()
+    return not user_agent or any(marker in user_agent for marker in PREVIEW_BOT_MARKERS)
+
+def _today() -> str:
+    return datetime.utcnow().strftime("%Y%m%d")
+
+class ClickAnalytics:
+    """
+    Buffered short-link analytics.
+    - record_* only touch in-process dicts (the /q redirect never waits on I/O)
+    - flush() pushes aggregated counters (HINCRBY) and unique-device HyperLogLogs (PFADD)
+      to Redis every ANALYTICS_FLUSH_INTERVAL
+    - rollup() copies the Redis aggregates into Postgres (click_stats) every ANALYTICS_ROLLUP_INTERVAL
+    """
+    def __init__(self):
+        self._counters = {} # (day, tenant_id, domain) -> {metric: n}
+        self._uniques = {} # (day, tenant_id, domain) -> set(device_id)
+
+    def _bucket(self, tenant_id, domain: str):
+        return (_today(), str(tenant_id or 0), domain or "")
+
+    def _incr(self, tenant_id, domain: str, metric: str):
+        counters = self._counters.setdefault(self._bucket(tenant_id, domain), {})
+        counters[metric] = counters.get(metric, 0) + 1
+
+    def record_sent(self, tenant_id, domain: str):
+        self._incr(tenant_id, domain, "sent")
+
+    def record_verified(self, tenant_id, domain: str = ""):
+        self._incr(tenant_id, domain, "verified")
+
+    def record_click(self, tenant_id, domain: str, user_agent: str, client_ip: str):
+        if is_preview_bot(user_agent):
+            self._incr(tenant_id, domain, "preview_hits")
+            return
+        self._incr(tenant_id, domain, "clicks")
+        device_id = hashlib.sha1(f"{client_ip}|{user_agent}".encode("utf-8")).hexdigest()[:16]
+        self._uniques.setdefault(self._bucket(tenant_id, domain), set()).add(device_id)
+
+    def _restore(self, counters: dict, uniques: dict):
+        # Put a failed flush back so it's pushed next time (merged with what was recorded meanwhile)
+        for bucket, values in counters.items():
+            current = self._counters.setdefault(bucket, {})
+            for metric, value in values.items():
+                current[metric] = current.get(metric, 0) + value
+        for bucket, devices in uniques.items():
+            self._uniques.setdefault(bucket, set()).update(devices)
+
+    async def flush(self):
+        counters, self._counters = self._counters, {}
+        uniques, self._uniques = self._uniques, {}
+        if not counters and not uniques:
+            return
+        try:
+            await self._push(counters, uniques)
+        except Exception:
+            self._restore(counters, uniques)
+            raise
+
+    async def _push(self, counters: dict, uniques: dict):
+        ttl = settings.ANALYTICS_RETENTION_DAYS * 86400
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (day, tenant_id, domain) in set(counters) | set(uniques):
+                key = COUNTERS_KEY.format(day=day, tenant_id=tenant_id, domain=domain)
+                hll_key = UNIQUES_KEY.format(day=day, tenant_id=tenant_id, domain=domain)
+                for metric, value in counters.get((day, tenant_id, domain), {}).items():
+                    pipe.hincrby(key, metric, value)
+                if (day, tenant_id, domain) in uniques:
+                    pipe.pfadd(hll_key, *uniques[(day, tenant_id, domain)])
+                    pipe.expire(hll_key, ttl)
+                pipe.expire(key, ttl)
+                pipe.sadd(INDEX_KEY.format(day=day), f"{tenant_id}|{domain}")
+                pipe.expire(INDEX_KEY.format(day=day), ttl)
+            await pipe.execute()
+
+    async def rollup(self, days: int = 2):
+        """
+        Upsert today's and yesterday's Redis aggregates into click_stats (absolute values, idempotent).
+        Only one worker per interval does it.
+        """
+        if not await redis_client.set(ROLLUP_LOCK_KEY, "1", nx=True, ex=max(1, settings.ANALYTICS_ROLLUP_INTERVAL - 1)):
+            return
+
+        rows = []
+        for offset in range(days):
+            day = (datetime.utcnow() - timedelta(days=offset)).strftime("%Y%m%d")
+            members = await redis_client.smembers(INDEX_KEY.format(day=day))
+            for member in members:
+                tenant_id, domain = member.split("|", 1)
+                counters = await redis_client.hgetall(COUNTERS_KEY.format(day=day, tenant_id=tenant_id, domain=domain))
+                uniques = await redis_client.pfcount(UNIQUES_KEY.format(day=day, tenant_id=tenant_id, domain=domain))
+                row = {metric: int(counters.get(metric, 0)) for metric in METRICS}
+                row.update(
+                    day=datetime.strptime(day, "%Y%m%d").date(),
+                    tenant_id=int(tenant_id),
+                    domain=domain,
+                    unique_visitors=uniques,
+                    updated_at=datetime.utcnow(),
+                )
+                rows.append(row)
+
+        if rows:
+            await asyncio.get_running_loop().run_in_executor(None, save_click_stats, rows)
+
+    async def run(self, stop_event: asyncio.Event):
+        last_rollup = 0.0
+        loop = asyncio.get_running_loop()
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.ANALYTICS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                if loop.time() - last_rollup >= settings.ANALYTICS_ROLLUP_INTERVAL:
+                    last_rollup = loop.time()
+                    await self.rollup()
+            except Exception as e:
+                logger.error(f"Click analytics error: {e}")
+
+def save_click_stats(rows: list):
+    db = SessionLocal()
+    try:
+        insert = dialect_insert(db.get_bind())
+        stmt = insert(ClickStat).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["day", "tenant_id", "domain"],
+            set_={column: getattr(stmt.excluded, column) for column in METRICS + ("unique_visitors", "updated_at")},
+        )
+        db.execute(stmt)
+        db.commit()
+    except Exception as e:
+        logger.error(f"Error saving click stats: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+click_analytics = ClickAnalytics()
@@ -0,0 +1,56 @@
+import random
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from .config import settings
+from .database import dialect_insert
+from .models import LedgerEntry, BalanceShard
+
+def to_minor(amount: float) -> int:
+    return int(round(amount * settings.BALANCE_MINOR_UNITS))
+
+def from_minor(amount_minor: int) -> float:
+    return amount_minor / settings.BALANCE_MINOR_UNITS
+
+def _apply(db: Session, tenant_id: int, amount_minor: int, kind: str, reference: str = None, shard: int = None):
+    """
+    Append a ledger entry and add `amount_minor` to one balance shard.
+    The shard update is a single atomic upsert (no read-modify-write), and concurrent
+    writers for the same tenant land on different rows most of the time.
+    Caller commits.
+    """
+    if shard is None:
+        shard = random.randrange(settings.BALANCE_SHARDS)
+    db.add(LedgerEntry(tenant_id=tenant_id, amount_minor=amount_minor, kind=kind, reference=reference))
+
+    insert = dialect_insert(db.get_bind())
+    stmt = insert(BalanceShard).values(tenant_id=tenant_id, shard=shard, balance_minor=amount_minor)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["tenant_id", "shard"],
+        set_={"balance_minor": BalanceShard.balance_minor + stmt.excluded.balance_minor},
+    )
+    db.execute(stmt)
+
+def charge(db: Session, tenant_id: int, amount_minor: int, reference: str = None):
+    _apply(db, tenant_id, -amount_minor, "charge", reference)
+
+def credit(db: Session, tenant_id: int, amount_minor: int, reference: str = None, kind: str = "topup"):
+    _apply(db, tenant_id, amount_minor, kind, reference)
+
+def get_balance_minor(db: Session, tenant_id: int) -> int:
+    total = db.query(func.sum(BalanceShard.balance_minor)).filter(BalanceShard.tenant_id == tenant_id).scalar()
+    return int(total or 0)
+
+def migrate_legacy_balances(db: Session) -> int:
+    """
+    Seed balance shards from the legacy Tenant.balance float for tenants without shards.
+    """
+    from .models import Tenant
+    migrated = 0
+    seeded = {row[0] for row in db.query(BalanceShard.tenant_id).distinct()}
+    for tenant in db.query(Tenant).all():
+        if tenant.id in seeded:
+            continue
+        _apply(db, tenant.id, to_minor(tenant.balance or 0.0), "migration", reference="legacy_balance", shard=0)
+        migrated += 1
+    db.commit()
+    return migrated
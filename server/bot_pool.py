@@ -0,0 +1,121 @@
+import logging
+import random
+import time
+from .config import settings
+from .utils import redis_client, mget
+
+logger = logging.getLogger("echoid")
+
+class Bot:
+    def __init__(self, session: str, phone: str):
+        self.session = session
+        self.phone = phone
+
+    def __repr__(self):
+        return f"Bot({self.session}:{self.phone})"
+
+def parse_bot_pool(spec: str, fallback_phone: str) -> list:
+    """
+    Parse BOT_POOL ("session:phone,session:phone").
+    Falls back to a single bot (BOT_PHONE_NUMBER on session "default").
+    """
+    bots = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if ":" in entry:
+            session, phone = entry.split(":", 1)
+        else:
+            session, phone = entry, fallback_phone
+        bots.append(Bot(session.strip(), phone.strip()))
+    if not bots:
+        bots.append(Bot("default", fallback_phone))
+    return bots
+
+class BotPool:
+    """
+    Pool of bot numbers / EchoB sessions.
+    - Tokens are assigned a bot at /v1/go time (sticky in the session).
+    - Selection is weighted by live send rate and failure ratio (Redis counters per window).
+    - A bot whose failure ratio crosses BOT_FAILURE_THRESHOLD is drained for BOT_DRAIN_SECONDS.
+    """
+    def __init__(self, bots: list):
+        self.bots = bots
+        self.by_session = {bot.session: bot for bot in bots}
+
+    def get(self, session: str):
+        return self.by_session.get(session) if session else None
+
+    @property
+    def default(self) -> Bot:
+        return self.bots[0]
+
+    def _window(self) -> int:
+        return int(time.time() // settings.BOT_HEALTH_WINDOW)
+
+    async def _load_stats(self) -> list:
+        window = self._window()
+        keys = []
+        for bot in self.bots:
+            keys += [
+                f"bot:{bot.session}:sent:{window}",
+                f"bot:{bot.session}:failed:{window}",
+                f"bot:{bot.session}:drained",
+            ]
+        values = await mget(keys)
+        stats = []
+        for i, bot in enumerate(self.bots):
+            sent, failed, drained = values[i * 3:i * 3 + 3]
+            stats.append((bot, int(sent or 0), int(failed or 0), bool(drained)))
+        return stats
+
+    async def choose(self) -> Bot:
+        """
+        Pick a bot for a new token, weighted towards idle & healthy bots.
+        """
+        # Fast path: single bot, no Redis round trip
+        if len(self.bots) == 1:
+            return self.default
+
+        try:
+            stats = await self._load_stats()
+        except Exception as e:
+            logger.error(f"Bot pool stats unavailable, picking uniformly: {e}")
+            return random.choice(self.bots)
+
+        candidates = [s for s in stats if not s[3]]
+        if not candidates:
+            # Every bot is drained: keep serving through the least failing one
+            logger.warning("All bots drained! Falling back to least failing bot")
+            return min(stats, key=lambda s: s[2])[0]
+
+        weights = []
+        for bot, sent, failed, _ in candidates:
+            success_ratio = (sent - failed + 1) / (sent + 1)
+            # Busier bots (higher live send rate) get proportionally less new traffic
+            weights.append(max(success_ratio, 0.01) / (1 + sent))
+        return random.choices([s[0] for s in candidates], weights=weights, k=1)[0]
+
+    async def record_send(self, session: str, ok: bool):
+        """
+        Update per-bot counters after a send and drain the bot if it keeps failing.
+        """
+        window = self._window()
+        sent_key = f"bot:{session}:sent:{window}"
+        failed_key = f"bot:{session}:failed:{window}"
+        sent = await redis_client.incr(sent_key)
+        if sent == 1:
+            await redis_client.expire(sent_key, settings.BOT_HEALTH_WINDOW * 2)
+        if ok:
+            return
+
+        failed = await redis_client.incr(failed_key)
+        if failed == 1:
+            await redis_client.expire(failed_key, settings.BOT_HEALTH_WINDOW * 2)
+        if sent >= settings.BOT_MIN_SAMPLES and failed / sent >= settings.BOT_FAILURE_THRESHOLD:
+            if len(self.bots) > 1:
+                logger.warning(f"Draining bot {session}: {failed}/{sent} sends failed")
+                await redis_client.setex(f"bot:{session}:drained", settings.BOT_DRAIN_SECONDS, "1")
+
+bot_pool = BotPool(parse_bot_pool(settings.BOT_POOL, settings.BOT_PHONE_NUMBER))
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import random
+import time
+from collections import namedtuple
+from sqlalchemy.orm import Session
+from .config import settings
+from .utils import redis_client
+from .database import SessionLocal
+from .models import Tenant
+from .keys import templates_key
+
+logger = logging.getLogger("echoid")
+
+# What the request path needs from a tenant (detached from any DB session)
+TenantInfo = namedtuple("TenantInfo", "id api_key name")
+
+class TemplateCache:
+    """
+    In-process snapshot of the reply templates (templates:{language} set).
+    - loaded with SSCAN at warm-up, refreshed every TEMPLATE_CACHE_REFRESH
+    - with client-side caching, refreshed TEMPLATE_CACHE_DEBOUNCE after the set changes
+    - at most TEMPLATE_CACHE_SIZE templates per worker
+    - choose() returns None until loaded (callers fall back to SRANDMEMBER)
+    """
+    def __init__(self, language: str = "es_mx"):
+        self.key = templates_key(language)
+        self.templates = ()
+        self.loaded_at = None
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.templates)
+
+    def choose(self):
+        return random.choice(self.templates) if self.templates else None
+
+    async def refresh(self) -> int:
+        templates, cursor = [], 0
+        while len(templates) < settings.TEMPLATE_CACHE_SIZE:
+            cursor, members = await redis_client.sscan(self.key, cursor, count=settings.TEMPLATE_BATCH_SIZE)
+            templates += members
+            if cursor == 0:
+                break
+        if templates: # Keep the previous snapshot if the set is (temporarily) empty
+            self.templates = tuple(templates[:settings.TEMPLATE_CACHE_SIZE])
+        self.loaded_at = time.monotonic()
+        return len(self.templates)
+
+    def clear(self):
+        self.templates = ()
+        self.loaded_at = None
+
+    def mark_changed(self, key):
+        """
+        Client cache invalidation listener (key None = tracking restarted, state unknown).
+        """
+        if key is None or key == self.key:
+            self._changed.set()
+
+    async def run(self, stop_event: asyncio.Event):
+        while not stop_event.is_set():
+            stopping = asyncio.ensure_future(stop_event.wait())
+            changed = asyncio.ensure_future(self._changed.wait())
+            await asyncio.wait({stopping, changed}, timeout=settings.TEMPLATE_CACHE_REFRESH, return_when=asyncio.FIRST_COMPLETED)
+            stopping.cancel()
+            changed.cancel()
+            if stop_event.is_set():
+                break
+            if self._changed.is_set():
+                # Bulk loads / clears change the set many times in a row: refresh once
+                await asyncio.sleep(settings.TEMPLATE_CACHE_DEBOUNCE)
+                self._changed.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Template cache refresh error: {e}")
+
+class TenantCache:
+    """
+    API key -> TenantInfo, so /v1/init and the tenant APIs skip the tenants query.
+    - entries live TENANT_CACHE_TTL seconds (a revoked key stops working within that time)
+    - unknown keys are not cached; oldest entries are evicted past TENANT_CACHE_SIZE
+    """
+    def __init__(self):
+        self._entries = {} # api_key -> (TenantInfo, expires_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, tenant: TenantInfo, now: float):
+        self._entries.pop(tenant.api_key, None)
+        self._entries[tenant.api_key] = (tenant, now + settings.TENANT_CACHE_TTL)
+        while len(self._entries) > settings.TENANT_CACHE_SIZE:
+            self._entries.pop(next(iter(self._entries)), None)
+
+    def get(self, db: Session, api_key: str):
+        now = time.monotonic()
+        entry = self._entries.get(api_key)
+        if entry and entry[1] > now:
+            return entry[0]
+        row = db.query(Tenant).filter(Tenant.api_key == api_key).first()
+        if not row:
+            self._entries.pop(api_key, None)
+            return None
+        tenant = TenantInfo(row.id, row.api_key, row.name)
+        self._put(tenant, now)
+        return tenant
+
+    def load(self) -> int:
+        """
+        Preload the most recent TENANT_CACHE_SIZE active tenants (warm-up, runs in a thread).
+        """
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(Tenant.id, Tenant.api_key, Tenant.name)
+                .filter(Tenant.is_active.isnot(False))
+                .order_by(Tenant.id.desc())
+                .limit(settings.TENANT_CACHE_SIZE)
+                .all()
+            )
+        finally:
+            db.close()
+        now = time.monotonic()
+        for row in reversed(rows):
+            self._put(TenantInfo(row.id, row.api_key, row.name), now)
+        return len(rows)
+
+    def clear(self):
+        self._entries.clear()
+
+template_cache = TemplateCache()
+tenant_cache = TenantCache()
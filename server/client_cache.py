@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+from redis.exceptions import ResponseError
+from .config import settings
+from .utils import redis_client, mget
+
+logger = logging.getLogger("echoid")
+
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+ENTRY_OVERHEAD = 100 # Rough per-entry bytes (dict slot, tuple, str headers) for the memory cap
+MISSING = object()
+
+class ClientCache:
+    """
+    Redis client-side caching for read-mostly keys (CLIENT TRACKING).
+    - BCAST tracking of CLIENT_CACHE_PREFIXES on a dedicated connection, invalidations
+      REDIRECTed to a second connection subscribed to __redis__:invalidate
+    - get() / mget() serve tracked keys from process memory (LRU, CLIENT_CACHE_MAX_BYTES)
+    - listeners are told which keys changed (e.g. TemplateCache refreshes right away)
+    - tracking not supported (Redis < 6, proxies, cluster mode) or connection lost:
+      cache flushed, reads go to Redis until tracking is re-established
+    """
+    def __init__(self, prefixes: list, max_bytes: int):
+        self.prefixes = prefixes
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self.unsupported = None # Reason tracking is off for good
+        self._entries = OrderedDict() # key -> (value, size)
+        self._bytes = 0
+        self._loading = {} # key -> marker; an invalidation during the read drops the marker
+        self._listeners = []
+        self.hits = self.misses = self.invalidations = self.flushes = 0
+
+    def tracks(self, key: str) -> bool:
+        return any(key.startswith(prefix) for prefix in self.prefixes)
+
+    def on_invalidate(self, callback):
+        """
+        callback(key) for each invalidated key (None = everything, e.g. FLUSHALL or tracking lost).
+        """
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def _store(self, key: str, value):
+        self._drop(key)
+        size = len(key) + len(value or "") + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[1]
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def mget(self, keys: list) -> list:
+        if not self.enabled:
+            return await mget(keys)
+        values = [self._lookup(key) if self.tracks(key) else MISSING for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is MISSING]
+        tracked = [key for key in missing if self.tracks(key)]
+        self.hits += sum(1 for key in keys if self.tracks(key)) - len(tracked)
+        self.misses += len(tracked)
+        if not missing:
+            return values
+        # A marker still in place after the read means no invalidation arrived meanwhile
+        markers = {key: object() for key in tracked}
+        self._loading.update(markers)
+        fetched = {}
+        try:
+            fetched = dict(zip(missing, await mget(missing)))
+        finally:
+            for key, marker in markers.items():
+                if self._loading.get(key) is marker:
+                    del self._loading[key]
+                    if key in fetched and self.enabled:
+                        self._store(key, fetched[key])
+        return [fetched[key] if value is MISSING else value for key, value in zip(keys, values)]
+
+    async def get(self, key: str):
+        return (await self.mget([key]))[0]
+
+    def invalidate(self, keys):
+        if keys is None:
+            self.flush()
+            return
+        for key in keys:
+            self.invalidations += 1
+            self._drop(key)
+            self._loading.pop(key, None)
+            for callback in self._listeners:
+                callback(key)
+
+    def flush(self):
+        self._entries.clear()
+        self._loading.clear()
+        self._bytes = 0
+        self.flushes += 1
+        for callback in self._listeners:
+            callback(None)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "unsupported": self.unsupported,
+            "prefixes": self.prefixes,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "flushes": self.flushes,
+        }
+
+    async def _read_invalidations(self, connection):
+        while True:
+            message = await connection.read_response(timeout=math.inf)
+            # ["message", "__redis__:invalidate", [keys] | None]; None = FLUSHDB / FLUSHALL
+            if isinstance(message, list) and len(message) == 3 and message[0] == "message":
+                self.invalidate(message[2])
+
+    async def _track(self, stop_event: asyncio.Event):
+        pool = redis_client.connection_pool
+        subscriber = pool.connection_class(**pool.connection_kwargs)
+        tracker = pool.connection_class(**pool.connection_kwargs)
+        reader = None
+        try:
+            await subscriber.send_command("CLIENT", "ID")
+            subscriber_id = await subscriber.read_response()
+            await subscriber.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+            await subscriber.read_response()
+            prefixes = [arg for prefix in self.prefixes for arg in ("PREFIX", prefix)]
+            await tracker.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", subscriber_id, "BCAST", *prefixes)
+            await tracker.read_response()
+
+            self.flush() # Nothing read before tracking started can be trusted
+            self.enabled = True
+            logger.info(f"[ClientCache] Tracking {self.prefixes} (invalidations -> client {subscriber_id})")
+            reader = asyncio.create_task(self._read_invalidations(subscriber))
+            while not stop_event.is_set():
+                stopping = asyncio.ensure_future(stop_event.wait())
+                await asyncio.wait({reader, stopping}, timeout=settings.CLIENT_CACHE_HEALTH_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                stopping.cancel()
+                if reader.done():
+                    reader.result() # Re-raises the connection error
+                    return
+                # Tracking lives and dies with this connection
+                await tracker.send_command("PING")
+                await tracker.read_response()
+        finally:
+            self.enabled = False
+            self.flush()
+            if reader:
+                reader.cancel()
+                await asyncio.gather(reader, return_exceptions=True)
+            for connection in (subscriber, tracker):
+                await connection.disconnect()
+
+    async def run(self, stop_event: asyncio.Event):
+        if settings.REDIS_CLUSTER:
+            # Tracking is per node; would need one subscriber per primary
+            self.unsupported = "cluster mode"
+        while not self.unsupported and not stop_event.is_set():
+            try:
+                await self._track(stop_event)
+            except ResponseError as e:
+                self.unsupported = str(e)
+            except Exception as e:
+                logger.error(f"[ClientCache] Tracking connection lost, reading from Redis: {e}")
+            if self.unsupported:
+                break
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.CLIENT_CACHE_HEALTH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        if self.unsupported:
+            logger.warning(f"[ClientCache] Client-side caching disabled: {self.unsupported}")
+
+client_cache = ClientCache(
+    [prefix.strip() for prefix in settings.CLIENT_CACHE_PREFIXES.split(",") if prefix.strip()],
+    settings.CLIENT_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from .config import settings
+from .utils import redis_client
+from .database import SessionLocal
+from .billing import get_balance_minor
+from .keys import credit_key, credit_reservations_key, credit_outstanding_key
+
+logger = logging.getLogger("echoid")
+
+# Per tenant (one hash tag in cluster mode, see keys.py):
+# credit_key = available credit (minor units) = DB balance - outstanding reservations
+# credit_reservations_key = token -> reserved amount
+# credit_outstanding_key = sum of the reservations (kept by the scripts, so reconcile is O(1))
+EXPIRY_KEY = "credit:expiry" # "tenant_id:token" -> expires_at (kept outside the scripts: other slot)
+TENANTS_KEY = "credit:tenants"
+RECONCILE_LOCK_KEY = "credit:reconcile:lock"
+
+# -1 = credit not loaded (cold), 0 = insufficient, 1 = reserved
+RESERVE_SCRIPT = """
+local available = redis.call('GET', KEYS[1])
+if not available then
+    return -1
+end
+if tonumber(available) < tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DECRBY', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+redis.call('INCRBY', KEYS[3], ARGV[1])
+return 1
+"""
+
+# Drop a reservation; ARGV[2] == 'refund' gives the amount back to the available credit
+RELEASE_SCRIPT = """
+local amount = redis.call('HGET', KEYS[2], ARGV[1])
+if not amount then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('DECRBY', KEYS[3], amount)
+if ARGV[2] == 'refund' and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], amount)
+end
+return tonumber(amount)
+"""
+
+# Credit = DB balance - outstanding reservations (computed atomically with the reservations).
+# The running total is rebuilt from the hash only when missing (reservations made before it existed)
+RECONCILE_SCRIPT = """
+local outstanding = redis.call('GET', KEYS[3])
+if not outstanding then
+    outstanding = 0
+    for _, amount in ipairs(redis.call('HVALS', KEYS[2])) do
+        outstanding = outstanding + tonumber(amount)
+    end
+    redis.call('SET', KEYS[3], outstanding)
+end
+local available = tonumber(ARGV[1]) - tonumber(outstanding)
+if ARGV[2] == 'nx' then
+    redis.call('SET', KEYS[1], available, 'NX')
+else
+    redis.call('SET', KEYS[1], available)
+end
+return available
+"""
+
+def _keys(tenant_id):
+    return credit_key(tenant_id), credit_reservations_key(tenant_id), credit_outstanding_key(tenant_id)
+
+def _load_db_balance(tenant_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return get_balance_minor(db, tenant_id)
+    finally:
+        db.close()
+
+async def _load_credit(tenant_id: int, mode: str = "nx"):
+    balance = await asyncio.get_running_loop().run_in_executor(None, _load_db_balance, tenant_id)
+    await redis_client.sadd(TENANTS_KEY, tenant_id)
+    return await redis_client.eval(RECONCILE_SCRIPT, 3, *_keys(tenant_id), balance, mode)
+
+async def reserve_credit(tenant_id: int, token: str, amount_minor: int = None) -> bool:
+    """
+    Atomically hold `amount_minor` of the tenant's credit for a verification.
+    Only a cold start (credit not in Redis yet) reads Postgres.
+    The expiry entry is written first: if the reservation never happens, refunding it is a no-op.
+    """
+    amount_minor = settings.VERIFICATION_COST_MINOR if amount_minor is None else amount_minor
+    keys = _keys(tenant_id)
+    member = f"{tenant_id}:{token}"
+    await redis_client.zadd(EXPIRY_KEY, {member: time.time() + settings.CREDIT_RESERVATION_TTL})
+    result = await redis_client.eval(RESERVE_SCRIPT, 3, *keys, amount_minor, token)
+    if result == -1:
+        await _load_credit(tenant_id)
+        result = await redis_client.eval(RESERVE_SCRIPT, 3, *keys, amount_minor, token)
+    if result != 1:
+        await redis_client.zrem(EXPIRY_KEY, member)
+    return result == 1
+
+async def settle_credit(tenant_id: int, token: str):
+    """
+    The charge is committed to Postgres: drop the reservation (credit stays deducted).
+    """
+    await redis_client.eval(RELEASE_SCRIPT, 3, *_keys(tenant_id), token, "settle")
+    await redis_client.zrem(EXPIRY_KEY, f"{tenant_id}:{token}")
+
+async def refund_expired_reservations(batch_size: int = 500) -> int:
+    """
+    Refund every expired reservation, `batch_size` per pipeline (no MULTI), until none is left:
+    abandoned /v1/init sessions never pile up from one reconcile run to the next.
+    """
+    refunded = 0
+    while True:
+        expired = await redis_client.zrangebyscore(EXPIRY_KEY, "-inf", time.time(), start=0, num=batch_size)
+        if not expired:
+            return refunded
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for member in expired:
+                tenant_id, token = member.split(":", 1)
+                pipe.eval(RELEASE_SCRIPT, 3, *_keys(tenant_id), token, "refund")
+            pipe.zrem(EXPIRY_KEY, *expired)
+            await pipe.execute()
+        refunded += len(expired)
+        if len(expired) < batch_size:
+            return refunded
+
+async def reconcile_credit():
+    """
+    Refund expired reservations, then reset every tenant's Redis credit from Postgres.
+    One worker per interval.
+    """
+    if not await redis_client.set(RECONCILE_LOCK_KEY, "1", nx=True, ex=max(1, settings.CREDIT_RECONCILE_INTERVAL - 1)):
+        return
+    refunded = await refund_expired_reservations()
+    tenant_ids = await redis_client.smembers(TENANTS_KEY)
+    for tenant_id in tenant_ids:
+        await _load_credit(int(tenant_id), mode="force")
+    logger.info(f"[Credit] Reconciled {len(tenant_ids)} tenant(s), refunded {refunded} expired reservation(s)")
+
+async def run_credit_reconciler(stop_event: asyncio.Event):
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=settings.CREDIT_RECONCILE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await reconcile_credit()
+        except Exception as e:
+            logger.error(f"Credit reconcile error: {e}")
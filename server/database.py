@@ -11,3 +11,13 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def dialect_insert(bind):
+    """
+    INSERT construct with ON CONFLICT support for the bound dialect (Postgres in prod, SQLite in dev).
+    """
+    if bind.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert
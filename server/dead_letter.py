@@ -0,0 +1,57 @@
+import logging
+import time
+from .utils import redis_client, json_dumps, json_loads
+
+logger = logging.getLogger("echoid")
+
+# Failed / interrupted replies: hash id -> entry JSON, sorted set id -> failed_at
+DLQ_KEY = "dlq:replies"
+DLQ_INDEX_KEY = "dlq:replies:index"
+
+async def add_dead_letter(job: dict, error: str, reason: str = "failed"):
+    """
+    Store a reply that could not be delivered, with the full context needed to replay it.
+    """
+    entry = {
+        "id": job.get("id"),
+        "token": job.get("token"),
+        "sender": job.get("chat_id"),
+        "tenant_id": job.get("tenant_id"),
+        "session": job.get("session"),
+        "attempts": job.get("attempts", 0),
+        "last_error": error,
+        "reason": reason, # failed | interrupted
+        "failed_at": time.time(),
+        "job": job,
+    }
+    await redis_client.hset(DLQ_KEY, entry["id"], json_dumps(entry))
+    await redis_client.zadd(DLQ_INDEX_KEY, {entry["id"]: entry["failed_at"]})
+    logger.error(f"[DLQ] Reply {entry['id']} for token {entry['token']} dead-lettered ({reason}): {error}")
+
+async def count_dead_letters() -> int:
+    return await redis_client.zcard(DLQ_INDEX_KEY)
+
+async def list_dead_letters(offset: int = 0, limit: int = 50) -> list:
+    """
+    Oldest first.
+    """
+    ids = await redis_client.zrange(DLQ_INDEX_KEY, offset, offset + limit - 1)
+    if not ids:
+        return []
+    raw_entries = await redis_client.hmget(DLQ_KEY, ids)
+    entries = []
+    for entry_id, raw in zip(ids, raw_entries):
+        if raw is None:
+            # Index entry without payload, clean it up
+            await redis_client.zrem(DLQ_INDEX_KEY, entry_id)
+            continue
+        entries.append(json_loads(raw))
+    return entries
+
+async def get_dead_letter(entry_id: str):
+    raw = await redis_client.hget(DLQ_KEY, entry_id)
+    return json_loads(raw) if raw else None
+
+async def remove_dead_letter(entry_id: str):
+    await redis_client.hdel(DLQ_KEY, entry_id)
+    await redis_client.zrem(DLQ_INDEX_KEY, entry_id)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import random
+from .config import settings
+from .utils import redis_client
+from .client_cache import client_cache
+
+logger = logging.getLogger("echoid")
+
+# Shared counters: hash field "{domain}|sent" / "{domain}|clicked"
+DOMAIN_STATS_KEY = "domains:stats"
+QUARANTINE_KEY = "domains:quarantine:{domain}"
+
+# Apply batched deltas, halve counters of domains past the window, return all counters
+SYNC_SCRIPT = """
+local window = tonumber(ARGV[1])
+for i = 2, #ARGV, 3 do
+    local sent = redis.call('HINCRBY', KEYS[1], ARGV[i] .. '|sent', ARGV[i + 1])
+    local clicked = redis.call('HINCRBY', KEYS[1], ARGV[i] .. '|clicked', ARGV[i + 2])
+    if sent > window then
+        redis.call('HSET', KEYS[1], ARGV[i] .. '|sent', math.floor(sent / 2))
+        redis.call('HSET', KEYS[1], ARGV[i] .. '|clicked', math.floor(clicked / 2))
+    end
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+def normalize_domain(domain: str) -> str:
+    domain = domain.strip().rstrip("/")
+    if domain and not domain.startswith("http"):
+        domain = f"http://{domain}"
+    return domain
+
+class DomainPool:
+    """
+    Link domain rotation with health-weighted selection.
+    - LINK_DOMAINS is parsed once
+    - Sent / clicked counts are kept in-process and flushed to Redis in batches
+      (every DOMAIN_SYNC_INTERVAL), so all workers share the same view
+    - Selection is Thompson sampling on each domain's click-through rate
+    - A domain whose CTR collapses is quarantined (shared via Redis key with TTL)
+    """
+    def __init__(self, domains: list):
+        self.domains = domains
+        self._pending = {} # domain -> [sent, clicked] not yet flushed
+        self._totals = {domain: [0, 0] for domain in domains}
+        self.quarantined = set()
+
+    def choose(self) -> str:
+        if len(self.domains) == 1:
+            return self.domains[0]
+        healthy = [d for d in self.domains if d not in self.quarantined] or self.domains
+
+        def sample(domain):
+            sent, clicked = self._counts(domain)
+            return random.betavariate(clicked + 1, sent - clicked + 1)
+        return max(healthy, key=sample)
+
+    def _counts(self, domain: str):
+        sent, clicked = self._totals.get(domain, (0, 0))
+        pending_sent, pending_clicked = self._pending.get(domain, (0, 0))
+        sent += pending_sent
+        clicked = min(clicked + pending_clicked, sent) # Safety net: a CTR above 1 breaks the beta sampling
+        return sent, clicked
+
+    def record_sent(self, domain: str):
+        self._pending.setdefault(domain, [0, 0])[0] += 1
+
+    def record_click(self, domain: str):
+        if domain in self._totals:
+            self._pending.setdefault(domain, [0, 0])[1] += 1
+
+    def apply_totals(self, totals: dict) -> list:
+        """
+        Replace local totals with the shared ones; return domains that should be quarantined.
+        """
+        to_quarantine = []
+        for domain in self.domains:
+            sent, clicked = totals.get(domain, (0, 0))
+            self._totals[domain] = [sent, clicked]
+            if domain in self.quarantined or sent < settings.DOMAIN_MIN_SAMPLES:
+                continue
+            if clicked / sent < settings.DOMAIN_QUARANTINE_CTR:
+                to_quarantine.append(domain)
+        return to_quarantine
+
+    async def sync(self):
+        pending, self._pending = self._pending, {}
+        args = []
+        for domain, (sent, clicked) in pending.items():
+            args += [domain, sent, clicked]
+        try:
+            raw = await redis_client.eval(SYNC_SCRIPT, 1, DOMAIN_STATS_KEY, settings.DOMAIN_STATS_WINDOW, *args)
+        except Exception:
+            # Put deltas back so they're flushed next time
+            for domain, (sent, clicked) in pending.items():
+                counts = self._pending.setdefault(domain, [0, 0])
+                counts[0] += sent
+                counts[1] += clicked
+            raise
+
+        totals = {}
+        for field, value in zip(raw[::2], raw[1::2]):
+            domain, kind = field.rsplit("|", 1)
+            counts = totals.setdefault(domain, [0, 0])
+            counts[0 if kind == "sent" else 1] = int(value)
+
+        for domain in self.apply_totals(totals):
+            sent, clicked = totals[domain]
+            logger.warning(f"Quarantining domain {domain}: CTR {clicked}/{sent}")
+            await redis_client.setex(QUARANTINE_KEY.format(domain=domain), settings.DOMAIN_QUARANTINE_SECONDS, "1")
+            # Start from scratch when it comes back
+            await redis_client.hdel(DOMAIN_STATS_KEY, f"{domain}|sent", f"{domain}|clicked")
+
+        # Quarantine flags rarely change: served from the client-side cache when tracking is on
+        flags = await client_cache.mget([QUARANTINE_KEY.format(domain=d) for d in self.domains])
+        self.quarantined = {d for d, flag in zip(self.domains, flags) if flag}
+
+    async def run_sync(self, stop_event: asyncio.Event):
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.DOMAIN_SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Domain stats sync error: {e}")
+
+def parse_link_domains(spec: str, fallback: str) -> list:
+    domains = []
+    for domain in (spec or "").split(","):
+        domain = normalize_domain(domain)
+        if domain and domain not in domains:
+            domains.append(domain)
+    return domains or [normalize_domain(fallback)]
+
+domain_pool = DomainPool(parse_link_domains(settings.LINK_DOMAINS, settings.HOST_URL))
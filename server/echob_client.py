@@ -9,42 +9,48 @@ class EchobClient:
             "X-Api-Key": self.api_key,
             "Content-Type": "application/json"
         }
+        self._client = None
+
+    def _http(self) -> httpx.AsyncClient:
+        # One pooled client per worker (keep-alive to EchoB), created on first use, closed at shutdown
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=5.0)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def send_text(self, session: str, chat_id: str, text: str):
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}/api/sendText"
-            payload = {
-                "session": session,
-                "chatId": chat_id,
-                "text": text
-            }
-            response = await client.post(url, json=payload, headers=self.headers)
-            response.raise_for_status()
-            return response.json()
+        payload = {
+            "session": session,
+            "chatId": chat_id,
+            "text": text
+        }
+        response = await self._http().post("/api/sendText", json=payload, timeout=30.0)
+        response.raise_for_status()
+        return response.json()
 
     async def start_typing(self, session: str, chat_id: str):
-        async with httpx.AsyncClient() as client:
-            url = f"{self.base_url}/api/startTyping"
-            payload = {
-                "session": session,
-                "chatId": chat_id
-            }
-            # Ignore errors for typing indicators as they are non-critical
-            try:
-                await client.post(url, json=payload, headers=self.headers)
-            except:
-                pass
+        payload = {
+            "session": session,
+            "chatId": chat_id
+        }
+        # Ignore errors for typing indicators as they are non-critical
+        try:
+            await self._http().post("/api/startTyping", json=payload)
+        except:
+            pass
 
     async def stop_typing(self, session: str, chat_id: str):
-        async with httpx.AsyncClient() as client:
-            url = f"{self.base_url}/api/stopTyping"
-            payload = {
-                "session": session,
-                "chatId": chat_id
-            }
-            try:
-                await client.post(url, json=payload, headers=self.headers)
-            except:
-                pass
+        payload = {
+            "session": session,
+            "chatId": chat_id
+        }
+        try:
+            await self._http().post("/api/stopTyping", json=payload)
+        except:
+            pass
 
 echob_client = EchobClient()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from .config import settings
+
+logger = logging.getLogger("echoid")
+
+# Priority classes (lower value is served first)
+PRIORITY_OTP = "otp"
+PRIORITY_BULK = "bulk"
+PRIORITY_ORDER = (PRIORITY_OTP, PRIORITY_BULK)
+
+def parse_tenant_weights(spec: str) -> dict:
+    weights = {}
+    for entry in (spec or "").split(","):
+        if ":" not in entry:
+            continue
+        tenant_id, weight = entry.split(":", 1)
+        try:
+            weights[str(tenant_id.strip())] = max(1, int(weight))
+        except ValueError:
+            logger.warning(f"Ignoring invalid tenant weight: {entry}")
+    return weights
+
+class TenantMetrics:
+    def __init__(self):
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_seen = time.monotonic()
+
+    def observe_wait(self, wait: float):
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def to_dict(self, queued: int, active: int) -> dict:
+        started = self.sent + self.failed
+        return {
+            "queued": queued,
+            "active": active,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "wait_avg_ms": round(self.wait_total / started * 1000, 2) if started else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
+
+class FairSender:
+    """
+    Deficit round-robin (DRR) over tenants in front of the outbound send path.
+    - Priority classes: "otp" is always served before "bulk"
+    - Each tenant earns `weight` credits per round; one send costs one credit
+    - Per-tenant and global concurrency caps
+    - Per-tenant queue wait time metrics, evicted once a tenant has been idle for `metrics_ttl`
+    """
+    def __init__(self, concurrency: int, tenant_concurrency: int, weights: dict = None, bulk_tenants: set = None,
+                 metrics_ttl: float = 600):
+        self.concurrency = concurrency
+        self.tenant_concurrency = tenant_concurrency
+        self.weights = weights or {}
+        self.bulk_tenants = bulk_tenants or set()
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_ORDER}
+        self._deficit = {}
+        self._active = {}
+        self._inflight = 0
+        self.metrics = {}
+        self.metrics_ttl = metrics_ttl
+        self._last_eviction = time.monotonic()
+
+    def priority_for(self, tenant_id, priority: str = None) -> str:
+        if str(tenant_id) in self.bulk_tenants:
+            return PRIORITY_BULK
+        return priority if priority in PRIORITY_ORDER else PRIORITY_OTP
+
+    async def submit(self, tenant_id, send, priority: str = None):
+        """
+        Queue `send` (a zero-arg coroutine factory) for `tenant_id` and wait for its result.
+        """
+        tenant = str(tenant_id)
+        priority = self.priority_for(tenant_id, priority)
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(tenant, deque()).append((send, future, time.monotonic()))
+        metrics = self.metrics.setdefault(tenant, TenantMetrics())
+        metrics.enqueued += 1
+        metrics.last_seen = time.monotonic()
+        self._evict_idle()
+        self._dispatch()
+        return await future
+
+    def _next(self):
+        """
+        Pick the next (tenant, item) using DRR within the highest non-empty priority class.
+        """
+        for priority in PRIORITY_ORDER:
+            queues = self._queues[priority]
+            eligible = [t for t, q in queues.items() if q and self._active.get(t, 0) < self.tenant_concurrency]
+            if not eligible:
+                continue
+            # Each round, the tenant at the head spends one credit per send; when out
+            # of credit it moves to the back and earns `weight` more.
+            while True:
+                tenant = next(iter(queues))
+                queue = queues[tenant]
+                if not queue:
+                    del queues[tenant]
+                    self._deficit.pop(tenant, None)
+                    continue
+                if tenant in eligible and self._deficit.get(tenant, 0) >= 1:
+                    self._deficit[tenant] -= 1
+                    item = queue.popleft()
+                    if not queue:
+                        del queues[tenant]
+                        self._deficit.pop(tenant, None)
+                    return tenant, item
+                queues.move_to_end(tenant)
+                if tenant in eligible:
+                    self._deficit[tenant] = self._deficit.get(tenant, 0) + self.weights.get(tenant, 1)
+        return None
+
+    def _dispatch(self):
+        while self._inflight < self.concurrency:
+            picked = self._next()
+            if not picked:
+                return
+            tenant, item = picked
+            self._inflight += 1
+            self._active[tenant] = self._active.get(tenant, 0) + 1
+            asyncio.create_task(self._run(tenant, item))
+
+    async def _run(self, tenant: str, item):
+        send, future, enqueued_at = item
+        metrics = self.metrics[tenant]
+        try:
+            if future.done(): # Caller gave up while queued (e.g. reply handed off at shutdown): don't send
+                return
+            metrics.observe_wait(time.monotonic() - enqueued_at)
+            result = await send()
+            metrics.sent += 1
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            metrics.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            metrics.last_seen = time.monotonic()
+            self._inflight -= 1
+            self._active[tenant] -= 1
+            if not self._active[tenant]:
+                del self._active[tenant]
+            self._dispatch()
+
+    def _evict_idle(self):
+        """
+        Drop the metrics of tenants with nothing queued or in flight for `metrics_ttl`
+        (at most one sweep per `metrics_ttl`), so churning tenants don't grow the dict forever.
+        """
+        now = time.monotonic()
+        if now - self._last_eviction < self.metrics_ttl:
+            return
+        self._last_eviction = now
+        busy = set(self._active).union(*self._queues.values())
+        for tenant in [t for t, m in self.metrics.items() if t not in busy and now - m.last_seen >= self.metrics_ttl]:
+            del self.metrics[tenant]
+
+    def snapshot(self) -> dict:
+        self._evict_idle()
+        queued = {}
+        for queues in self._queues.values():
+            for tenant, queue in queues.items():
+                queued[tenant] = queued.get(tenant, 0) + len(queue)
+        return {
+            "inflight": self._inflight,
+            "tenants": {
+                tenant: metrics.to_dict(queued.get(tenant, 0), self._active.get(tenant, 0))
+                for tenant, metrics in self.metrics.items()
+            },
+        }
+
+fair_sender = FairSender(
+    concurrency=settings.FAIR_QUEUE_CONCURRENCY,
+    tenant_concurrency=settings.FAIR_QUEUE_TENANT_CONCURRENCY,
+    weights=parse_tenant_weights(settings.FAIR_QUEUE_TENANT_WEIGHTS),
+    bulk_tenants={t.strip() for t in settings.FAIR_QUEUE_BULK_TENANTS.split(",") if t.strip()},
+    metrics_ttl=settings.FAIR_QUEUE_METRICS_TTL,
+)
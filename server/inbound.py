@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import socket
+import time
+import zlib
+from .config import settings
+from .utils import redis_client, json_dumps, json_loads
+
+logger = logging.getLogger("echoid")
+
+STREAM_KEY = "inbound:{partition}"
+LEASE_KEY = "inbound:lease:{partition}"
+WORKERS_KEY = "inbound:workers"
+CONSUMER_GROUP = "echoid"
+
+# Renew a lease only if we still own it
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Release a lease only if we still own it
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def extract_sender(payload: dict) -> str:
+    if "sender" in payload:
+        return payload.get("sender") or ""
+    return (payload.get("payload") or {}).get("from", "") or ""
+
+def partition_for(sender: str, partitions: int) -> int:
+    return zlib.crc32(sender.encode("utf-8")) % partitions
+
+def assign_partitions(workers: list, partitions: int) -> dict:
+    """
+    Rendezvous (highest random weight) hashing: partition -> worker.
+    When a worker joins or leaves only the partitions it wins/owned move.
+    """
+    assignment = {}
+    for partition in range(partitions):
+        assignment[partition] = max(
+            workers,
+            key=lambda w: hashlib.md5(f"{w}:{partition}".encode("utf-8")).digest()
+        ) if workers else None
+    return assignment
+
+class InboundPartitions:
+    """
+    Sender-partitioned inbound event processing.
+    - Webhooks append events to inbound:{crc32(sender) % N} (Redis stream)
+    - Live workers heartbeat into a sorted set; partitions are assigned by rendezvous hashing
+    - A worker consumes a partition only while it holds that partition's lease,
+      processing its events one at a time (per-sender order), partitions in parallel
+    - The consumer name is per partition, so a new owner inherits unacked events
+    - Before each event the consumer checks its lease is still live locally (deadline taken before
+      the last SET / renewal): a failed renewal or a stalled loop stops it before a new owner starts
+    """
+    def __init__(self, partitions: int):
+        self.partitions = partitions
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+        self.owned = {} # partition -> (task, stop_event)
+        self.lease_until = {} # partition -> monotonic time our lease expires at the latest
+        self.releasing = set() # consumers winding down before their lease is given up
+
+    async def enqueue(self, payload: dict) -> int:
+        partition = partition_for(extract_sender(payload), self.partitions)
+        await redis_client.xadd(
+            STREAM_KEY.format(partition=partition),
+            {"payload": json_dumps(payload)},
+            maxlen=settings.INBOUND_STREAM_MAXLEN,
+            approximate=True,
+        )
+        return partition
+
+    async def _ensure_groups(self):
+        for partition in range(self.partitions):
+            try:
+                await redis_client.xgroup_create(STREAM_KEY.format(partition=partition), CONSUMER_GROUP, id="0", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def _heartbeat(self) -> list:
+        now = time.time()
+        await redis_client.zadd(WORKERS_KEY, {self.worker_id: now})
+        await redis_client.zremrangebyscore(WORKERS_KEY, "-inf", now - settings.INBOUND_LEASE_TTL)
+        return await redis_client.zrangebyscore(WORKERS_KEY, now - settings.INBOUND_LEASE_TTL, "+inf")
+
+    async def _hold_lease(self, partition: int) -> bool:
+        key = LEASE_KEY.format(partition=partition)
+        ttl_ms = settings.INBOUND_LEASE_TTL * 1000
+        started = time.monotonic()
+        if partition in self.owned:
+            held = bool(await redis_client.eval(RENEW_LEASE_SCRIPT, 1, key, self.worker_id, ttl_ms))
+        else:
+            held = bool(await redis_client.set(key, self.worker_id, nx=True, px=ttl_ms))
+        if held:
+            self.lease_until[partition] = started + settings.INBOUND_LEASE_TTL
+        return held
+
+    def _leased(self, partition: int) -> bool:
+        return time.monotonic() < self.lease_until.get(partition, 0)
+
+    def _release(self, partition: int) -> asyncio.Task:
+        """
+        Stop consuming `partition` without holding up the membership loop (and its heartbeat):
+        the consumer stops after the event in hand, then the lease is given up in the background.
+        """
+        task, stop = self.owned.pop(partition)
+        stop.set()
+        release = asyncio.create_task(self._give_up(partition, task))
+        self.releasing.add(release)
+        release.add_done_callback(self.releasing.discard)
+        return release
+
+    async def _give_up(self, partition: int, task: asyncio.Task):
+        await asyncio.gather(task, return_exceptions=True)
+        self.lease_until.pop(partition, None)
+        try:
+            await redis_client.eval(RELEASE_LEASE_SCRIPT, 1, LEASE_KEY.format(partition=partition), self.worker_id)
+        except Exception as e:
+            logger.error(f"[Inbound] Could not release partition {partition} (lease expires on its own): {e}")
+            return
+        logger.info(f"[Inbound] {self.worker_id} released partition {partition}")
+
+    async def _consume(self, partition: int, handler, stop: asyncio.Event):
+        stream = STREAM_KEY.format(partition=partition)
+        consumer = f"p{partition}"
+        # Drain events left unacked by the previous owner first ("0"), then new ones (">")
+        read_id = "0"
+        while not stop.is_set():
+            if not self._leased(partition):
+                # Renewal failed or late: another worker may own the partition by now
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                response = await redis_client.xreadgroup(
+                    CONSUMER_GROUP, consumer, {stream: read_id},
+                    count=settings.INBOUND_BATCH_SIZE,
+                    block=settings.INBOUND_BLOCK_MS if read_id == ">" else None,
+                )
+            except Exception as e:
+                logger.error(f"[Inbound] Read error on partition {partition}: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            entries = response[0][1] if response else []
+            if not entries:
+                read_id = ">"
+                continue
+
+            for entry_id, fields in entries:
+                if stop.is_set() or not self._leased(partition):
+                    # The rest stays pending under this partition's consumer name (re-read from "0")
+                    read_id = "0"
+                    break
+                try:
+                    await handler(json_loads(fields["payload"]))
+                except Exception as e:
+                    # Don't block the partition on a poison event
+                    logger.error(f"[Inbound] Event {entry_id} on partition {partition} failed: {e}")
+                await redis_client.xack(stream, CONSUMER_GROUP, entry_id)
+
+    async def run(self, handler, stop_event: asyncio.Event):
+        """
+        Membership / rebalance loop. Runs until `stop_event` is set.
+        """
+        await self._ensure_groups()
+        logger.info(f"[Inbound] Worker {self.worker_id} consuming {self.partitions} partitions")
+        try:
+            while not stop_event.is_set():
+                try:
+                    workers = await self._heartbeat()
+                    assignment = assign_partitions(workers or [self.worker_id], self.partitions)
+                    for partition, owner in assignment.items():
+                        wanted = owner == self.worker_id
+                        held = wanted and await self._hold_lease(partition)
+                        if held and partition not in self.owned:
+                            stop = asyncio.Event()
+                            task = asyncio.create_task(self._consume(partition, handler, stop))
+                            self.owned[partition] = (task, stop)
+                            logger.info(f"[Inbound] {self.worker_id} acquired partition {partition}")
+                        elif not held and partition in self.owned:
+                            self._release(partition)
+                except Exception as e:
+                    logger.error(f"[Inbound] Rebalance error: {e}")
+
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=settings.INBOUND_LEASE_TTL / 3)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for partition in list(self.owned):
+                self._release(partition)
+            await asyncio.gather(*self.releasing, return_exceptions=True)
+            await redis_client.zrem(WORKERS_KEY, self.worker_id)
+
+inbound_partitions = InboundPartitions(settings.INBOUND_PARTITIONS) if settings.INBOUND_PARTITIONS > 0 else None
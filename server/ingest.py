@@ -0,0 +1,202 @@
+import asyncio
+import codecs
+import json
+import logging
+from .config import settings
+from .utils import TOKEN_PATTERN, json_loads
+
+logger = logging.getLogger("echoid")
+
+_decoder = json.JSONDecoder()
+
+class BatchParseError(Exception):
+    pass
+
+async def iter_batch_events(chunks):
+    """
+    Incrementally parse a batch body from an async iterator of byte chunks.
+    Accepts either a JSON array of events or NDJSON (one event per line).
+    Yields parsed events (or a BatchParseError for a malformed element / line)
+    without buffering the whole body: at most WEBHOOK_BATCH_MAX_EVENT_BYTES
+    of one unfinished element is held, past that the rest of the body is rejected.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")() # Multi-byte chars may span chunks
+    buffer = ""
+    mode = None # "array" | "ndjson"
+    array = None
+    done = False
+    async for chunk in chunks:
+        if done:
+            continue
+        buffer += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+        if mode is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                continue
+            if stripped[0] == "[":
+                mode = "array"
+                array = _ArrayParser()
+                buffer = stripped[1:]
+            else:
+                mode = "ndjson"
+
+        if mode == "ndjson":
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line.strip():
+                    yield _parse_line(line)
+            if len(buffer) > settings.WEBHOOK_BATCH_MAX_EVENT_BYTES:
+                yield BatchParseError("event_too_large")
+                done = True
+            continue
+
+        for event in array.feed(buffer):
+            yield event
+        buffer = ""
+        done = array.done
+
+    if mode == "ndjson" and buffer.strip() and not done:
+        yield _parse_line(buffer)
+    elif mode == "array" and not done:
+        for event in array.feed("", final=True):
+            yield event
+        if not array.done:
+            yield BatchParseError("truncated_array")
+
+class _ArrayParser:
+    """
+    Elements of a JSON array body, fed as text. An element that fails to decode is
+    only reported once its top-level delimiter (',' or ']') has arrived: before that
+    it is just incomplete.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+
+    def feed(self, text: str, final: bool = False) -> list:
+        if self.done: # Anything after ']' (or a rejected element) is ignored
+            return []
+        self.buffer += text
+        events = []
+        while not self.done:
+            buffer = self.buffer.lstrip().lstrip(",").lstrip()
+            self.buffer = buffer
+            if not buffer:
+                break
+            if buffer[0] == "]":
+                self.done = True
+                break
+            try:
+                event, end = _decoder.raw_decode(buffer)
+                # A number (or 'tru') at the end of the chunk may go on in the next one
+                if end < len(buffer) or final:
+                    events.append(event)
+                    self.buffer = buffer[end:]
+                    continue
+            except json.JSONDecodeError:
+                boundary = _element_end(buffer)
+                if boundary is not None:
+                    events.append(BatchParseError("invalid_json"))
+                    self.buffer = buffer[boundary:] # Skip it, keep the delimiter
+                    continue
+            if len(buffer) > settings.WEBHOOK_BATCH_MAX_EVENT_BYTES:
+                events.append(BatchParseError("event_too_large"))
+                self.buffer = ""
+                self.done = True
+            break # Incomplete, wait for more data
+        return events
+
+def _element_end(text: str):
+    """
+    Index of the ',' or ']' ending the first top-level array element of `text`, or None.
+    """
+    depth, in_string, escaped = 0, False, False
+    for i, c in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "[{":
+            depth += 1
+        elif c in "]}":
+            if depth == 0 and c == "]":
+                return i
+            depth = max(depth - 1, 0)
+        elif c == "," and depth == 0:
+            return i
+    return None
+
+def _parse_line(line: str):
+    try:
+        return json_loads(line)
+    except json.JSONDecodeError:
+        return BatchParseError("invalid_json")
+
+def prefilter_event(event) -> str:
+    """
+    CPU-only checks done before any Redis access.
+    Returns a drop reason, or None if the event should be processed.
+    """
+    if not isinstance(event, dict):
+        return "invalid_event"
+    if "sender" in event and "text" in event:
+        body = event.get("text")
+    else:
+        if event.get("event") != "message":
+            return "not_message"
+        body = (event.get("payload") or {}).get("body")
+    if not body or not isinstance(body, str):
+        return "no_body"
+    if not TOKEN_PATTERN.search(body):
+        return "no_token"
+    return None
+
+async def process_batch(events, handler) -> list:
+    """
+    Run `handler(event)` for each parsed event with bounded concurrency.
+    Parsing is paused while WEBHOOK_BATCH_CONCURRENCY events are in flight,
+    so only the per-event results grow with the batch size.
+    Returns per-event results in input order.
+    """
+    semaphore = asyncio.Semaphore(settings.WEBHOOK_BATCH_CONCURRENCY)
+    results = []
+    pending = set()
+
+    async def run(index: int, event):
+        try:
+            result = await handler(event)
+            results[index] = {"index": index, **result}
+        except Exception as e:
+            logger.error(f"[Batch] Event {index} failed: {e}")
+            results[index] = {"index": index, "status": "error", "msg": "processing_failed"}
+        finally:
+            semaphore.release()
+
+    index = 0
+    async for event in events:
+        if index >= settings.WEBHOOK_BATCH_MAX_EVENTS:
+            results.append({"index": index, "status": "ignored", "msg": "batch_limit_exceeded"})
+            break
+        if isinstance(event, BatchParseError):
+            results.append({"index": index, "status": "error", "msg": str(event)})
+        else:
+            reason = prefilter_event(event)
+            if reason:
+                results.append({"index": index, "status": "ignored", "msg": reason})
+            else:
+                results.append(None)
+                await semaphore.acquire()
+                task = asyncio.create_task(run(index, event))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        index += 1
+
+    if pending:
+        await asyncio.gather(*pending)
+    return results
@@ -0,0 +1,68 @@
+from .config import settings
+
+def hash_tag(value) -> str:
+    """
+    '{value}' with REDIS_CLUSTER (keys sharing the tag map to the same cluster slot),
+    the plain value on a single instance (key names unchanged).
+    """
+    return f"{{{value}}}" if settings.REDIS_CLUSTER else str(value)
+
+# Per verification: everything keyed by one token lands on the token's slot
+def session_key(token: str) -> str:
+    return f"session:{hash_tag(token)}"
+
+def otp_key(token: str) -> str:
+    return f"otp:{hash_tag(token)}"
+
+def reply_slot_key(token: str, sender: str) -> str:
+    return f"reply:{hash_tag(token)}:{sender}"
+
+# Single-key namespaces (spread over the cluster)
+def short_link_key(slug: str) -> str:
+    return f"short:{slug}"
+
+def lock_key(msg_id: str) -> str:
+    return f"lock:{msg_id}"
+
+def rate_limit_key(identifier: str) -> str:
+    return f"ratelimit:{identifier}"
+
+# Templates of one language: reply set + upstream list (cleared together)
+def templates_key(language: str = "es_mx") -> str:
+    return f"templates:{hash_tag(language)}"
+
+def upstream_templates_key(language: str = "es_mx") -> str:
+    return f"templates:{hash_tag(language)}:upstream"
+
+# Credit of one tenant: the RESERVE / RELEASE / RECONCILE scripts touch all three
+def credit_key(tenant_id) -> str:
+    return f"credit:{hash_tag(tenant_id)}"
+
+def credit_reservations_key(tenant_id) -> str:
+    return f"credit:reservations:{hash_tag(tenant_id)}"
+
+def credit_outstanding_key(tenant_id) -> str:
+    return f"credit:outstanding:{hash_tag(tenant_id)}"
+
+# Reply scheduler, per shard (SCHEDULER_SHARDS, tenants spread by hash): due sets, tenant index,
+# job bodies and in-flight set are updated by one script. Shard 0 keeps the original key names
+def reply_shard_key(shard: int = 0) -> str:
+    return f"scheduler:{hash_tag('replies' if not shard else f'replies-{shard}')}"
+
+def reply_jobs_key(shard: int = 0) -> str:
+    return f"{reply_shard_key(shard)}:jobs"
+
+def reply_inflight_key(shard: int = 0) -> str:
+    return f"{reply_shard_key(shard)}:inflight"
+
+def reply_tenants_key(shard: int = 0) -> str:
+    return f"{reply_shard_key(shard)}:tenants"
+
+def reply_queue_key(tenant: str, shard: int = 0) -> str:
+    # "-" = replies without a tenant (and jobs queued before the per-tenant split)
+    return reply_shard_key(shard) if tenant == "-" else f"{reply_shard_key(shard)}:tenant:{tenant}"
+
+REPLY_QUEUE_KEY = reply_shard_key(0)
+REPLY_JOBS_KEY = reply_jobs_key(0)
+REPLY_INFLIGHT_KEY = reply_inflight_key(0)
+REPLY_TENANTS_KEY = reply_tenants_key(0)
@@ -0,0 +1,59 @@
+import csv
+import io
+from datetime import datetime
+from sqlalchemy import tuple_
+from .config import settings
+from .database import SessionLocal
+from .models import Log
+from .utils import json_dumps
+
+EXPORT_COLUMNS = ("id", "created_at", "token", "phone", "cost")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def _format_row(row, fmt: str, out: io.StringIO):
+    if fmt == "csv":
+        csv.writer(out).writerow((row.id, row.created_at.isoformat(), row.token, row.phone, row.cost))
+    else:
+        out.write(json_dumps({
+            "id": row.id, "created_at": row.created_at.isoformat(),
+            "token": row.token, "phone": row.phone, "cost": row.cost,
+        }) + "\n")
+
+def iter_log_export(tenant_id: int, since: datetime, until: datetime, fmt: str = "csv", page_size: int = None):
+    """
+    Yield a tenant's logs in [since, until) as CSV / NDJSON chunks, one page at a time.
+    - Keyset pagination on (created_at, id): every page is an index range scan on
+      (tenant_id, created_at) inside the partitions of the time range, never an OFFSET
+    - Rows are fetched from a server-side cursor (yield_per), so memory stays at one page
+    - Runs in Starlette's threadpool (sync generator) with its own session
+    """
+    page_size = page_size or settings.LOG_EXPORT_PAGE_SIZE
+    if fmt == "csv":
+        yield ",".join(EXPORT_COLUMNS) + "\r\n"
+
+    db = SessionLocal()
+    try:
+        cursor = None
+        while True:
+            conditions = [Log.tenant_id == tenant_id, Log.created_at >= since, Log.created_at < until]
+            if cursor:
+                conditions.append(tuple_(Log.created_at, Log.id) > tuple_(*cursor))
+            query = (
+                db.query(Log.id, Log.created_at, Log.token, Log.phone, Log.cost)
+                .filter(*conditions)
+                .order_by(Log.created_at, Log.id)
+                .limit(page_size)
+                .yield_per(1000)
+            )
+            out = io.StringIO()
+            fetched = 0
+            for row in query:
+                _format_row(row, fmt, out)
+                cursor = (row.created_at, row.id)
+                fetched += 1
+            if fetched:
+                yield out.getvalue()
+            if fetched < page_size:
+                break
+    finally:
+        db.close()
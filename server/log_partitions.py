@@ -0,0 +1,223 @@
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime
+from sqlalchemy import text
+from .config import settings
+from .models import Base
+
+logger = logging.getLogger("echoid")
+
+# Postgres only: logs is RANGE-partitioned by month on created_at.
+# SQLite (dev/tests) keeps the plain table from models.Log.
+PARTITION_NAME = "logs_y{year:04d}m{month:02d}"
+PARTITION_PATTERN = re.compile(r"^logs_y(\d{4})m(\d{2})$")
+DEFAULT_PARTITION = "logs_default" # Catches rows if maintenance falls behind
+LEGACY_TABLE = "logs_legacy"
+
+CREATE_PARTITIONED_LOGS = """
+CREATE TABLE logs (
+    id BIGSERIAL,
+    tenant_id INTEGER,
+    phone VARCHAR,
+    token VARCHAR,
+    template_snapshot VARCHAR,
+    cost DOUBLE PRECISION DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at)
+"""
+
+# Columns of the partitioned table, with how each one is read from the legacy table
+LEGACY_COLUMN_EXPRESSIONS = {
+    "id": "id",
+    "tenant_id": "tenant_id",
+    "phone": "phone",
+    "token": "token",
+    "template_snapshot": "template_snapshot",
+    "cost": "cost",
+    "created_at": "COALESCE(created_at, now() AT TIME ZONE 'utc')",
+}
+# Older deployments stored the OTP: it is dropped and masked in the snapshot
+MASKED_SNAPSHOT = "CASE WHEN otp IS NULL OR otp = '' THEN template_snapshot ELSE replace(template_snapshot, otp, '{otp}') END"
+
+def copy_legacy_logs_sql(legacy_columns) -> str:
+    """
+    INSERT ... SELECT for the columns the legacy table actually has (the others take their
+    defaults; old rows keep their id when it exists).
+    """
+    columns = [c for c in LEGACY_COLUMN_EXPRESSIONS if c in legacy_columns]
+    expressions = [
+        MASKED_SNAPSHOT if c == "template_snapshot" and "otp" in legacy_columns else LEGACY_COLUMN_EXPRESSIONS[c]
+        for c in columns
+    ]
+    return f"INSERT INTO logs ({', '.join(columns)}) SELECT {', '.join(expressions)} FROM {LEGACY_TABLE}"
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+def add_months(day: date, months: int) -> date:
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month: date) -> str:
+    return PARTITION_NAME.format(year=month.year, month=month.month)
+
+def parse_partition_name(name: str):
+    match = PARTITION_PATTERN.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+def expired_partitions(names, today: date, retention_months: int) -> list:
+    """
+    Monthly partitions that end before the retention cutoff (oldest first).
+    """
+    cutoff = add_months(month_start(today), -retention_months)
+    months = sorted(m for m in map(parse_partition_name, names) if m and add_months(m, 1) <= cutoff)
+    return [partition_name(m) for m in months]
+
+def _relkind(conn, table: str):
+    return conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table}).scalar()
+
+def _table_columns(conn, table: str) -> set:
+    rows = conn.execute(text(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = :t"
+    ), {"t": table})
+    return {row[0] for row in rows}
+
+def _rename_legacy_indexes(conn):
+    # Index names are schema-wide: free ix_logs_* (e.g. from create_all) for the partitioned table
+    rows = conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :t AND indexname <> :pk"
+    ), {"t": LEGACY_TABLE, "pk": f"{LEGACY_TABLE}_pkey"})
+    for (name,) in rows.fetchall():
+        conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{LEGACY_TABLE}_{name}"'))
+
+def _attached_partitions(conn) -> set:
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'logs'::regclass"
+    ))
+    return {row[0] for row in rows}
+
+def ensure_log_partitions(conn, start: date, end: date) -> list:
+    """
+    Create the monthly partitions covering [start, end]. Rows that already landed in the
+    default partition for a new month are moved into it before it is attached.
+    """
+    attached = _attached_partitions(conn)
+    if DEFAULT_PARTITION not in attached:
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF logs DEFAULT"))
+
+    created = []
+    month = month_start(start)
+    while month <= end:
+        name, upper = partition_name(month), add_months(month, 1)
+        if name not in attached:
+            bounds = {"lower": month, "upper": upper}
+            conn.execute(text(f"CREATE TABLE {name} (LIKE logs INCLUDING DEFAULTS)"))
+            conn.execute(text(
+                f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper"
+            ), bounds)
+            conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper"), bounds)
+            conn.execute(text(
+                f"ALTER TABLE logs ATTACH PARTITION {name} FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+            ))
+            created.append(name)
+        month = upper
+    return created
+
+def setup_log_partitions(engine, migrate: bool = True) -> bool:
+    """
+    Create the partitioned logs table (or convert the legacy single table) and the partitions
+    for the coming months. Runs in one transaction; no-op on non-Postgres databases.
+    With migrate=False a legacy single table is left as is (init_db converts it).
+    """
+    if engine.dialect.name != "postgresql":
+        return False
+
+    with engine.begin() as conn:
+        kind = _relkind(conn, "logs")
+        if kind == "r" and not migrate:
+            return False
+        start = month_start(datetime.utcnow().date())
+        if kind == "r":
+            # 1. Move the old table (and the names it owns) out of the way
+            logger.info("[Logs] Migrating single logs table to monthly partitions")
+            conn.execute(text("LOCK TABLE logs IN ACCESS EXCLUSIVE MODE"))
+            conn.execute(text(f"ALTER TABLE logs RENAME TO {LEGACY_TABLE}"))
+            conn.execute(text(f"ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT logs_pkey TO {LEGACY_TABLE}_pkey"))
+            conn.execute(text(f"ALTER SEQUENCE IF EXISTS logs_id_seq RENAME TO {LEGACY_TABLE}_id_seq"))
+            _rename_legacy_indexes(conn)
+            oldest = conn.execute(text(f"SELECT MIN(created_at) FROM {LEGACY_TABLE}")).scalar()
+            if oldest:
+                start = min(start, month_start(oldest.date()))
+
+        if kind in (None, "r"):
+            # 2. Partitioned parent + composite index (propagates to every partition)
+            conn.execute(text(CREATE_PARTITIONED_LOGS))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_logs_tenant_id_created_at ON logs (tenant_id, created_at)"))
+
+        ensure_log_partitions(conn, start, add_months(month_start(datetime.utcnow().date()), settings.LOG_PARTITIONS_AHEAD))
+
+        if kind == "r":
+            # 3. Copy rows without OTPs, continue the id sequence, drop the old table
+            moved = conn.execute(text(copy_legacy_logs_sql(_table_columns(conn, LEGACY_TABLE)))).rowcount
+            conn.execute(text("SELECT setval('logs_id_seq', COALESCE((SELECT MAX(id) FROM logs), 0) + 1, false)"))
+            conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+            logger.info(f"[Logs] Moved {moved} row(s) into partitioned logs")
+    return True
+
+def create_tables(engine, tables: list = None):
+    """
+    Base.metadata.create_all for the scripts. On Postgres logs is never created as a plain
+    table (init_db would then have to migrate it): it is created partitioned if missing.
+    """
+    tables = tables if tables is not None else Base.metadata.sorted_tables
+    if engine.dialect.name == "postgresql":
+        if any(table.name == "logs" for table in tables):
+            setup_log_partitions(engine, migrate=False)
+        tables = [table for table in tables if table.name != "logs"]
+    Base.metadata.create_all(bind=engine, tables=tables)
+
+def _export_partition(engine, name: str, archive_dir: str) -> str:
+    """
+    COPY one (detached) partition to {archive_dir}/{name}.csv.gz; written to a temp file first.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    raw = engine.raw_connection()
+    try:
+        with gzip.open(path + ".tmp", "wb") as fh:
+            raw.cursor().copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", fh)
+        os.replace(path + ".tmp", path)
+    finally:
+        raw.close()
+    return path
+
+def archive_log_partitions(engine, retention_months: int = None, archive_dir: str = None, dry_run: bool = False) -> list:
+    """
+    Detach partitions older than the retention window, export them to gzipped CSV and drop them.
+    Also picks up partitions left detached by an interrupted previous run.
+    """
+    if engine.dialect.name != "postgresql":
+        return []
+    retention_months = settings.LOG_RETENTION_MONTHS if retention_months is None else retention_months
+    archive_dir = archive_dir or settings.LOG_ARCHIVE_DIR
+
+    with engine.connect() as conn:
+        tables = [row[0] for row in conn.execute(text("SELECT tablename FROM pg_tables WHERE tablename LIKE 'logs_y%'"))]
+        attached = _attached_partitions(conn)
+    expired = expired_partitions(tables, datetime.utcnow().date(), retention_months)
+    if dry_run:
+        return expired
+
+    for name in expired:
+        if name in attached:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE logs DETACH PARTITION {name}"))
+        path = _export_partition(engine, name, archive_dir)
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE {name}"))
+        logger.info(f"[Logs] Archived {name} to {path}")
+    return expired
@@ -1,12 +1,11 @@
 import asyncio
-import re
 import logging
 import time
-import json
 import secrets
-import random
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
@@ -21,27 +20,161 @@ logger = logging.getLogger("echoid")
 
 from .config import settings
 from .schemas import InitRequest, InitResponse, VerifyRequest
+from .keys import session_key, otp_key, short_link_key
 from .utils import (
     generate_token, generate_otp, save_verification_session, 
     get_session_data, acquire_lock, get_random_template, check_rate_limit,
-    redis_client, validate_pkce
+    redis_client, validate_pkce, claim_reply_slot, extract_token_candidates, resolve_session,
+    json_dumps, json_loads, FastJSONResponse
 )
 from .echob_client import echob_client
-from .database import get_db, SessionLocal
-from .models import Tenant, Log
-
-app = FastAPI(title=settings.PROJECT_NAME, version=settings.VERSION)
+from .scheduler import compute_typing_delay, schedule_reply, ack_reply, run_reply_scheduler, reply_tracker, drain_replies
+from .bot_pool import bot_pool
+from .fair_queue import fair_sender, PRIORITY_OTP
+from .inbound import inbound_partitions
+from .ingest import iter_batch_events, process_batch
+from .domains import domain_pool
+from .analytics import click_analytics, is_preview_bot
+from .usage import usage_meter, bucket_start, PERIODS
+from .log_export import iter_log_export, MEDIA_TYPES
+from .billing import charge, from_minor
+from .credit import reserve_credit, settle_credit, run_credit_reconciler
+from .caches import template_cache, tenant_cache, TenantInfo
+from .client_cache import client_cache
+from .warmup import readiness, try_warm_up, run_warm_up, check_dependencies, drain_on_sigterm
+from .database import get_db, SessionLocal, engine
+from .models import Log, ClickStat, UsageRollup
+
+app = FastAPI(title=settings.PROJECT_NAME, version=settings.VERSION, default_response_class=FastJSONResponse)
+
+FUNNEL_METRICS = ("sent", "preview_hits", "clicks", "unique_visitors", "verified")
+
+# Background workers owned by this process. Intake (reply scheduler, inbound consumers) is
+# stopped and drained first on shutdown, then the flushers / syncs (scheduler_stop)
+intake_stop = asyncio.Event()
+intake_workers = []
+scheduler_stop = asyncio.Event()
+background_workers = []
+billing_tasks = set() # Billing of delivered replies, shielded from cancellation
 
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"Server starting up...")
     logger.info(f"Config HOST_URL: {settings.HOST_URL}")
     logger.info(f"Config ECHOB_API_URL: {settings.ECHOB_API_URL}")
+    intake_stop.clear()
+    scheduler_stop.clear()
+    # SIGTERM: out of rotation first, uvicorn stops serving SHUTDOWN_DRAIN_DELAY later
+    drain_on_sigterm(asyncio.get_running_loop(), settings.SHUTDOWN_DRAIN_DELAY)
+    # Pools, caches and a self-check before uvicorn starts accepting connections
+    if not await try_warm_up():
+        background_workers.append(asyncio.create_task(run_warm_up(scheduler_stop)))
+    background_workers.append(asyncio.create_task(template_cache.run(scheduler_stop)))
+    if settings.CLIENT_CACHE:
+        client_cache.on_invalidate(template_cache.mark_changed)
+        background_workers.append(asyncio.create_task(client_cache.run(scheduler_stop)))
+    intake_workers.append(asyncio.create_task(run_reply_scheduler(deliver_reply, intake_stop)))
+    background_workers.append(asyncio.create_task(domain_pool.run_sync(scheduler_stop)))
+    background_workers.append(asyncio.create_task(click_analytics.run(scheduler_stop)))
+    background_workers.append(asyncio.create_task(usage_meter.run(scheduler_stop)))
+    background_workers.append(asyncio.create_task(run_credit_reconciler(scheduler_stop)))
+    if inbound_partitions:
+        intake_workers.append(asyncio.create_task(
+            inbound_partitions.run(lambda payload: process_webhook_payload(payload, BackgroundTasks()), intake_stop)
+        ))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Graceful shutdown (uvicorn has stopped accepting connections and finished open requests):
+    1. Draining: /readyz and the webhooks answer 503 (already since SIGTERM, see warmup.drain_on_sigterm)
+    2. Stop claiming replies / reading inbound streams; claimed replies get SHUTDOWN_DRAIN_TIMEOUT
+       to finish, then unsent ones are handed off and the ones mid-send dead-lettered
+    3. Wait for billing of delivered replies (SHUTDOWN_BILLING_TIMEOUT)
+    4. Stop the flushers (each does a final flush of its buffered counters)
+    5. Close the EchoB, Redis and DB pools, log what was drained vs. abandoned
+    """
+    started = time.monotonic()
+    readiness.state = "draining"
+
+    # 2. Replies
+    intake_stop.set()
+    report = await drain_replies(intake_workers, settings.SHUTDOWN_DRAIN_TIMEOUT)
+    intake_workers.clear()
+
+    # 3. Billing
+    report["billing_flushed"], report["billing_abandoned"] = len(billing_tasks), 0
+    if billing_tasks:
+        _, pending = await asyncio.wait(set(billing_tasks), timeout=settings.SHUTDOWN_BILLING_TIMEOUT)
+        report["billing_flushed"] -= len(pending)
+        report["billing_abandoned"] = len(pending)
+
+    # 4. Flushers
+    scheduler_stop.set()
+    if background_workers:
+        _, pending = await asyncio.wait(background_workers, timeout=settings.SHUTDOWN_BILLING_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*background_workers, return_exceptions=True)
+        background_workers.clear()
+
+    # 5. Pools
+    for name, close in (("echob", echob_client.aclose), ("redis", redis_client.aclose)):
+        try:
+            await close()
+        except Exception as e:
+            logger.error(f"Shutdown: error closing {name} pool: {e}")
+    await run_in_threadpool(engine.dispose)
+
+    report["duration_s"] = round(time.monotonic() - started, 2)
+    abandoned = report["abandoned"] + report["billing_abandoned"]
+    (logger.warning if abandoned else logger.info)(f"Shutdown report: {report}")
+    return report
 
 @app.get("/")
 async def root():
     return {"message": "EchoID Server is running", "version": settings.VERSION}
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: 200 once this worker has finished its warm-up.
+    """
+    if not readiness.alive:
+        return JSONResponse(status_code=503, content={"status": readiness.state, "error": readiness.error})
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: warm-up done and Redis / Postgres answering, with probe latencies.
+    """
+    checks = await check_dependencies()
+    ready = readiness.ready and all(check["ok"] for check in checks.values())
+    content = {
+        "status": "ready" if ready else ("degraded" if readiness.ready else readiness.state),
+        "checks": checks,
+        "warmup": readiness.warmup,
+        "caches": {"templates": len(template_cache), "tenants": len(tenant_cache)},
+    }
+    if readiness.error:
+        content["error"] = readiness.error
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+@app.get("/metrics/outbound")
+async def outbound_metrics():
+    """
+    Per-tenant outbound queue depth, concurrency and queue wait time (this worker).
+    """
+    return fair_sender.snapshot()
+
+@app.get("/metrics/cache")
+async def cache_metrics():
+    """
+    Client-side cache (Redis CLIENT TRACKING) state and hit rate (this worker).
+    """
+    return client_cache.snapshot()
+
 # --- Simulation Schema ---
 class SimulationRequest(BaseModel):
     phone: str
@@ -105,6 +238,8 @@ async def process_webhook_payload(payload: dict, background_tasks: BackgroundTas
     # If it's real webhook:
     event_type = payload.get("event")
     
+    received_session = None
+
     # If it's simulation (no "event" key or custom structure), we adapt
     if "sender" in payload and "text" in payload:
         # Simulation structure adaptation
@@ -119,6 +254,8 @@ async def process_webhook_payload(payload: dict, background_tasks: BackgroundTas
         body = message_data.get("body", "")
         sender = message_data.get("from", "") 
         msg_id = message_data.get("id", "")
+        # EchoB session (bot) that received the message
+        received_session = payload.get("session")
 
     if not body or not sender or not msg_id:
         return {"status": "ignored"}
@@ -130,18 +267,16 @@ async def process_webhook_payload(payload: dict, background_tasks: BackgroundTas
         return {"status": "ignored", "msg": "rate_limit_exceeded"}
 
     # Optimization 2: CPU-based Token Extraction (Avoid Redis if no token)
-    match = re.search(r"\b([A-HJ-KMNP-Z2-9]{6,10})\b", body, re.IGNORECASE)
-    if not match:
+    candidates = extract_token_candidates(body)
+    if not candidates:
         return {"status": "ignored", "msg": "no_token"}
-    
-    token = match.group(1).upper()
 
     # 3. Idempotency Check
     if not await acquire_lock(msg_id):
         return {"status": "ok", "msg": "duplicate"}
 
-    # 4. Retrieve Session & Tenant Info
-    session_data = await get_session_data(token)
+    # 4. Retrieve Session & Tenant Info (all candidates in one MGET)
+    token, session_data = await resolve_session(candidates)
     if not session_data:
         # Session expired or invalid
         return {"status": "ignored", "msg": "session_not_found"}
@@ -169,40 +304,46 @@ async def process_webhook_payload(payload: dict, background_tasks: BackgroundTas
         # This effectively "registers" the user with this phone number for this session
         session_data["phone"] = sender
         # Update session in Redis to save the binding
-        await redis_client.setex(f"session:{token}", settings.SESSION_TTL, json.dumps(session_data))
+        await redis_client.setex(session_key(token), settings.SESSION_TTL, json_dumps(session_data))
 
     tenant_id = session_data.get("tenant_id")
     
     # Update Session with Verified WA ID
     session_data["wa_id"] = sender
-    await redis_client.setex(f"session:{token}", settings.SESSION_TTL, json.dumps(session_data))
+    await redis_client.setex(session_key(token), settings.SESSION_TTL, json_dumps(session_data))
     
     logger.info(f"Processing for Tenant: {tenant_id}, Token: {token}, WA_ID: {sender}")
 
-    # 4. Humanize
-    await echob_client.start_typing("default", sender)
-    await asyncio.sleep(2.5) # Simulate Human behavior (typing delay)
-    await echob_client.stop_typing("default", sender)
+    # Coalesce duplicates: while a reply for (sender, token) is pending or was just sent,
+    # repeated messages attach to it instead of triggering another OTP/send/billing cycle
+    reply_id = secrets.token_hex(8)
+    pending_reply = await claim_reply_slot(token, sender, reply_id)
+    if pending_reply:
+        logger.info(f"Coalesced duplicate message for Token: {token}, WA_ID: {sender}")
+        return {"status": "ok", "msg": "coalesced", "reply_id": pending_reply}
+
+    # Reply through the bot that received the message (sticky bot from /v1/go as fallback)
+    bot = bot_pool.get(received_session) or bot_pool.get(session_data.get("bot_session")) or bot_pool.default
+
+    # 4. Humanize (typing indicator on; stop + send happen in the scheduled job)
+    await echob_client.start_typing(bot.session, sender)
 
     # 5. Prepare Material
     otp = await generate_otp()
     
     # Save OTP for verification (Web Demo support)
-    await redis_client.setex(f"otp:{token}", settings.OTP_TTL, otp)
+    await redis_client.setex(otp_key(token), settings.OTP_TTL, otp)
     
     # Anti-Ban Strategy: Slug Short Link
     slug = secrets.token_urlsafe(6) # e.g. "Hu7_9A"
-    await redis_client.setex(f"short:{slug}", settings.SHORT_LINK_TTL, json.dumps({"token": token, "otp": otp}))
-    
-    # Domain Rotation
-    base_url = settings.HOST_URL
-    if settings.LINK_DOMAINS:
-        domains = [d.strip() for d in settings.LINK_DOMAINS.split(",") if d.strip()]
-        if domains:
-            base_url = random.choice(domains)
-            
-    if not base_url.startswith("http"):
-        base_url = f"http://{base_url}"
+
+    # Domain Rotation (health-weighted, see domains.py)
+    base_url = domain_pool.choose()
+    domain_pool.record_sent(base_url)
+    click_analytics.record_sent(tenant_id, base_url)
+    await redis_client.setex(short_link_key(slug), settings.SHORT_LINK_TTL, json_dumps({
+        "token": token, "otp": otp, "domain": base_url, "tenant_id": tenant_id
+    }))
         
     link = f"{base_url}/q/{slug}"
     
@@ -210,53 +351,110 @@ async def process_webhook_payload(payload: dict, background_tasks: BackgroundTas
     app_name = session_data.get("app_name", "EchoID App")
     
     # 6. Template Assembly
-    template = await get_random_template()
+    template = template_cache.choose() or await get_random_template()
     final_msg = template.format(app_name=app_name, otp=otp, link=link)
     logger.info(f"Selected template: {final_msg}")
 
-    # 7. Send Reply
-    await echob_client.send_text("default", sender, final_msg)
-
-    # 8. Billing & Logging (Background Task)
-    if tenant_id:
-        background_tasks.add_task(
-            log_transaction, 
-            tenant_id=tenant_id, 
-            phone=sender, 
-            token=token, 
-            otp=otp, 
-            template=final_msg, 
-            cost=0.05 # Mock cost per transaction
-        )
+    # 7. Schedule Reply (typing delay based on message length, no coroutine parked here)
+    await schedule_reply({
+        "id": reply_id,
+        "session": bot.session,
+        "chat_id": sender,
+        "text": final_msg,
+        "token": token,
+        "tenant_id": tenant_id,
+        "otp": otp,
+        "priority": PRIORITY_OTP,
+    }, delay=compute_typing_delay(final_msg))
     
     return {"status": "ok"}
 
+async def deliver_reply(job: dict):
+    """
+    Scheduled job: stop typing, send the reply, then bill the tenant.
+    """
+    session = job["session"]
+    chat_id = job["chat_id"]
+    await echob_client.stop_typing(session, chat_id)
+
+    async def send():
+        reply_tracker.mark(job.get("id"), "sending")
+        return await echob_client.send_text(session, chat_id, job["text"])
+
+    try:
+        # Fair queuing per tenant so one tenant's burst can't delay everyone's OTPs
+        await fair_sender.submit(job.get("tenant_id"), send, priority=job.get("priority"))
+    except Exception:
+        await bot_pool.record_send(session, ok=False)
+        raise
+    # Delivered: from here on nothing may fail the job (the scheduler would send it again)
+    reply_tracker.mark(job.get("id"), "sent")
+    await after_delivery("ack", job, ack_reply(job))
+    await after_delivery("bot health", job, bot_pool.record_send(session, ok=True))
+
+    # 8. Billing & Logging (shielded: a shutdown deadline must not drop the charge of a delivered reply)
+    if job.get("tenant_id"):
+        task = asyncio.ensure_future(after_delivery("billing", job, bill_reply(job)))
+        billing_tasks.add(task)
+        task.add_done_callback(billing_tasks.discard)
+        await asyncio.shield(task)
+
+async def after_delivery(step: str, job: dict, coro):
+    try:
+        await coro
+    except Exception as e:
+        logger.error(f"Delivered reply {job.get('id')}: {step} failed: {e}")
+
+async def bill_reply(job: dict):
+    billed = await run_in_threadpool(
+        log_transaction,
+        tenant_id=job["tenant_id"],
+        phone=job["chat_id"],
+        token=job["token"],
+        otp=job["otp"],
+        template=job["text"],
+        cost_minor=settings.VERIFICATION_COST_MINOR
+    )
+    # Charge is in Postgres now: meter it, then settle the credit reserved at /v1/init
+    # (an unsettled reservation expires and is reconciled, never charged twice)
+    if billed:
+        usage_meter.record(job["tenant_id"], job["chat_id"], settings.VERIFICATION_COST_MINOR)
+        await settle_credit(job["tenant_id"], job["token"])
+
 # Helper for background task billing
-def log_transaction(tenant_id: int, phone: str, token: str, otp: str, template: str, cost: float):
+def log_transaction(tenant_id: int, phone: str, token: str, otp: str, template: str, cost_minor: int):
     db = SessionLocal()
     try:
-        # Decrement balance
-        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
-        if tenant:
-            tenant.balance -= cost
+        # Decrement balance (ledger entry + one random balance shard, see billing.py)
+        charge(db, tenant_id, cost_minor, reference=token)
             
         # Create log
         log_entry = Log(
             tenant_id=tenant_id,
             phone=phone,
             token=token,
-            otp=otp,
-            template_snapshot=template,
-            cost=cost
+            template_snapshot=template.replace(otp, "{otp}") if otp else template,
+            cost=from_minor(cost_minor)
         )
         db.add(log_entry)
         db.commit()
+        return True
     except Exception as e:
         logger.error(f"Error in billing: {e}")
         db.rollback()
+        return False
     finally:
         db.close()
 
+def require_tenant(x_api_key: str = Header(...), db: Session = Depends(get_db)) -> TenantInfo:
+    """
+    API key auth for tenant read APIs (X-Api-Key header).
+    """
+    tenant = tenant_cache.get(db, x_api_key)
+    if not tenant:
+        raise HTTPException(status_code=403, detail="Invalid API Key")
+    return tenant
+
 @app.post("/v1/init", response_model=InitResponse)
 async def init_verification(request: InitRequest, db: Session = Depends(get_db)):
     """
@@ -270,15 +468,16 @@ async def init_verification(request: InitRequest, db: Session = Depends(get_db))
     #    raise HTTPException(status_code=429, detail="Too many requests")
 
     # 1. Auth & Balance Check
-    tenant = db.query(Tenant).filter(Tenant.api_key == request.api_key).first()
+    tenant = tenant_cache.get(db, request.api_key)
     if not tenant:
         raise HTTPException(status_code=403, detail="Invalid API Key")
     
-    if tenant.balance <= 0:
-        raise HTTPException(status_code=402, detail="Insufficient balance")
-    
     # 2. Generate Session
     token = await generate_token() # LOGIN-XXXXX
+
+    # Credit decision in Redis: hold the verification cost until it is billed (or expires)
+    if not await reserve_credit(tenant.id, token):
+        raise HTTPException(status_code=402, detail="Insufficient balance")
     
     # 3. Cache
     await save_verification_session(
@@ -311,13 +510,20 @@ async def go_redirect(token: str):
     if not session_data:
         raise HTTPException(status_code=404, detail="Invalid or expired link")
     
-    # 2. Construct WhatsApp Deep Link
-    target_phone = settings.BOT_PHONE_NUMBER
+    # 2. Assign Bot (sticky for the token's lifetime)
+    bot = bot_pool.get(session_data.get("bot_session"))
+    if not bot:
+        bot = await bot_pool.choose()
+        session_data["bot_session"] = bot.session
+        await redis_client.setex(session_key(token), settings.SESSION_TTL, json_dumps(session_data))
+
+    # 3. Construct WhatsApp Deep Link
+    target_phone = bot.phone
     # Message MUST match the regex in webhook: \b([A-HJ-KMNP-Z2-9]{6,10})\b
     message = f"Hola, mi código de verificación es {token}"
     wa_link = f"https://wa.me/{target_phone}?text={message}"
     
-    # 3. Redirect
+    # 4. Redirect
     return RedirectResponse(url=wa_link)
 
 @app.post("/v1/verify")
@@ -325,7 +531,7 @@ async def verify_otp(request: VerifyRequest):
     """
     Verify OTP for Web Demo (or App Manual Entry).
     """
-    stored_otp = await redis_client.get(f"otp:{request.token}")
+    stored_otp = await redis_client.get(otp_key(request.token))
     if not stored_otp:
         # For security, we might want to return generic error, but for demo specific is fine
         raise HTTPException(status_code=400, detail="Invalid or expired session")
@@ -334,7 +540,7 @@ async def verify_otp(request: VerifyRequest):
         raise HTTPException(status_code=400, detail="Invalid OTP")
         
     # Security: Invalidate OTP immediately after use (Replay Attack Prevention)
-    await redis_client.delete(f"otp:{request.token}")
+    await redis_client.delete(otp_key(request.token))
 
     # Retrieve WA ID from session if available
     session_data = await get_session_data(request.token)
@@ -350,6 +556,8 @@ async def verify_otp(request: VerifyRequest):
             raise HTTPException(status_code=403, detail="PKCE Validation Failed")
 
     wa_id = session_data.get("wa_id") if session_data else None
+    if session_data and session_data.get("tenant_id"):
+        click_analytics.record_verified(session_data["tenant_id"])
 
     return {"status": "verified", "wa_id": wa_id}
 
@@ -358,18 +566,28 @@ async def short_link_handler(request: Request, slug: str):
     """
     Anti-Ban Short Link Redirect (302 Redirect)
     """
-    data_str = await redis_client.get(f"short:{slug}")
+    # Written once, then read by the user's click and every link preview fetch (expiry invalidates it)
+    data_str = await client_cache.get(short_link_key(slug))
     if not data_str:
         return HTMLResponse(content="<h1>Link Expired or Invalid</h1>", status_code=404)
     
     try:
-        data = json.loads(data_str)
+        data = json_loads(data_str)
         token = data.get('token')
         otp = data.get('otp')
         
         if not token or not otp:
              return HTMLResponse(content="<h1>Invalid Link Data</h1>", status_code=400)
 
+        # Domain health & click analytics (in-process buffers, never waits on I/O)
+        user_agent = request.headers.get("user-agent", "")
+        click_analytics.record_click(
+            data.get("tenant_id"), data.get("domain"), user_agent, request.client.host if request.client else ""
+        )
+        if data.get("domain") and not is_preview_bot(user_agent):
+            # Unfurlers fetch the most-shared domains most: counting them would inflate their CTR
+            domain_pool.record_click(data["domain"])
+
         # Custom Scheme Target (iOS / Fallback)
         target = f"echoid://login?token={token}&otp={otp}"
         
@@ -406,10 +624,100 @@ async def short_link_handler(request: Request, slug: str):
         return RedirectResponse(url=final_target, status_code=302)
 
         # DO NOT DELETE immediately to allow Link Preview generation (Redis TTL handles expiration)
-        # await redis_client.delete(f"short:{slug}")
+        # await redis_client.delete(short_link_key(slug))
     except Exception:
         return HTMLResponse(content="<h1>Server Error</h1>", status_code=500)
 
+@app.get("/v1/analytics/funnel")
+async def analytics_funnel(days: int = 7, tenant: TenantInfo = Depends(require_tenant), db: Session = Depends(get_db)):
+    """
+    Short-link funnel (sent -> preview hits -> clicks -> unique visitors -> verified)
+    for the calling tenant, overall and per domain, from the click_stats rollups.
+    """
+    since = (datetime.utcnow() - timedelta(days=max(1, days) - 1)).date()
+    rows = db.query(ClickStat).filter(ClickStat.tenant_id == tenant.id, ClickStat.day >= since).all()
+
+    def funnel(stats):
+        totals = {metric: sum(getattr(r, metric) or 0 for r in stats) for metric in FUNNEL_METRICS}
+        totals["ctr"] = round(totals["clicks"] / totals["sent"], 4) if totals["sent"] else 0.0
+        totals["verify_rate"] = round(totals["verified"] / totals["sent"], 4) if totals["sent"] else 0.0
+        return totals
+
+    domains = {}
+    for row in rows:
+        if row.domain:
+            domains.setdefault(row.domain, []).append(row)
+
+    return {
+        "tenant_id": tenant.id,
+        "since": since.isoformat(),
+        "funnel": funnel(rows),
+        "domains": {domain: funnel(stats) for domain, stats in domains.items()},
+    }
+
+@app.get("/v1/usage")
+async def usage_report(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    periods: int = Query(7, ge=1, le=744),
+    tenant: TenantInfo = Depends(require_tenant),
+    db: Session = Depends(get_db),
+):
+    """
+    Billed verifications, spend and unique phones for the calling tenant over the last
+    `periods` hours / days, from the usage_rollups table only.
+    """
+    since = bucket_start(granularity, datetime.utcnow() - PERIODS[granularity][1] * (periods - 1))
+    rows = db.query(UsageRollup).filter(
+        UsageRollup.tenant_id == tenant.id,
+        UsageRollup.period == granularity,
+        UsageRollup.bucket >= since,
+    ).order_by(UsageRollup.bucket).all()
+
+    buckets = [{
+        "bucket": row.bucket.isoformat(),
+        "verifications": row.verifications or 0,
+        "cost": from_minor(row.cost_minor or 0),
+        "unique_phones": row.unique_phones or 0,
+    } for row in rows]
+    return {
+        "tenant_id": tenant.id,
+        "granularity": granularity,
+        "since": since.isoformat(),
+        "totals": {
+            "verifications": sum(b["verifications"] for b in buckets),
+            "cost": from_minor(sum(row.cost_minor or 0 for row in rows)),
+        },
+        "buckets": buckets,
+    }
+
+def naive_utc(value: datetime):
+    # created_at is stored as naive UTC; query params may carry 'Z' or an offset
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+@app.get("/v1/logs/export")
+async def export_logs(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    since: datetime = None,
+    until: datetime = None,
+    tenant: TenantInfo = Depends(require_tenant),
+):
+    """
+    Stream the calling tenant's billed verifications in [since, until) (default: last 30 days)
+    as CSV or NDJSON, ordered by (created_at, id).
+    """
+    until = naive_utc(until) or datetime.utcnow()
+    since = naive_utc(since) or until - timedelta(days=30)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    filename = f"logs_{since:%Y%m%d}_{until:%Y%m%d}.{format}"
+    return StreamingResponse(
+        iter_log_export(tenant.id, since, until, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 @app.get("/jump")
 async def jump_link(t: str, o: str):
     """
@@ -425,9 +733,33 @@ async def echob_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     PRD v5.0 Section 3.2.B: WhatsApp Webhook
     """
+    if readiness.draining: # EchoB retries; another worker takes it
+        return JSONResponse(status_code=503, content={"status": "draining"})
     try:
-        payload = await request.json()
+        payload = json_loads(await request.body())
     except:
         return {"status": "ignored"}
 
+    # Partitioned mode: per-sender ordering, processed by the worker owning the partition
+    if inbound_partitions:
+        partition = await inbound_partitions.enqueue(payload)
+        return {"status": "queued", "partition": partition}
+
     return await process_webhook_payload(payload, background_tasks)
+
+@app.post("/webhook/echob/batch")
+async def echob_webhook_batch(request: Request, background_tasks: BackgroundTasks):
+    """
+    Batch variant of /webhook/echob (gateway backlog replay).
+    Body: JSON array of events or NDJSON. Returns one result per event, in order.
+    """
+    if readiness.draining:
+        return JSONResponse(status_code=503, content={"status": "draining"})
+    async def handle(event: dict):
+        if inbound_partitions:
+            partition = await inbound_partitions.enqueue(event)
+            return {"status": "queued", "partition": partition}
+        return await process_webhook_payload(event, background_tasks)
+
+    results = await process_batch(iter_batch_events(request.stream()), handle)
+    return {"status": "ok", "count": len(results), "results": results}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, Date, UniqueConstraint, Index
 from sqlalchemy.orm import declarative_base
 from datetime import datetime
 
@@ -10,21 +10,49 @@ class Tenant(Base):
     id = Column(Integer, primary_key=True, index=True)
     api_key = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=False)
-    balance = Column(Float, default=0.0)
+    balance = Column(Float, default=0.0) # Legacy, migrated into balance_shards (see billing.py)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
 
+class LedgerEntry(Base):
+    """
+    Append-only record of every balance movement (integer minor units, e.g. cents).
+    """
+    __tablename__ = "ledger"
+    __table_args__ = (Index("ix_ledger_tenant_id_created_at", "tenant_id", "created_at"),)
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    tenant_id = Column(Integer, nullable=False)
+    amount_minor = Column(BigInteger, nullable=False) # Negative = charge, positive = top-up
+    kind = Column(String, nullable=False) # charge, topup, migration
+    reference = Column(String) # e.g. verification token
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class BalanceShard(Base):
+    """
+    One of BALANCE_SHARDS counters per tenant; the balance is the sum of the shards.
+    """
+    __tablename__ = "balance_shards"
+
+    tenant_id = Column(Integer, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    balance_minor = Column(BigInteger, nullable=False, default=0)
+
 class Log(Base):
+    """
+    One row per billed verification. On Postgres the table is RANGE-partitioned by month
+    on created_at (see log_partitions.py); the OTP itself is never stored.
+    """
     __tablename__ = "logs"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    tenant_id = Column(Integer, index=True)
-    phone = Column(String, index=True)
-    token = Column(String, index=True)
-    otp = Column(String)
-    template_snapshot = Column(String) # Record the actual message sent
+    __table_args__ = (Index("ix_logs_tenant_id_created_at", "tenant_id", "created_at"),)
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    tenant_id = Column(Integer)
+    phone = Column(String)
+    token = Column(String)
+    template_snapshot = Column(String) # Message sent, with the OTP masked as {otp}
     cost = Column(Float, default=0.0)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 class Template(Base):
     __tablename__ = "templates"
@@ -36,3 +64,37 @@ class Template(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     source = Column(String, default="ai_generated") # ai_generated, manual
+
+class ClickStat(Base):
+    """
+    Daily short-link funnel per tenant & domain (rolled up from Redis analytics counters).
+    """
+    __tablename__ = "click_stats"
+    __table_args__ = (UniqueConstraint("day", "tenant_id", "domain", name="uq_click_stats_day_tenant_domain"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False)
+    tenant_id = Column(Integer, nullable=False)
+    domain = Column(String, nullable=False, default="")
+    sent = Column(Integer, default=0)
+    clicks = Column(Integer, default=0)
+    preview_hits = Column(Integer, default=0) # Link preview bots (WhatsApp, facebookexternalhit...)
+    unique_visitors = Column(Integer, default=0) # HyperLogLog estimate
+    verified = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class UsageRollup(Base):
+    """
+    Billed usage per tenant per hour / day (rolled up from Redis usage counters).
+    """
+    __tablename__ = "usage_rollups"
+    __table_args__ = (UniqueConstraint("tenant_id", "period", "bucket", name="uq_usage_rollups_tenant_period_bucket"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    tenant_id = Column(Integer, nullable=False)
+    period = Column(String, nullable=False) # hour, day
+    bucket = Column(DateTime, nullable=False) # Start of the hour / day (UTC)
+    verifications = Column(Integer, default=0)
+    cost_minor = Column(BigInteger, default=0)
+    unique_phones = Column(Integer, default=0) # HyperLogLog estimate
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,108 @@
+import hashlib
+import re
+import unicodedata
+from array import array
+from .config import settings
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\w+\}") # {otp}, {link}, {app_name}
+GENERATED_TOKEN_PATTERN = re.compile(r"\b[A-HJ-KMNP-Z2-9]{6,10}\b") # Upstream messages embed an uppercase token
+NON_WORD_PATTERN = re.compile(r"[^\w§]+")
+SHINGLE_SIZE = 4
+SHINGLE_CACHE_SIZE = 200_000 # Templates of one language share most of their shingles
+
+def normalize_template(text: str) -> str:
+    """
+    Lowercase, strip accents and punctuation, mask placeholders / tokens as '§'.
+    """
+    text = PLACEHOLDER_PATTERN.sub(" § ", text)
+    text = GENERATED_TOKEN_PATTERN.sub(" § ", text)
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(NON_WORD_PATTERN.sub(" ", text).split())
+
+def shingles(text: str) -> set:
+    """
+    Character 4-grams (templates are a dozen words, too short for word shingles).
+    """
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def lsh_params(num_perm: int, threshold: float):
+    """
+    (bands, rows) with bands * rows == num_perm whose S-curve threshold (1/b)^(1/r) is the
+    highest one not above `threshold` (favours recall; candidates are verified anyway).
+    """
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    below = [(b, r) for b, r in options if (1 / b) ** (1 / r) <= threshold]
+    if below:
+        return max(below, key=lambda p: (1 / p[0]) ** (1 / p[1]))
+    return min(options, key=lambda p: (1 / p[0]) ** (1 / p[1]))
+
+class NearDuplicateIndex:
+    """
+    MinHash + LSH index of template texts.
+    - signature: per-position minimum of num_perm 32-bit hashes of each shingle (one SHAKE-128
+      digest per shingle, cached), i.e. num_perm independent MinHash functions
+    - LSH banding: only templates sharing a band bucket are compared
+    - a match is a candidate whose estimated Jaccard similarity >= threshold
+    """
+    def __init__(self, threshold: float = None, num_perm: int = None):
+        self.threshold = settings.TEMPLATE_SIMILARITY_THRESHOLD if threshold is None else threshold
+        self.num_perm = num_perm or settings.TEMPLATE_MINHASH_PERMUTATIONS
+        self._shingle_cache = {}
+        self.bands, self.rows = lsh_params(self.num_perm, self.threshold)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _hashes(self, shingle: str) -> array:
+        hashes = self._shingle_cache.get(shingle)
+        if hashes is None:
+            if len(self._shingle_cache) >= SHINGLE_CACHE_SIZE:
+                self._shingle_cache.clear()
+            hashes = array("I", hashlib.shake_128(shingle.encode("utf-8")).digest(4 * self.num_perm))
+            self._shingle_cache[shingle] = hashes
+        return hashes
+
+    def signature(self, text: str) -> array:
+        # Packed uint32 array: 4 bytes per value instead of a tuple of int objects (~25 MB per 100k templates)
+        return array("I", map(min, zip(*(self._hashes(s) for s in shingles(normalize_template(text))))))
+
+    def _band_keys(self, signature: array):
+        r = self.rows
+        return [signature[i * r:(i + 1) * r].tobytes() for i in range(self.bands)]
+
+    def add(self, key, text: str, signature: array = None):
+        signature = signature or self.signature(text)
+        self._signatures[key] = signature
+        for bucket, band in zip(self._buckets, self._band_keys(signature)):
+            bucket.setdefault(band, []).append(key)
+
+    def query(self, text: str, signature: array = None):
+        """
+        Most similar indexed template as (key, similarity), or None below the threshold.
+        """
+        signature = signature or self.signature(text)
+        candidates = set()
+        for bucket, band in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(band, ()))
+        best = None
+        for key in candidates:
+            other = self._signatures[key]
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def check_and_add(self, key, text: str):
+        """
+        Return the near-duplicate match if there is one; otherwise index `text` and return None.
+        """
+        signature = self.signature(text)
+        match = self.query(text, signature)
+        if match is None:
+            self.add(key, text, signature)
+        return match
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import random
+import secrets
+import time
+import zlib
+from .config import settings
+from .utils import redis_client, release_reply_slot, json_dumps, json_loads
+from .dead_letter import add_dead_letter
+from .keys import reply_jobs_key, reply_inflight_key, reply_tenants_key, reply_queue_key
+
+logger = logging.getLogger("echoid")
+
+# Per shard (a tenant's replies all live in one shard, see reply_shard_for):
+# Pending replies: one sorted set per tenant, job id -> due timestamp (reply_queue_key),
+# indexed by reply_tenants_key: tenant -> due time of its next job. Job bodies in a hash (reply_jobs_key)
+# Claimed replies: sorted set job id -> lease deadline (reply_inflight_key, detects workers dying mid-send)
+# The keys of one shard share a hash tag in cluster mode (the scripts touch them together),
+# shards spread the scheduler over the cluster
+
+SCHEDULE_SCRIPT = """
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+redis.call('ZADD', KEYS[3], head[2], ARGV[4])
+return 1
+"""
+
+# Move one tenant's due jobs to the in-flight set atomically so that exactly one worker runs each job
+CLAIM_DUE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[3], ARGV[3], id)
+end
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #head == 0 then
+    redis.call('ZREM', KEYS[4], ARGV[4])
+else
+    redis.call('ZADD', KEYS[4], head[2], ARGV[4])
+end
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(ids))
+"""
+
+# Index a due set written without the tenant index (replies queued before the per-tenant split)
+INDEX_QUEUE_SCRIPT = """
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #head > 0 then
+    redis.call('ZADD', KEYS[2], head[2], ARGV[1])
+end
+return #head
+"""
+
+ACK_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+class ReplyTracker:
+    """
+    Replies claimed by this worker and how far each one got, for the shutdown drain:
+    - queued: not handed to EchoB yet (another worker can safely take it over)
+    - sending: EchoB call in flight (outcome unknown)
+    - sent: delivered, billing in progress
+    """
+    def __init__(self):
+        self.jobs = {} # id -> [job, phase]
+        self.completed = 0
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def add(self, job: dict):
+        self.jobs[job["id"]] = [job, "queued"]
+
+    def mark(self, job_id: str, phase: str):
+        if job_id in self.jobs:
+            self.jobs[job_id][1] = phase
+
+    def finish(self, job_id: str):
+        if self.jobs.pop(job_id, None) is not None:
+            self.completed += 1
+
+def compute_typing_delay(text: str) -> float:
+    """
+    Human-like typing delay for a reply:
+    - Base delay + time to "type" each character
+    - Random jitter (TYPING_DELAY_JITTER) so replies don't arrive on a fixed beat
+    - Clamped to [TYPING_DELAY_MIN, TYPING_DELAY_MAX]
+    """
+    delay = settings.TYPING_DELAY_BASE + len(text or "") * settings.TYPING_DELAY_PER_CHAR
+    jitter = settings.TYPING_DELAY_JITTER
+    delay *= random.uniform(1 - jitter, 1 + jitter)
+    return max(settings.TYPING_DELAY_MIN, min(settings.TYPING_DELAY_MAX, delay))
+
+def reply_tenant(job: dict) -> str:
+    tenant_id = job.get("tenant_id")
+    return "-" if tenant_id is None else str(tenant_id)
+
+def reply_shard_for(tenant: str) -> int:
+    return zlib.crc32(tenant.encode("utf-8")) % max(1, settings.SCHEDULER_SHARDS)
+
+def reply_shard(job: dict) -> int:
+    # Shard the job was scheduled in (jobs queued before sharding: 0)
+    return int(job.get("shard") or 0)
+
+async def schedule_reply(job: dict, delay: float) -> str:
+    """
+    Store a "stop typing and send reply at T" job in its tenant's due set. Any worker can pick it up once due.
+    """
+    job = dict(job)
+    job.setdefault("id", secrets.token_hex(8))
+    job.setdefault("attempts", 0)
+    due_at = time.time() + delay
+    tenant = reply_tenant(job)
+    shard = job["shard"] = reply_shard_for(tenant)
+    await redis_client.eval(
+        SCHEDULE_SCRIPT, 3, reply_queue_key(tenant, shard), reply_jobs_key(shard), reply_tenants_key(shard),
+        job["id"], json_dumps(job), due_at, tenant
+    )
+    return job["id"]
+
+async def claim_tenant_replies(shard: int, tenant: str, limit: int, now: float) -> list:
+    raw_jobs = await redis_client.eval(
+        CLAIM_DUE_SCRIPT, 4, reply_queue_key(tenant, shard), reply_jobs_key(shard), reply_inflight_key(shard),
+        reply_tenants_key(shard), now, limit, now + settings.REPLY_LEASE_SECONDS, tenant
+    )
+    jobs = []
+    for raw in raw_jobs or []:
+        if raw is None:
+            continue
+        try:
+            job = json_loads(raw)
+        except (TypeError, json.JSONDecodeError):
+            logger.error(f"Scheduler: dropping malformed job {raw!r}")
+            continue
+        job["shard"] = shard # Acked / renewed where it was claimed
+        jobs.append(job)
+    return jobs
+
+class ClaimRotation:
+    """
+    Order in which a worker visits tenants with due replies: least recently claimed first,
+    tenants it has not claimed for yet (e.g. one that just became due) ahead of everyone.
+    Only tenants due at the last claim are remembered.
+    """
+    def __init__(self):
+        self.last_claim = {} # tenant -> claim round
+        self.rounds = 0
+
+    def order(self, tenants: list) -> list:
+        self.last_claim = {tenant: self.last_claim[tenant] for tenant in tenants if tenant in self.last_claim}
+        return sorted(tenants, key=lambda tenant: self.last_claim.get(tenant, 0))
+
+    def claimed(self, tenant: str):
+        self.rounds += 1
+        self.last_claim[tenant] = self.rounds
+
+async def claim_due_replies(limit: int = None, rotation: ClaimRotation = None) -> list:
+    """
+    Claim up to `limit` due jobs, round-robin across tenants: every due tenant gets an
+    equal share and the share of tenants with fewer due jobs goes to the others.
+    One tenant's backlog can't hold back the next reply of another.
+    """
+    limit = limit or settings.SCHEDULER_BATCH_SIZE
+    rotation = rotation or ClaimRotation()
+    now = time.time()
+    due = []
+    for shard in range(max(1, settings.SCHEDULER_SHARDS)):
+        tenants = await redis_client.zrangebyscore(reply_tenants_key(shard), "-inf", now, start=0, num=limit)
+        due += [(shard, tenant) for tenant in tenants or []]
+    jobs, active = [], rotation.order(due)
+    while active and len(jobs) < limit:
+        share = max(1, (limit - len(jobs)) // len(active))
+        more = []
+        for shard, tenant in active:
+            if len(jobs) >= limit:
+                break
+            claimed = await claim_tenant_replies(shard, tenant, min(share, limit - len(jobs)), now)
+            rotation.claimed((shard, tenant))
+            jobs.extend(claimed)
+            if len(claimed) == share:
+                more.append((shard, tenant))
+        active = more
+    return jobs
+
+async def ack_reply(job: dict):
+    shard = reply_shard(job)
+    await redis_client.eval(ACK_SCRIPT, 2, reply_inflight_key(shard), reply_jobs_key(shard), job["id"])
+
+async def fail_reply(job: dict, error: str):
+    """
+    Retry with exponential backoff, dead-letter after REPLY_MAX_ATTEMPTS.
+    """
+    job = dict(job)
+    job["attempts"] = job.get("attempts", 0) + 1
+    job["last_error"] = error
+    if job["attempts"] < settings.REPLY_MAX_ATTEMPTS:
+        delay = settings.REPLY_RETRY_BACKOFF * (2 ** (job["attempts"] - 1))
+        logger.warning(f"Scheduler job {job['id']} failed (attempt {job['attempts']}), retrying in {delay}s: {error}")
+        await schedule_reply(job, delay=delay)
+        await redis_client.zrem(reply_inflight_key(reply_shard(job)), job["id"])
+    else:
+        await add_dead_letter(job, error, reason="failed")
+        await ack_reply(job)
+        # Let the user trigger a fresh reply by sending the token again
+        if job.get("token") and job.get("chat_id"):
+            await release_reply_slot(job["token"], job["chat_id"])
+
+async def hand_off_reply(job: dict):
+    """
+    Give a claimed but unsent reply back to the queue, due now, without using up an attempt.
+    """
+    await schedule_reply(job, delay=0)
+    await redis_client.zrem(reply_inflight_key(reply_shard(job)), job["id"])
+
+async def renew_leases():
+    """
+    Push back the lease of every reply this worker still holds (waiting in FairSender or mid-send):
+    only the jobs of a worker that stopped renewing are seen as interrupted.
+    XX: a job acked meanwhile is not put back in the in-flight set.
+    """
+    deadline = time.time() + settings.REPLY_LEASE_SECONDS
+    leases = {}
+    for job_id, (job, _) in list(reply_tracker.jobs.items()):
+        leases.setdefault(reply_shard(job), {})[job_id] = deadline
+    for shard, shard_leases in leases.items():
+        await redis_client.zadd(reply_inflight_key(shard), shard_leases, xx=True)
+
+async def keep_leases():
+    while True:
+        await asyncio.sleep(settings.REPLY_LEASE_SECONDS / 3)
+        try:
+            await renew_leases()
+        except Exception as e:
+            logger.error(f"Scheduler lease renewal error: {e}")
+
+async def recover_interrupted_replies() -> int:
+    """
+    Dead-letter jobs whose lease expired: the worker died between claim and ack,
+    so we can't know whether the reply went out. Jobs this worker still holds are skipped
+    (their renewal may just have failed).
+    """
+    recovered = 0
+    for shard in range(max(1, settings.SCHEDULER_SHARDS)):
+        expired = await redis_client.zrangebyscore(reply_inflight_key(shard), "-inf", time.time(), start=0, num=settings.SCHEDULER_BATCH_SIZE)
+        expired = [job_id for job_id in expired or [] if job_id not in reply_tracker.jobs]
+        if not expired:
+            continue
+        raw_jobs = await redis_client.hmget(reply_jobs_key(shard), expired)
+        for job_id, raw in zip(expired, raw_jobs):
+            job = json_loads(raw) if raw else {"id": job_id}
+            job["shard"] = shard
+            await add_dead_letter(job, "worker stopped before the reply was acknowledged", reason="interrupted")
+            await ack_reply(job)
+        recovered += len(expired)
+    return recovered
+
+async def index_unindexed_replies():
+    # Replies queued before per-tenant due sets only ever lived in shard 0
+    await redis_client.eval(INDEX_QUEUE_SCRIPT, 2, reply_queue_key("-"), reply_tenants_key(0), "-")
+
+async def run_claimed_reply(handler, job: dict):
+    try:
+        try:
+            await handler(job)
+        except Exception as e:
+            await fail_reply(job, repr(e))
+        else:
+            await ack_reply(job)
+    except Exception as e:
+        logger.error(f"Scheduler bookkeeping error for job {job.get('id')}: {e}")
+    reply_tracker.finish(job["id"])
+
+async def run_reply_scheduler(handler, stop_event: asyncio.Event):
+    """
+    Worker loop: claim due jobs (round-robin across tenants) and run `handler(job)` for each.
+    At most SCHEDULER_BATCH_SIZE jobs are in flight per worker, so memory stays
+    flat no matter how many replies are waiting in Redis. Every finished job frees its
+    slot for the next claim: no batch waits for its slowest send.
+    On stop, claiming ends and the jobs in flight are awaited (drain_replies bounds the wait).
+    Leases of the claimed jobs are renewed every REPLY_LEASE_SECONDS / 3 until they finish.
+    """
+    logger.info("Reply scheduler started")
+    capacity = settings.SCHEDULER_BATCH_SIZE
+    rotation = ClaimRotation()
+    running = set()
+    last_recovery = 0.0
+    leases = asyncio.create_task(keep_leases())
+    try:
+        await index_unindexed_replies()
+    except Exception as e:
+        logger.error(f"Scheduler index error: {e}")
+    try:
+        while not stop_event.is_set():
+            free = capacity - len(running)
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = await claim_due_replies(free, rotation)
+                except Exception as e:
+                    logger.error(f"Scheduler poll error: {e}")
+            for job in jobs:
+                reply_tracker.add(job)
+                task = asyncio.create_task(run_claimed_reply(handler, job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+            if time.monotonic() - last_recovery > settings.REPLY_LEASE_SECONDS / 2:
+                last_recovery = time.monotonic()
+                try:
+                    await recover_interrupted_replies()
+                except Exception as e:
+                    logger.error(f"Scheduler recovery error: {e}")
+
+            if len(running) >= capacity:
+                # Every slot busy: claim again as soon as one frees up
+                stopping = asyncio.ensure_future(stop_event.wait())
+                await asyncio.wait(running | {stopping}, return_when=asyncio.FIRST_COMPLETED)
+                stopping.cancel()
+            elif len(jobs) < free:
+                # Nothing more due: poll again after the interval
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=settings.SCHEDULER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        if running:
+            await asyncio.wait(set(running))
+    finally:
+        # Cancelled by the shutdown drain: claimed jobs are settled by phase (see drain_replies)
+        pending = list(running)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        leases.cancel()
+        await asyncio.gather(leases, return_exceptions=True)
+    logger.info("Reply scheduler stopped")
+
+async def drain_replies(workers: list, timeout: float) -> dict:
+    """
+    Shutdown: wait up to `timeout` for the scheduler to finish its claimed replies (it must have
+    been told to stop claiming), then cancel it and settle what is left by phase:
+    - queued -> handed off to another worker
+    - sending -> dead-lettered as interrupted (may or may not have reached the user)
+    - sent -> acknowledged (billing is shielded, see main.deliver_reply)
+    """
+    completed_before = reply_tracker.completed
+    pending = set()
+    if workers:
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    report = {"drained": reply_tracker.completed - completed_before, "handed_off": 0, "abandoned": 0}
+    for job_id, (job, phase) in list(reply_tracker.jobs.items()):
+        try:
+            if phase == "queued":
+                await hand_off_reply(job)
+                report["handed_off"] += 1
+            elif phase == "sending":
+                await add_dead_letter(job, "worker shut down while the reply was being sent", reason="interrupted")
+                await ack_reply(job)
+                report["abandoned"] += 1
+            else:
+                await ack_reply(job)
+                report["drained"] += 1
+        except Exception as e:
+            # Lease expiry (recover_interrupted_replies) dead-letters it later
+            logger.error(f"Shutdown: could not settle reply {job_id} ({phase}): {e}")
+            report["abandoned"] += 1
+        reply_tracker.jobs.pop(job_id, None)
+    return report
+
+reply_tracker = ReplyTracker()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.config import settings
+    from server.models import Tenant
+    from server.log_partitions import create_tables
+    from server.billing import charge, credit, get_balance_minor, to_minor
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.config import settings
+    from server.models import Tenant
+    from server.log_partitions import create_tables
+    from server.billing import charge, credit, get_balance_minor, to_minor
+
+BENCH_API_KEY = "bench_billing_tenant"
+COST = 0.05
+
+def legacy_charge(db, tenant_id: int):
+    """Pre-ledger behaviour: ORM read-modify-write on the single tenants row."""
+    tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
+    tenant.balance -= COST
+
+def sharded_charge(db, tenant_id: int):
+    charge(db, tenant_id, to_minor(COST), reference="bench")
+
+def run(mode: str, SessionLocal, tenant_id: int, billers: int, charges: int):
+    charge_fn = legacy_charge if mode == "legacy" else sharded_charge
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_gate = threading.Barrier(billers)
+
+    def biller():
+        db = SessionLocal()
+        local = []
+        start_gate.wait()
+        try:
+            for _ in range(charges):
+                started = time.perf_counter()
+                try:
+                    charge_fn(db, tenant_id)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    with lock:
+                        errors.append(str(e))
+                local.append(time.perf_counter() - started)
+        finally:
+            db.close()
+            with lock:
+                latencies.extend(local)
+
+    threads = [threading.Thread(target=biller) for _ in range(billers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    return elapsed, p99, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Billing contention benchmark (N concurrent billers on one tenant)")
+    parser.add_argument("--billers", type=int, default=64)
+    parser.add_argument("--charges", type=int, default=50, help="Charges per biller")
+    parser.add_argument("--mode", choices=["legacy", "sharded", "both"], default="both")
+    parser.add_argument("--database-url", default=settings.DATABASE_URL)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url, pool_size=args.billers, max_overflow=0)
+    create_tables(engine) # Partitioned logs on Postgres, like init_db
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    db = SessionLocal()
+    tenant = db.query(Tenant).filter(Tenant.api_key == BENCH_API_KEY).first()
+    if not tenant:
+        tenant = Tenant(api_key=BENCH_API_KEY, name="Billing Benchmark", balance=0.0)
+        db.add(tenant)
+        db.commit()
+    tenant_id = tenant.id
+    db.close()
+
+    total = args.billers * args.charges
+    print(f"{args.billers} billers x {args.charges} charges = {total} charges on tenant {tenant_id} ({engine.dialect.name})\n")
+
+    for mode in (["legacy", "sharded"] if args.mode == "both" else [args.mode]):
+        db = SessionLocal()
+        tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
+        tenant.balance = 1000.0
+        credit(db, tenant_id, to_minor(1000.0), reference="bench_reset")
+        db.commit()
+        before_float = tenant.balance
+        before_minor = get_balance_minor(db, tenant_id)
+        db.close()
+
+        elapsed, p99, errors = run(mode, SessionLocal, tenant_id, args.billers, args.charges)
+
+        db = SessionLocal()
+        if mode == "legacy":
+            charged = round((before_float - db.query(Tenant).filter(Tenant.id == tenant_id).first().balance) / COST, 2)
+        else:
+            charged = (before_minor - get_balance_minor(db, tenant_id)) / to_minor(COST)
+        db.close()
+
+        print(f"[{mode}] {total / elapsed:,.0f} charges/s   p99 {p99 * 1000:.1f} ms   "
+              f"charges recorded in balance: {charged}/{total}   errors: {len(errors)}")
+        if errors:
+            print(f"    first error: {errors[0][:120]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import time
+import httpx
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.serve import worker_count, runtime_options
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.serve import worker_count, runtime_options
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+REQUEST_SEQUENCE = itertools.count() # Request numbers stay unique across warm-up and profiles
+
+def profiles():
+    tuned = runtime_options()
+    return {
+        # What the Dockerfile used to run
+        "baseline": {"workers": 1, "loop": "asyncio", "http": "h11", "FAST_JSON": "false"},
+        "tuned": {"workers": worker_count(), "loop": tuned["loop"], "http": tuned["http"], "FAST_JSON": "true"},
+    }
+
+def start_server(profile: dict, port: int) -> subprocess.Popen:
+    env = dict(os.environ, FAST_JSON=profile["FAST_JSON"], PYTHONPATH=PROJECT_ROOT)
+    cmd = [
+        sys.executable, "-m", "uvicorn", "server.main:app", "--port", str(port), "--log-level", "warning",
+        "--workers", str(profile["workers"]), "--loop", profile["loop"], "--http", profile["http"],
+    ]
+    return subprocess.Popen(cmd, cwd=PROJECT_ROOT, env=env)
+
+async def wait_ready(base_url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{base_url}/")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not come up")
+
+def scenario_requests(args) -> list:
+    """
+    One (label, send(client, n)) per request kind; users cycle through them.
+    read: GETs that never touch Redis. webhook / init: the hot write paths, against the server's real Redis.
+    """
+    if args.scenario == "webhook":
+        # Unique sender and message id per request: rate limit INCR, idempotency lock, session MGET
+        # (the token has no session, so no reply is scheduled and EchoB is never called)
+        def webhook(client, n):
+            return client.post("/webhook/echob", json={"event": "message", "payload": {
+                "from": f"5215{n:08d}", "body": "Mi codigo es BENCH2345", "id": f"bench-{os.getpid()}-{n}"}})
+        return [("/webhook/echob", webhook)]
+    if args.scenario == "init":
+        # Tenant lookup (cached), credit reservation and session write; every request holds VERIFICATION_COST
+        def init(client, n):
+            return client.post("/v1/init", json={"api_key": args.api_key, "app_name": "Bench", "code_challenge": "bench"})
+        return [("/v1/init", init)]
+    paths = args.paths or ["/", "/metrics/outbound"]
+    return [(path, lambda client, n, path=path: client.get(path)) for path in paths]
+
+async def load(base_url: str, requests: list, concurrency: int, duration: float):
+    latencies = []
+    errors, first_error = 0, None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        deadline = time.monotonic() + duration
+        async def user():
+            nonlocal errors, first_error
+            while time.monotonic() < deadline:
+                i = next(REQUEST_SEQUENCE)
+                label, send = requests[i % len(requests)]
+                started = time.perf_counter()
+                try:
+                    response = await send(client, i)
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    errors += 1
+                    first_error = first_error or f"{label}: {e}"
+                else:
+                    # Only successful requests count towards rate and latency
+                    latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+    return len(latencies) / elapsed, pct(0.5), pct(0.99), errors, first_error
+
+def report_errors(errors: int, first_error: str) -> bool:
+    if errors:
+        print(f"    first error: {first_error}")
+    return bool(errors)
+
+async def main():
+    parser = argparse.ArgumentParser(description="HTTP throughput / p99: baseline runtime vs tuned runtime profile")
+    parser.add_argument("--profile", choices=["baseline", "tuned", "both"], default="both")
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--scenario", choices=["read", "webhook", "init"], default="read",
+                        help="read: GET --path; webhook: POST /webhook/echob; init: POST /v1/init (webhook/init need the server's Redis up)")
+    parser.add_argument("--path", action="append", dest="paths", help="read scenario: path to hit (repeatable, default / and /metrics/outbound)")
+    parser.add_argument("--api-key", help="init scenario: API key of a tenant with balance")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load per profile")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    if args.scenario == "init" and not args.api_key:
+        parser.error("--scenario init needs --api-key")
+    requests = scenario_requests(args)
+
+    if args.url:
+        rps, p50, p99, errors, first_error = await load(args.url.rstrip("/"), requests, args.concurrency, args.duration)
+        print(f"[{args.url}] {rps:,.0f} req/s   p50 {p50:.1f} ms   p99 {p99:.1f} ms   errors {errors}")
+        if report_errors(errors, first_error):
+            sys.exit("Failed requests: the numbers above are not comparable")
+        return
+
+    print(f"{args.concurrency} concurrent clients, {args.duration:.0f}s per profile, {[label for label, _ in requests]} (load generator shares the host)\n")
+    failed = False
+    for name, profile in profiles().items():
+        if args.profile not in (name, "both"):
+            continue
+        server = start_server(profile, args.port)
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            await wait_ready(base_url)
+            await load(base_url, requests, args.concurrency, 1.0) # Warm-up
+            rps, p50, p99, errors, first_error = await load(base_url, requests, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+        print(f"[{name}] workers={profile['workers']} loop={profile['loop']} http={profile['http']} orjson={profile['FAST_JSON']}")
+        print(f"    {rps:,.0f} req/s   p50 {p50:.1f} ms   p99 {p99:.1f} ms   errors {errors}")
+        failed = report_errors(errors, first_error) or failed
+    if failed:
+        sys.exit("Failed requests: the numbers above are not comparable")
+
+if __name__ == "__main__":
+    asyncio.run(main())
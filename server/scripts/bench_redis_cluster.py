@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.config import settings
+    from server.utils import (
+        redis_client, save_verification_session, resolve_session, acquire_lock, check_rate_limit, generate_token, json_dumps
+    )
+    from server.keys import otp_key, short_link_key, credit_key
+    from server.credit import reserve_credit, settle_credit
+    from server.scheduler import schedule_reply, ack_reply, reply_shard_for
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.config import settings
+    from server.utils import (
+        redis_client, save_verification_session, resolve_session, acquire_lock, check_rate_limit, generate_token, json_dumps
+    )
+    from server.keys import otp_key, short_link_key, credit_key
+    from server.credit import reserve_credit, settle_credit
+    from server.scheduler import schedule_reply, ack_reply, reply_shard_for
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+BENCH_TENANTS = range(900001, 900065) # Credit pre-seeded below, never loaded from Postgres
+
+async def verification(n: int):
+    """
+    The Redis traffic of one verification: /v1/init, webhook, reply, /v1/verify.
+    """
+    tenant_id = BENCH_TENANTS[n % len(BENCH_TENANTS)]
+    token = await generate_token()
+    sender = f"5215{n:08d}"
+    await reserve_credit(tenant_id, token)
+    await save_verification_session(token, None, tenant_id=tenant_id)
+    await check_rate_limit(f"webhook:{sender}", limit=10**9, period=60)
+    await acquire_lock(f"bench-{token}", ttl=60)
+    await resolve_session(["BUENASTARD", token])
+    await redis_client.setex(otp_key(token), 60, "1234")
+    await redis_client.setex(short_link_key(f"b{token}"), 60, json_dumps({"token": token}))
+    job = {"id": f"bench-{token}", "tenant_id": tenant_id, "text": "x"}
+    await schedule_reply(job, delay=3600)
+    await ack_reply({**job, "shard": reply_shard_for(str(tenant_id))})
+    await settle_credit(tenant_id, token)
+    await redis_client.get(otp_key(token))
+    await redis_client.delete(otp_key(token))
+
+async def worker_main(concurrency: int, duration: float):
+    for tenant_id in BENCH_TENANTS:
+        await redis_client.set(credit_key(tenant_id), 10**15)
+    latencies, errors, first_error = [], 0, None
+    deadline = time.monotonic() + duration
+
+    async def user(n: int):
+        nonlocal errors, first_error
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                await verification(n)
+            except Exception as e:
+                errors += 1
+                first_error = first_error or f"{type(e).__name__}: {e}"
+            else:
+                # Only completed verifications count towards rate and latency
+                latencies.append(time.perf_counter() - started)
+            n += concurrency
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    nodes = len(redis_client.get_primaries()) if settings.REDIS_CLUSTER else 1
+    await redis_client.aclose()
+    print(json.dumps({"count": len(latencies), "elapsed": elapsed, "errors": errors, "first_error": first_error, "nodes": nodes,
+                      "latencies": sorted(latencies)[::max(1, len(latencies) // 2000)]}))
+
+def run_target(url: str, cluster: bool, args) -> dict:
+    env = dict(os.environ, REDIS_URL=url, REDIS_CLUSTER=str(cluster).lower(), PYTHONPATH=PROJECT_ROOT)
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--concurrency", str(args.concurrency), "--duration", str(args.duration)]
+    # One event loop per process: several processes so the client side isn't the bottleneck
+    procs = [subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, text=True) for _ in range(args.processes)]
+    outputs = [proc.communicate()[0] for proc in procs]
+    if any(proc.returncode for proc in procs):
+        sys.exit(f"Benchmark worker failed against {url} (traceback above)")
+    results = [json.loads(output.strip().splitlines()[-1]) for output in outputs]
+    latencies = sorted(l for r in results for l in r["latencies"])
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+    return {
+        "nodes": results[0]["nodes"],
+        "rate": sum(r["count"] / r["elapsed"] for r in results),
+        "p50": pct(0.5), "p99": pct(0.99),
+        "errors": sum(r["errors"] for r in results),
+        "first_error": next((r["first_error"] for r in results if r["first_error"]), None),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Verification hot path (Redis ops) throughput: single instance vs Redis Cluster")
+    parser.add_argument("--standalone", help="Single instance URL, e.g. redis://127.0.0.1:6390/0")
+    parser.add_argument("--cluster", help="Any cluster node URL, e.g. redis://127.0.0.1:7000 (see docker-compose.redis-cluster.yml)")
+    parser.add_argument("--processes", type=int, default=4, help="Client processes per target")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent verifications per process")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(worker_main(args.concurrency, args.duration))
+        return
+    if not (args.standalone or args.cluster):
+        parser.error("give --standalone and/or --cluster")
+
+    print(f"{args.processes} processes x {args.concurrency} concurrent verifications, {args.duration:.0f}s per target "
+          f"(~15 Redis commands per verification, reply scheduler on {settings.SCHEDULER_SHARDS} shard(s): "
+          f"raise SCHEDULER_SHARDS to spread it over the cluster)\n")
+    failed = False
+    for name, url, cluster in (("standalone", args.standalone, False), ("cluster", args.cluster, True)):
+        if not url:
+            continue
+        r = run_target(url, cluster, args)
+        print(f"[{name}] {url} ({r['nodes']} primary node(s))")
+        print(f"    {r['rate']:,.0f} verifications/s   p50 {r['p50']:.2f} ms   p99 {r['p99']:.2f} ms   errors {r['errors']}")
+        if r["errors"]:
+            print(f"    first error: {r['first_error']}")
+            failed = True
+    if failed:
+        sys.exit("Failed verifications: the numbers above are not comparable")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.utils import extract_token_candidates, generate_token, create_redis_client
+    from server.keys import upstream_templates_key
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.utils import extract_token_candidates, generate_token, create_redis_client
+    from server.keys import upstream_templates_key
+
+REDIS_KEY_TEMPLATES_UPSTREAM = upstream_templates_key("es_mx")
+
+# Used when the upstream pool is empty (same shapes as generate_templates mock mode)
+FALLBACK_UPSTREAM = [
+    "Hola, mi código es {token}",
+    "Aquí está el código: {token}",
+    "Verifícame con {token}",
+    "{token}",
+    "Ya tengo el código {token}, gracias",
+]
+
+# Uppercase words users add before the token (token-shaped false candidates)
+NOISE_PREFIXES = ["", "", "BUENAS TARDES ", "URGENTE ", "HOLA BUENAS ", "PRUEBA "]
+
+def legacy_extract(body: str):
+    """Pre-optimisation behaviour: inline pattern, first match only."""
+    match = re.search(r"\b([A-HJ-KMNP-Z2-9]{6,10})\b", body, re.IGNORECASE)
+    return match.group(1).upper() if match else None
+
+async def load_corpus(size: int) -> list:
+    """
+    Build messages from the upstream templates, swapping each template's token
+    for a fresh one (the upstream templates embed the token they were generated with).
+    """
+    redis_client = create_redis_client()
+    try:
+        upstream = await redis_client.lrange(REDIS_KEY_TEMPLATES_UPSTREAM, 0, -1)
+    except Exception as e:
+        print(f"Redis unavailable ({e}), using fallback corpus")
+        upstream = []
+    finally:
+        await redis_client.aclose()
+
+    shapes = []
+    for message in upstream:
+        candidates = extract_token_candidates(message)
+        if candidates:
+            shapes.append(message.replace(candidates[-1], "{token}"))
+    if not shapes:
+        shapes = FALLBACK_UPSTREAM
+    print(f"Corpus: {len(shapes)} upstream shapes ({'redis' if upstream else 'fallback'})")
+
+    corpus = []
+    for _ in range(size):
+        token = await generate_token()
+        body = random.choice(NOISE_PREFIXES) + random.choice(shapes).replace("{token}", token)
+        corpus.append((body, token))
+    return corpus
+
+def bench(name: str, fn, corpus: list, rounds: int):
+    hits = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for body, token in corpus:
+            if fn(body, token):
+                hits += 1
+    elapsed = time.perf_counter() - started
+    total = len(corpus) * rounds
+    print(f"{name:<28} {total / elapsed:>12,.0f} msgs/s   {elapsed / total * 1e6:6.2f} µs/msg   token found: {hits / total:6.1%}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Token extraction micro-benchmark")
+    parser.add_argument("--size", type=int, default=10000, help="Messages in the corpus")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = await load_corpus(args.size)
+    bench("legacy (first match)", lambda body, token: legacy_extract(body) == token, corpus, args.rounds)
+    # All candidates; the real token is found by the MGET in resolve_session
+    bench("compiled (all candidates)", lambda body, token: token in extract_token_candidates(body), corpus, args.rounds)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,66 +1,51 @@
+import argparse
 import asyncio
 import sys
 import os
-import redis.asyncio as redis
 
 # Allow importing from server package
 sys.path.append("/app")
 
 try:
     from server.config import settings
-    from server.database import SessionLocal
-    from server.models import Template
+    from server.utils import create_redis_client
+    from server.template_store import clear_templates, GENERATED_SOURCES
 except ImportError:
     # Fallback for local run
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
     from server.config import settings
-    from server.database import SessionLocal
-    from server.models import Template
+    from server.utils import create_redis_client
+    from server.template_store import clear_templates, GENERATED_SOURCES
 
-REDIS_KEY_TEMPLATES = "templates:es_mx"
+async def main():
+    parser = argparse.ArgumentParser(description="Clear templates from Redis and Postgres (batched, non-blocking)")
+    parser.add_argument("--language", default="es_mx")
+    parser.add_argument("--source", action="append", dest="sources",
+                        help=f"Only this source (repeatable). Default: generated ones ({', '.join(GENERATED_SOURCES)})")
+    parser.add_argument("--all", action="store_true", help="Every source of the language, incl. manual (UNLINKs the Redis keys)")
+    parser.add_argument("--older-than", type=float, metavar="DAYS", help="Only templates created more than DAYS ago")
+    parser.add_argument("--dry-run", action="store_true", help="Report counts without deleting anything")
+    args = parser.parse_args()
 
-async def clear_templates():
+    sources = None if args.all else (args.sources or list(GENERATED_SOURCES))
     print(f"Connecting to Redis at {settings.REDIS_URL}...")
-    redis_client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
-    
+    redis_client = create_redis_client()
+
     try:
-        # 1. Clear Redis
-        count = await redis_client.scard(REDIS_KEY_TEMPLATES)
-        if count == 0:
-            print(f"[Redis] No templates found in '{REDIS_KEY_TEMPLATES}'.")
+        scope = "all sources" if sources is None else ", ".join(sources)
+        age = f", older than {args.older_than} days" if args.older_than is not None else ""
+        print(f"Clearing {args.language} templates ({scope}{age}){' [dry run]' if args.dry_run else ''}...")
+        report = await clear_templates(redis_client, args.language, sources, args.older_than, dry_run=args.dry_run)
+
+        if args.dry_run:
+            print(f"[Dry run] {report['matched']} template rows match"
+                  + (f", {report['redis_removed']} Redis entries would be UNLINKed" if sources is None and args.older_than is None else ""))
         else:
-            print(f"[Redis] Found {count} templates. Deleting...")
-            await redis_client.delete(REDIS_KEY_TEMPLATES)
-            print(f"[Redis] Successfully deleted key: {REDIS_KEY_TEMPLATES}")
-            
-        # 2. Clear Postgres
-        print("[DB] Clearing 'templates' table in Postgres...")
-        # Using sync session in async context requires run_in_executor
-        loop = asyncio.get_event_loop()
-        deleted_count = await loop.run_in_executor(None, clear_db_templates)
-        print(f"[DB] Deleted {deleted_count} rows from 'templates' table.")
-            
+            print(f"Done. Deleted {report['deleted']} rows from 'templates', removed {report['redis_removed']} Redis entries.")
     except Exception as e:
         print(f"Error: {e}")
     finally:
         await redis_client.aclose()
 
-def clear_db_templates():
-    try:
-        db = SessionLocal()
-        # Delete all records from Template table
-        # If we only want to delete generated ones: .filter(Template.source == "ai_generated")
-        # But user said "clear history", implying all. Let's stick to "es_mx" + "ai_generated" to be safe or just all.
-        # Looking at generate_templates.py: new_template = Template(content=content, language="es_mx", source="ai_generated")
-        
-        deleted = db.query(Template).filter(Template.language == "es_mx", Template.source == "ai_generated").delete()
-        db.commit()
-        return deleted
-    except Exception as e:
-        print(f"DB Error: {e}")
-        return 0
-    finally:
-        db.close()
-
 if __name__ == "__main__":
-    asyncio.run(clear_templates())
+    asyncio.run(main())
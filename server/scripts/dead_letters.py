@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.dead_letter import count_dead_letters, list_dead_letters, get_dead_letter, remove_dead_letter
+    from server.scheduler import schedule_reply
+    from server.utils import redis_client
+    from server.keys import session_key
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.dead_letter import count_dead_letters, list_dead_letters, get_dead_letter, remove_dead_letter
+    from server.scheduler import schedule_reply
+    from server.utils import redis_client
+    from server.keys import session_key
+
+PAGE_SIZE = 100
+
+def format_entry(entry: dict) -> str:
+    failed_at = datetime.fromtimestamp(entry.get("failed_at", 0)).strftime("%Y-%m-%d %H:%M:%S")
+    return (
+        f"{entry.get('id')}  {failed_at}  token={entry.get('token')}  sender={entry.get('sender')}  "
+        f"tenant={entry.get('tenant_id')}  attempts={entry.get('attempts')}  "
+        f"{entry.get('reason')}: {str(entry.get('last_error'))[:60]}"
+    )
+
+async def cmd_list(args):
+    total = await count_dead_letters()
+    print(f"[DLQ] {total} dead-lettered replies")
+    for entry in await list_dead_letters(args.offset, args.limit):
+        print(format_entry(entry))
+
+async def cmd_inspect(args):
+    entry = await get_dead_letter(args.id)
+    if not entry:
+        print(f"[DLQ] Entry {args.id} not found")
+        return
+    ttl = await redis_client.ttl(session_key(entry.get("token")))
+    print(json.dumps(entry, indent=2, ensure_ascii=False))
+    print(f"Session TTL: {ttl if ttl and ttl > 0 else 'expired'}")
+
+async def replay_entry(entry: dict, dry_run: bool) -> str:
+    """
+    Re-schedule a dead-lettered reply. Entries whose session already expired are skipped
+    (the user can no longer complete verification with that OTP / link).
+    """
+    ttl = await redis_client.ttl(session_key(entry.get("token")))
+    if not ttl or ttl <= 0:
+        return "expired"
+    if dry_run:
+        return "would_replay"
+
+    job = dict(entry["job"])
+    job["attempts"] = 0
+    job.pop("last_error", None)
+    await schedule_reply(job, delay=0)
+    await remove_dead_letter(entry["id"])
+    return "replayed"
+
+async def cmd_replay(args):
+    if args.id:
+        entries = [e for e in [await get_dead_letter(i) for i in args.id] if e]
+    else:
+        entries = []
+        offset = 0
+        while True:
+            page = await list_dead_letters(offset, PAGE_SIZE)
+            entries += page
+            if len(page) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+
+    counts = {"replayed": 0, "would_replay": 0, "expired": 0}
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    for entry in entries:
+        started = time.monotonic()
+        result = await replay_entry(entry, args.dry_run)
+        counts[result] += 1
+        print(f"[{result}] {format_entry(entry)}")
+        if result == "expired" and args.purge_expired and not args.dry_run:
+            await remove_dead_letter(entry["id"])
+        # Rate limiting (only replays cost outbound capacity)
+        if result == "replayed" and interval:
+            await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+
+    print(f"\nDone! {counts}")
+
+async def cmd_purge(args):
+    for entry_id in args.id:
+        await remove_dead_letter(entry_id)
+        print(f"[DLQ] Removed {entry_id}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Inspect and replay dead-lettered replies")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_list = sub.add_parser("list", help="List dead-lettered replies (oldest first)")
+    p_list.add_argument("--offset", type=int, default=0)
+    p_list.add_argument("--limit", type=int, default=50)
+    p_list.set_defaults(func=cmd_list)
+
+    p_inspect = sub.add_parser("inspect", help="Show the full context of one entry")
+    p_inspect.add_argument("id")
+    p_inspect.set_defaults(func=cmd_inspect)
+
+    p_replay = sub.add_parser("replay", help="Re-schedule entries (all, or the given ids)")
+    p_replay.add_argument("id", nargs="*")
+    p_replay.add_argument("--rate", type=float, default=5.0, help="Max replays per second (0 = unlimited)")
+    p_replay.add_argument("--dry-run", action="store_true", help="Only report what would be replayed")
+    p_replay.add_argument("--purge-expired", action="store_true", help="Remove entries whose session expired")
+    p_replay.set_defaults(func=cmd_replay)
+
+    p_purge = sub.add_parser("purge", help="Remove entries without replaying")
+    p_purge.add_argument("id", nargs="+")
+    p_purge.set_defaults(func=cmd_purge)
+    return parser
+
+async def main():
+    args = build_parser().parse_args()
+    try:
+        await args.func(args)
+    finally:
+        await redis_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,33 +1,39 @@
+import argparse
 import asyncio
 import httpx
-import redis.asyncio as redis
+import json
 import sys
 import os
 import random
-import string
+import time
 
 # Allow importing from server package
 sys.path.append("/app")
 
 try:
     from server.config import settings
-    from server.database import SessionLocal, engine
-    from server.models import Base, Template
-    from server.utils import generate_token
+    from server.database import engine
+    from server.models import Template
+    from server.log_partitions import create_tables
+    from server.utils import generate_token, create_redis_client
+    from server.keys import templates_key, upstream_templates_key
+    from server.template_store import ingest_templates, load_near_duplicate_index, UPSTREAM_SOURCES
 except ImportError:
     # Fallback for local run
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
     from server.config import settings
-    from server.database import SessionLocal, engine
-    from server.models import Base, Template
-    from server.utils import generate_token
+    from server.database import engine
+    from server.models import Template
+    from server.log_partitions import create_tables
+    from server.utils import generate_token, create_redis_client
+    from server.keys import templates_key, upstream_templates_key
+    from server.template_store import ingest_templates, load_near_duplicate_index, UPSTREAM_SOURCES
 
-# Ensure tables exist (for standalone script run)
-Base.metadata.create_all(bind=engine)
-
-REDIS_KEY_TEMPLATES_DOWNSTREAM = "templates:es_mx"
-REDIS_KEY_TEMPLATES_UPSTREAM = "templates:es_mx:upstream"
+REDIS_KEY_TEMPLATES_DOWNSTREAM = templates_key("es_mx")
+REDIS_KEY_TEMPLATES_UPSTREAM = upstream_templates_key("es_mx")
 TARGET_COUNT = 20
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".generate_templates.checkpoint.json")
+MOCK_MODE = settings.NVIDIA_API_KEY.startswith("mock-")
 
 # --- Prompt Loading ---
 def load_prompt(filename):
@@ -43,34 +49,108 @@ def load_prompt(filename):
 PROMPT_REPLY = load_prompt("prompts_reply.md")
 PROMPT_TOKEN = load_prompt("prompts_random_token.md")
 
-# --- Helper Functions ---
-def save_to_db_sync(content: str, source_type: str):
+# --- Rate Limiting & Checkpoint ---
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float = None):
+        super().__init__("429 Too Many Requests")
+        self.retry_after = retry_after
+
+class AdaptiveLimiter:
     """
-    source_type: 'ai_reply' (Downstream) or 'ai_request' (Upstream)
+    AIMD concurrency limit for the LLM API.
+    - Each success grows the limit by ~1 per window of in-flight requests (up to max)
+    - A 429 halves it and pauses new requests for Retry-After
     """
-    try:
-        db = SessionLocal()
-        # Check for duplicates
-        exists = db.query(Template).filter(Template.content == content).first()
-        if not exists:
-            new_template = Template(content=content, language="es_mx", source=source_type)
-            db.add(new_template)
-            db.commit()
-            return True
-        return False
-    except Exception as e:
-        print(f"DB Error: {e}")
-        return False
-    finally:
-        db.close()
+    def __init__(self, max_concurrency: int):
+        self.max = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.in_flight >= int(self.limit):
+                await self._cond.wait()
+            self.in_flight += 1
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, ok: bool = False, throttled: bool = False, retry_after: float = 0.0):
+        async with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            elif ok:
+                self.limit = min(float(self.max), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+class Checkpoint:
+    """
+    Indices already generated & ingested, per kind; saved atomically after every ingest batch
+    so an interrupted run resumes where it stopped.
+    """
+    def __init__(self, path: str, fresh: bool = False):
+        self.path = path
+        self.done = {}
+        if not fresh and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.done = {kind: set(indices) for kind, indices in json.load(f).items()}
+
+    def completed(self, kind: str) -> set:
+        return self.done.setdefault(kind, set())
+
+    def mark(self, kind: str, indices):
+        self.completed(kind).update(indices)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({k: sorted(v) for k, v in self.done.items()}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 # --- Generators ---
 
-async def generate_downstream_reply(client: httpx.AsyncClient, index: int):
+async def chat_completion(client: httpx.AsyncClient, system_prompt: str, user_instruction: str, timeout: float, **params):
+    response = await client.post(
+        f"{settings.NVIDIA_BASE_URL}/chat/completions",
+        headers={
+            "Authorization": f"Bearer {settings.NVIDIA_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": settings.NVIDIA_MODEL,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_instruction}
+            ],
+            **params
+        },
+        timeout=timeout
+    )
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After")
+        raise RateLimited(float(retry_after) if retry_after and retry_after.isdigit() else None)
+    response.raise_for_status()
+    data = response.json()
+    return data["choices"][0]["message"]["content"].strip()
+
+async def mock_call(args):
+    """Local stand-in for the API: configurable latency and 429 rate (for benchmarking the pipeline)."""
+    if args.mock_latency:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * args.mock_latency)
+    if random.random() < args.mock_429_rate:
+        raise RateLimited(1.0)
+
+async def generate_downstream_reply(client: httpx.AsyncClient, index: int, args):
     """Downstream Factory: System Reply"""
     # Mock Mode Support
-    if settings.NVIDIA_API_KEY.startswith("mock-"):
-        import random
+    if MOCK_MODE:
+        await mock_call(args)
         templates = [
             "Hola, tu código {app_name} es {otp}. Entra aquí: {link}",
             "Verificación {app_name}: usa {otp} para entrar. Link: {link}",
@@ -81,40 +161,15 @@ async def generate_downstream_reply(client: httpx.AsyncClient, index: int):
         return random.choice(templates)
 
     user_instruction = f"Generate variation #{index}. Make this one {'very short' if index%2==0 else 'friendly'}. Use {'Mexican' if index%3==0 else 'Colombian'} slang."
-    
-    try:
-        response = await client.post(
-            f"{settings.NVIDIA_BASE_URL}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {settings.NVIDIA_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": settings.NVIDIA_MODEL,
-                "messages": [
-                    {"role": "system", "content": PROMPT_REPLY},
-                    {"role": "user", "content": user_instruction}
-                ],
-                "temperature": 0.95,
-                "top_p": 0.9,
-                "max_tokens": 60
-            },
-            timeout=10.0
-        )
-        response.raise_for_status()
-        data = response.json()
-        content = data["choices"][0]["message"]["content"].strip()
-        return content
-    except Exception as e:
-        print(f"Downstream Gen Error: {e}")
-        return None
+    return await chat_completion(client, PROMPT_REPLY, user_instruction, args.timeout, temperature=0.95, top_p=0.9, max_tokens=60)
 
-async def generate_upstream_request(client: httpx.AsyncClient, index: int):
+async def generate_upstream_request(client: httpx.AsyncClient, index: int, args):
     """Upstream Factory: User Request"""
     token = await generate_token()
-    
+
     # Mock Mode Support
-    if settings.NVIDIA_API_KEY.startswith("mock-"):
+    if MOCK_MODE:
+        await mock_call(args)
         templates = [
             f"Hola, mi código es {token}",
             f"Aquí está el código: {token}",
@@ -125,41 +180,132 @@ async def generate_upstream_request(client: httpx.AsyncClient, index: int):
         return random.choice(templates)
 
     user_instruction = f"Generate variation #{index}. The token is {token}."
-    
-    try:
-        response = await client.post(
-            f"{settings.NVIDIA_BASE_URL}/chat/completions",
-            headers={
-                "Authorization": f"Bearer {settings.NVIDIA_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": settings.NVIDIA_MODEL,
-                "messages": [
-                    {"role": "system", "content": PROMPT_TOKEN},
-                    {"role": "user", "content": user_instruction}
-                ],
-                "temperature": 0.9,
-                "max_tokens": 40
-            },
-            timeout=10.0
-        )
-        response.raise_for_status()
-        data = response.json()
-        content = data["choices"][0]["message"]["content"].strip()
-        # Ensure token is preserved exactly (LLM might mess it up slightly, though unlikely with instructions)
-        if token not in content:
-            # Fallback if token lost: just append it
-            content = f"{content} {token}"
+    content = await chat_completion(client, PROMPT_TOKEN, user_instruction, args.timeout, temperature=0.9, max_tokens=40)
+    # Ensure token is preserved exactly (LLM might mess it up slightly, though unlikely with instructions)
+    if token not in content:
+        # Fallback if token lost: just append it
+        content = f"{content} {token}"
+    return content
+
+GENERATORS = {
+    "downstream": (generate_downstream_reply, "ai_reply"),
+    "upstream": (generate_upstream_request, "ai_request"),
+}
+
+# --- Pipeline ---
+
+async def generate_with_retries(client, limiter: AdaptiveLimiter, kind: str, index: int, args, stats: dict):
+    generate, _ = GENERATORS[kind]
+    for attempt in range(args.max_retries + 1):
+        backoff = min(30.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+        await limiter.acquire()
+        try:
+            content = await generate(client, index, args)
+        except RateLimited as e:
+            stats["throttled"] += 1
+            await limiter.release(throttled=True, retry_after=e.retry_after or backoff)
+            continue
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            await limiter.release()
+            if attempt == args.max_retries:
+                print(f"❌ [{kind}] #{index} failed after {attempt + 1} attempts: {e}")
+                break
+            await asyncio.sleep(backoff)
+            continue
+        await limiter.release(ok=True)
         return content
-    except Exception as e:
-        print(f"Upstream Gen Error: {e}")
-        return None
+    stats["failed"] += 1
+    return None
+
+async def run_pipeline(kind: str, redis_client, client, limiter: AdaptiveLimiter, checkpoint: Checkpoint, args, stats: dict):
+    """
+    `args.concurrency` workers pull indices not yet in the checkpoint; results stream through a
+    queue into batched ingest (one INSERT ... ON CONFLICT + one Redis pipeline per batch).
+    """
+    _, source = GENERATORS[kind]
+    near_dups = await asyncio.get_running_loop().run_in_executor(
+        None, load_near_duplicate_index, "es_mx", source in UPSTREAM_SOURCES, args.similarity
+    )
+    print(f"Near-duplicate index: {len(near_dups)} existing {kind} template(s), threshold {near_dups.threshold}")
+    pending = iter([i for i in range(args.count) if i not in checkpoint.completed(kind)])
+    queue = asyncio.Queue(maxsize=args.batch_size * 4)
+
+    async def worker():
+        for index in pending:
+            content = await generate_with_retries(client, limiter, kind, index, args, stats)
+            await queue.put((index, content))
+
+    async def writer():
+        done = False
+        while not done:
+            batch = []
+            deadline = time.monotonic() + 1.0
+            while len(batch) < args.batch_size:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+            results = []
+            for index, content in batch:
+                if not content:
+                    continue
+                stats["generated"] += 1
+                # Reworded copies of an existing template add no diversity
+                if near_dups.check_and_add(f"{kind}:{index}", content):
+                    stats["near_duplicates"] += 1
+                    continue
+                results.append((content, source))
+            saved = await ingest_templates(redis_client, results)
+            stats["saved"] += len(saved)
+            # Failed indices stay out of the checkpoint so a rerun retries them
+            checkpoint.mark(kind, [index for index, content in batch if content])
+            print(f"✅ [{kind}] +{len(saved)} new ({len(batch) - len(saved)} duplicate/failed) | limit {limiter.limit:.1f}")
+
+    writer_task = asyncio.create_task(writer())
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    workers = asyncio.gather(*worker_tasks)
+    try:
+        # The writer only returns after the sentinel: finishing first means it failed, and
+        # nothing drains the queue anymore (workers would block on put() forever)
+        await asyncio.wait({writer_task, workers}, return_when=asyncio.FIRST_COMPLETED)
+        if writer_task.done():
+            writer_task.result()
+        workers.result()
+        await queue.put(None)
+        await writer_task
+    finally:
+        for task in (writer_task, *worker_tasks):
+            task.cancel()
+        await asyncio.gather(writer_task, workers, return_exceptions=True)
 
 async def main():
-    print("🚀 Starting Template Factory...")
+    parser = argparse.ArgumentParser(description="Generate reply / request templates with an LLM (resumable)")
+    parser.add_argument("--count", type=int, default=TARGET_COUNT, help="Variations per kind")
+    parser.add_argument("--kind", choices=["downstream", "upstream", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max concurrent API calls (AIMD adapts below it)")
+    parser.add_argument("--max-retries", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout in seconds")
+    parser.add_argument("--batch-size", type=int, default=50, help="Results per ingest batch")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--fresh", action="store_true", help="Ignore an existing checkpoint")
+    parser.add_argument("--similarity", type=float, default=settings.TEMPLATE_SIMILARITY_THRESHOLD,
+                        help="Near-duplicate threshold (estimated Jaccard of normalised text)")
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="Mock mode: mean simulated API latency (s)")
+    parser.add_argument("--mock-429-rate", type=float, default=0.0, help="Mock mode: share of calls answered with 429")
+    args = parser.parse_args()
+
+    # Ensure tables exist (for standalone script run)
+    create_tables(engine, [Template.__table__])
+
+    print("🚀 Starting Template Factory..." + (" (mock mode)" if MOCK_MODE else ""))
     print(f"Connecting to Redis at {settings.REDIS_URL}...")
-    redis_client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+    redis_client = create_redis_client()
 
     try:
         # Check if the key exists and if it is of the correct type (Set)
@@ -174,56 +320,34 @@ async def main():
              print(f"Self-healing: Deleting incorrect key type...")
              await redis_client.delete(REDIS_KEY_TEMPLATES_DOWNSTREAM)
 
-        async with httpx.AsyncClient() as client:
-            # 1. Generate Downstream (Replies)
-            print("\n--- Generating Downstream Replies (System -> User) ---")
-            count_down = 0
-            tasks = [generate_downstream_reply(client, i) for i in range(TARGET_COUNT)]
-            results = await asyncio.gather(*tasks)
-
-            for content in results:
-                if content:
-                    # Save to Redis (Set)
-                    # SADD returns 1 if added, 0 if duplicate
-                    if await redis_client.sadd(REDIS_KEY_TEMPLATES_DOWNSTREAM, content):
-                        # Save to DB
-                        if save_to_db_sync(content, "ai_reply"):
-                            print(f"✅ [Downstream] Saved: {content[:30]}...")
-                            count_down += 1
-                        else:
-                            print(f"⚠️ [Downstream] DB Duplicate")
-                    else:
-                         print(f"⚠️ [Downstream] Redis Duplicate")
-
-            # 2. Generate Upstream (Requests)
-            # Upstream templates (User messages) can probably stay as a list or also become a set
-            # Let's keep them as list for now or convert to set if uniqueness is desired
-            # But the error was specifically about WRONGTYPE on rpush vs set
-            # Assuming upstream logic uses RPUSH, let's check its key type too
-            
-            key_type_up = await redis_client.type(REDIS_KEY_TEMPLATES_UPSTREAM)
-            if key_type_up == "set": # If we want list but it is set
-                 print(f"Warning: Key {REDIS_KEY_TEMPLATES_UPSTREAM} is a Set. Deleting it to create a List.")
-                 await redis_client.delete(REDIS_KEY_TEMPLATES_UPSTREAM)
-
-            print("\n--- Generating Upstream Requests (User -> System) ---")
-            count_up = 0
-            tasks_up = [generate_upstream_request(client, i) for i in range(TARGET_COUNT)]
-            results_up = await asyncio.gather(*tasks_up)
-            
-            for content in results_up:
-                if content:
-                    # Save to Redis (List)
-                    await redis_client.rpush(REDIS_KEY_TEMPLATES_UPSTREAM, content)
-                    # Save to DB
-                    if save_to_db_sync(content, "ai_request"):
-                        print(f"✅ [Upstream] Saved: {content[:30]}...")
-                        count_up += 1
-                    else:
-                        print(f"⚠️ [Upstream] Duplicate/Error")
-
-        print(f"\n🎉 Done! Downstream: {count_down}, Upstream: {count_up}")
-    
+        # Upstream templates (user messages) are a List (RPUSH)
+        key_type_up = await redis_client.type(REDIS_KEY_TEMPLATES_UPSTREAM)
+        if key_type_up == "set": # If we want list but it is set
+             print(f"Warning: Key {REDIS_KEY_TEMPLATES_UPSTREAM} is a Set. Deleting it to create a List.")
+             await redis_client.delete(REDIS_KEY_TEMPLATES_UPSTREAM)
+
+        checkpoint = Checkpoint(args.checkpoint, fresh=args.fresh)
+        limiter = AdaptiveLimiter(args.concurrency)
+        kinds = ["downstream", "upstream"] if args.kind == "both" else [args.kind]
+        stats = {"generated": 0, "saved": 0, "near_duplicates": 0, "failed": 0, "throttled": 0}
+        started = time.perf_counter()
+
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            for kind in kinds:
+                resumed = len(checkpoint.completed(kind))
+                print(f"\n--- Generating {kind} ({args.count} variations, {resumed} already done) ---")
+                await run_pipeline(kind, redis_client, client, limiter, checkpoint, args, stats)
+
+        elapsed = time.perf_counter() - started
+        print(
+            f"\n🎉 Done in {elapsed:.1f}s ({stats['generated'] / elapsed:.1f}/s): generated {stats['generated']}, "
+            f"new {stats['saved']}, near-duplicates {stats['near_duplicates']}, failed {stats['failed']}, 429s {stats['throttled']}"
+        )
+        if not stats["failed"]:
+            checkpoint.clear()
+        else:
+            print(f"Checkpoint kept at {args.checkpoint}; rerun to retry the failed variations.")
+
     finally:
         await redis_client.aclose()
 
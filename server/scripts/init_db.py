@@ -6,8 +6,10 @@ from sqlalchemy.exc import OperationalError
 # Since we run this as `python -m server.scripts.init_db` with PYTHONPATH=/app,
 # we can import directly from the server package.
 from server.database import engine, SessionLocal
-from server.models import Base, Tenant
+from server.models import Tenant
 from server.utils import generate_token
+from server.billing import credit, to_minor, migrate_legacy_balances
+from server.log_partitions import setup_log_partitions, create_tables
 
 def wait_for_db():
     retries = 30
@@ -28,8 +30,12 @@ def init_db():
         print("Could not connect to database. Exiting.")
         sys.exit(1)
 
+    # Partitioned logs first (converts a legacy single table); create_all then skips it
+    if setup_log_partitions(engine):
+        print("Logs partitions ready.")
+
     print("Creating tables...")
-    Base.metadata.create_all(bind=engine)
+    create_tables(engine)
     print("Tables created.")
     
     # Create initial tenant if not exists
@@ -46,13 +52,20 @@ def init_db():
             tenant = Tenant(
                 api_key=default_api_key,
                 name="Default Tenant",
-                balance=100.0
+                balance=0.0
             )
             db.add(tenant)
+            db.flush()
+            credit(db, tenant.id, to_minor(100.0), reference="initial_credit")
             db.commit()
             print(f"Default tenant created. API Key: {default_api_key}")
         else:
             print("Tenant already exists. Skipping creation.")
+
+        # Move legacy float balances into the sharded ledger (idempotent)
+        migrated = migrate_legacy_balances(db)
+        if migrated:
+            print(f"Migrated legacy balance of {migrated} tenant(s) into balance shards.")
             
     except Exception as e:
         print(f"Error initializing data: {e}")
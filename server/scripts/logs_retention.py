@@ -0,0 +1,45 @@
+import argparse
+import os
+import sys
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.config import settings
+    from server.database import engine
+    from server.log_partitions import setup_log_partitions, archive_log_partitions
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.config import settings
+    from server.database import engine
+    from server.log_partitions import setup_log_partitions, archive_log_partitions
+
+def main():
+    """
+    Daily maintenance for the partitioned logs table (run from cron):
+    - creates the partitions for the next LOG_PARTITIONS_AHEAD months
+    - detaches partitions older than LOG_RETENTION_MONTHS, exports them to gzipped CSV, drops them
+    """
+    parser = argparse.ArgumentParser(description="Logs partition maintenance, retention & archival")
+    parser.add_argument("--retention-months", type=int, default=settings.LOG_RETENTION_MONTHS)
+    parser.add_argument("--archive-dir", default=settings.LOG_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="Only list partitions that would be archived")
+    args = parser.parse_args()
+
+    if engine.dialect.name != "postgresql":
+        print(f"Logs partitioning needs PostgreSQL (got {engine.dialect.name}). Nothing to do.")
+        return
+
+    if not args.dry_run:
+        # Also converts a legacy single table and creates the upcoming months
+        setup_log_partitions(engine)
+        print(f"Partitions ready through {settings.LOG_PARTITIONS_AHEAD} month(s) ahead.")
+
+    archived = archive_log_partitions(engine, args.retention_months, args.archive_dir, dry_run=args.dry_run)
+    verb = "Would archive" if args.dry_run else "Archived"
+    print(f"{verb} {len(archived)} partition(s) to {args.archive_dir}: {', '.join(archived) or '-'}")
+
+if __name__ == "__main__":
+    main()
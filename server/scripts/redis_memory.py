@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.config import settings
+    from server.utils import create_redis_client, LOCK_TTL
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.config import settings
+    from server.utils import create_redis_client, LOCK_TTL
+
+# (upper bound in seconds, label) for the TTL distribution
+TTL_BUCKETS = ((60, "<1m"), (600, "<10m"), (3600, "<1h"), (86400, "<1d"), (math.inf, ">=1d"))
+
+def expected_ttls() -> dict:
+    """
+    Namespaces whose keys are always written with a TTL -> the TTL to repair them with.
+    Everything else (templates, credit, scheduler, dlq, domains:stats, ...) is persistent by design.
+    """
+    return {
+        "session": settings.SESSION_TTL,
+        "otp": settings.OTP_TTL,
+        "short": settings.SHORT_LINK_TTL,
+        "reply": settings.REPLY_COALESCE_WINDOW,
+        "lock": LOCK_TTL, # SETNX + EXPIRE in acquire_lock
+        "ratelimit": max(settings.RATE_LIMIT_INIT_PERIOD, settings.RATE_LIMIT_WEBHOOK_PERIOD), # INCR + EXPIRE
+        "bot": settings.BOT_HEALTH_WINDOW * 2, # INCR + EXPIRE of the health window counters
+    }
+
+def key_prefix(key: str, depth: int = 1) -> str:
+    parts = key.split(":")
+    return ":".join(parts[:depth]) if len(parts) > 1 else "(no prefix)"
+
+def ttl_bucket(pttl: int) -> str:
+    if pttl < 0:
+        return "none"
+    return next(label for bound, label in TTL_BUCKETS if pttl / 1000 < bound)
+
+class PrefixStats:
+    def __init__(self, prefix: str, expected_ttl=None):
+        self.prefix = prefix
+        self.expected_ttl = expected_ttl
+        self.keys = 0
+        self.no_ttl = 0
+        self.fixed = 0
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.largest = (None, 0)
+        self.ttls = dict.fromkeys([label for _, label in TTL_BUCKETS] + ["none"], 0)
+
+    @property
+    def est_bytes(self) -> int:
+        # Mean of the sampled MEMORY USAGE, extrapolated to every key counted
+        return int(self.sampled_bytes / self.sampled * self.keys) if self.sampled else 0
+
+    def to_dict(self) -> dict:
+        return {
+            "prefix": self.prefix,
+            "keys": self.keys,
+            "est_bytes": self.est_bytes,
+            "avg_bytes": int(self.sampled_bytes / self.sampled) if self.sampled else 0,
+            "sampled": self.sampled,
+            "no_ttl": self.no_ttl,
+            "expected_ttl": self.expected_ttl,
+            "fixed": self.fixed,
+            "ttls": self.ttls,
+            "largest": {"key": self.largest[0], "bytes": self.largest[1]},
+        }
+
+class KeyspaceReport:
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.expected = expected_ttls()
+        self.prefixes = {}
+        self.scanned = 0
+        self.vanished = 0 # Expired / deleted between SCAN and PTTL
+        self.used_memory = None
+
+    def stats(self, key: str) -> PrefixStats:
+        prefix = key_prefix(key, self.depth)
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = PrefixStats(prefix, self.expected.get(key_prefix(key)))
+        return self.prefixes[prefix]
+
+    def to_dict(self) -> dict:
+        prefixes = sorted(self.prefixes.values(), key=lambda s: (s.est_bytes, s.keys), reverse=True)
+        return {
+            "scanned": self.scanned,
+            "vanished": self.vanished,
+            "used_memory": self.used_memory,
+            "est_bytes": sum(s.est_bytes for s in prefixes),
+            "prefixes": [s.to_dict() for s in prefixes],
+        }
+
+async def scan_batch(client, node, cursor: int, args):
+    if node is None:
+        return await client.scan(cursor, match=args.match, count=args.count)
+    # Cluster: SCAN one primary at a time, the reply is keyed by node name
+    cursors, keys = await client.scan(cursor, match=args.match, count=args.count, target_nodes=node)
+    return cursors[node.name], keys
+
+async def measure(client, keys: list, args, report: KeyspaceReport, rng: random.Random):
+    """
+    PTTL of every key, MEMORY USAGE of a sample, one pipeline (no MULTI) per SCAN batch.
+    The first key seen of each prefix is always sampled so small namespaces get a size too.
+    """
+    sampled, seen = [], set(report.prefixes)
+    for key in keys:
+        prefix = key_prefix(key, report.depth)
+        if prefix not in seen or rng.random() < args.sample:
+            sampled.append(key)
+            seen.add(prefix)
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.pttl(key)
+    for key in sampled:
+        pipe.memory_usage(key, samples=args.memory_samples)
+    results = await pipe.execute()
+    pttls, sizes = results[:len(keys)], dict(zip(sampled, results[len(keys):]))
+
+    repair = []
+    for key, pttl in zip(keys, pttls):
+        if pttl == -2:
+            report.vanished += 1
+            continue
+        report.scanned += 1
+        stats = report.stats(key)
+        stats.keys += 1
+        stats.ttls[ttl_bucket(pttl)] += 1
+        if pttl == -1:
+            stats.no_ttl += 1
+            if args.fix_ttl and stats.expected_ttl:
+                repair.append((key, stats))
+        size = sizes.get(key)
+        if size:
+            stats.sampled += 1
+            stats.sampled_bytes += size
+            if size > stats.largest[1]:
+                stats.largest = (key, size)
+
+    if repair:
+        pipe = client.pipeline(transaction=False)
+        for key, stats in repair:
+            pipe.expire(key, stats.expected_ttl)
+        for (key, stats), applied in zip(repair, await pipe.execute()):
+            stats.fixed += int(bool(applied))
+
+async def analyze(client, args) -> KeyspaceReport:
+    """
+    Incremental SCAN of the keyspace (every primary in cluster mode), throttled by --sleep
+    between batches and bounded by --max-keys. Never KEYS, never a blocking command.
+    """
+    report = KeyspaceReport(args.depth)
+    rng = random.Random(args.seed)
+    nodes = client.get_primaries() if settings.REDIS_CLUSTER else [None]
+    for node in nodes:
+        cursor = 0
+        while True:
+            cursor, keys = await scan_batch(client, node, cursor, args)
+            if keys:
+                await measure(client, keys, args, report, rng)
+            if cursor == 0 or (args.max_keys and report.scanned >= args.max_keys):
+                break
+            if args.sleep:
+                await asyncio.sleep(args.sleep)
+        if args.max_keys and report.scanned >= args.max_keys:
+            break
+    if not settings.REDIS_CLUSTER:
+        report.used_memory = (await client.info("memory")).get("used_memory")
+    return report
+
+def human(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def print_report(report: dict, fix_ttl: bool):
+    print(f"{'prefix':<24} {'keys':>10} {'est. memory':>12} {'avg/key':>9} {'sampled':>8} {'no TTL':>8}  TTL distribution")
+    for s in report["prefixes"]:
+        ttls = " ".join(f"{label}:{n}" for label, n in s["ttls"].items() if n)
+        print(f"{s['prefix']:<24} {s['keys']:>10,} {human(s['est_bytes']):>12} {human(s['avg_bytes']):>9} "
+              f"{s['sampled']:>8,} {s['no_ttl']:>8,}  {ttls}")
+    total = f"\n{report['scanned']:,} keys scanned, ~{human(report['est_bytes'])} estimated (keys + values)"
+    if report["used_memory"]:
+        total += f", Redis used_memory {human(report['used_memory'])}"
+    print(total + (f", {report['vanished']} expired while scanning" if report["vanished"] else ""))
+
+    for s in report["prefixes"]:
+        if s["no_ttl"] and s["expected_ttl"]:
+            action = f"{s['fixed']} repaired" if fix_ttl else "run with --fix-ttl to repair"
+            print(f"    ⚠️  {s['no_ttl']:,} '{s['prefix']}' keys without TTL (written with {s['expected_ttl']}s): {action}")
+        if s["largest"]["key"] and s["largest"]["bytes"] > 1024 * 1024:
+            print(f"    ⚠️  Large key in '{s['prefix']}': {s['largest']['key']} ({human(s['largest']['bytes'])})")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Redis memory and TTL footprint per key prefix (SCAN + sampled MEMORY USAGE, production safe)")
+    parser.add_argument("--match", default="*", help="SCAN MATCH pattern, e.g. 'session:*'")
+    parser.add_argument("--count", type=int, default=200, help="SCAN COUNT hint per batch")
+    parser.add_argument("--sample", type=float, default=0.05, help="Fraction of keys measured with MEMORY USAGE")
+    parser.add_argument("--memory-samples", type=int, default=5, help="MEMORY USAGE SAMPLES for hashes, sets, lists and zsets")
+    parser.add_argument("--sleep", type=float, default=0.01, help="Seconds to pause between SCAN batches")
+    parser.add_argument("--max-keys", type=int, default=0, help="Stop after this many keys (0 = whole keyspace)")
+    parser.add_argument("--depth", type=int, default=1, help="Key segments used as prefix, e.g. 2 for 'credit:reservations'")
+    parser.add_argument("--seed", type=int, help="Random seed of the sampling (reproducible runs)")
+    parser.add_argument("--fix-ttl", action="store_true",
+                        help=f"EXPIRE TTL-less keys of namespaces that always carry one ({', '.join(expected_ttls())})")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser
+
+async def main():
+    args = build_parser().parse_args()
+    redis_client = create_redis_client()
+    try:
+        if not args.json:
+            print(f"Scanning {settings.REDIS_URL} (match {args.match!r}, sample {args.sample:.0%})"
+                  f"{', repairing missing TTLs' if args.fix_ttl else ''}...\n")
+        report = (await analyze(redis_client, args)).to_dict()
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report, args.fix_ttl)
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        await redis_client.aclose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+import os
+import sys
+
+# Allow importing from server package
+sys.path.append("/app")
+
+try:
+    from server.config import settings
+    from server.utils import create_redis_client
+    from server.database import engine
+    from server.models import Template
+    from server.log_partitions import create_tables
+    from server.template_store import sync_templates
+except ImportError:
+    # Fallback for local run
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+    from server.config import settings
+    from server.utils import create_redis_client
+    from server.database import engine
+    from server.models import Template
+    from server.log_partitions import create_tables
+    from server.template_store import sync_templates
+
+async def main():
+    parser = argparse.ArgumentParser(description="Reconcile the templates table with the Redis template keys")
+    parser.add_argument("--language", default="es_mx")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be repaired")
+    args = parser.parse_args()
+
+    create_tables(engine, [Template.__table__])
+    print(f"Connecting to Redis at {settings.REDIS_URL}...")
+    redis_client = create_redis_client()
+    try:
+        report = await sync_templates(redis_client, args.language, dry_run=args.dry_run)
+    finally:
+        await redis_client.aclose()
+
+    prefix = "[Dry run] Would have" if args.dry_run else "Sync done:"
+    print(
+        f"{prefix} added {report['added_to_redis']} to Redis, removed {report['removed_from_redis']} inactive "
+        f"from Redis, added {report['added_to_db']} to Postgres ({args.language})"
+    )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import importlib.util
+import os
+import uvicorn
+from .config import settings
+
+def worker_count() -> int:
+    """
+    WEB_WORKERS, or one worker per CPU core this process may run on (respects cpusets / taskset).
+    """
+    if settings.WEB_WORKERS > 0:
+        return settings.WEB_WORKERS
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError: # Not available on macOS
+        return max(1, os.cpu_count() or 1)
+
+def runtime_options() -> dict:
+    """
+    uvloop + httptools when installed (runtime image), uvicorn's pure-Python defaults otherwise.
+    """
+    has = lambda module: importlib.util.find_spec(module) is not None
+    return {
+        "loop": "uvloop" if has("uvloop") else "asyncio",
+        "http": "httptools" if has("httptools") else "h11",
+    }
+
+def main():
+    """
+    Production entrypoint: `python -m server.serve`.
+    Background loops (reply scheduler, syncs, rollups) coordinate across workers through Redis.
+    """
+    workers = worker_count()
+    options = runtime_options()
+    print(f"Starting {settings.PROJECT_NAME} with {workers} worker(s), loop={options['loop']}, http={options['http']}")
+    uvicorn.run(
+        "server.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        proxy_headers=True,
+        # SIGTERM: /readyz 503 for SHUTDOWN_DRAIN_DELAY (see warmup.drain_on_sigterm), then open requests
+        # get this long, then the shutdown drain runs (see main.shutdown_event)
+        timeout_graceful_shutdown=int(settings.SHUTDOWN_DRAIN_TIMEOUT),
+        log_level="info",
+        **options,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from .config import settings
+from .database import SessionLocal, dialect_insert
+from .models import Template
+from .near_duplicates import NearDuplicateIndex
+from .keys import templates_key, upstream_templates_key
+
+# templates_key: set of system replies (SRANDMEMBER in get_random_template)
+# upstream_templates_key: list of user request messages
+UPSTREAM_SOURCES = ("ai_request",)
+GENERATED_SOURCES = ("ai_generated", "ai_reply", "ai_request")
+
+def redis_key(language: str, source: str) -> str:
+    return upstream_templates_key(language) if source in UPSTREAM_SOURCES else templates_key(language)
+
+def _chunks(items: list, size: int = None):
+    size = size or settings.TEMPLATE_BATCH_SIZE
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def insert_templates(db: Session, rows: list) -> list:
+    """
+    Batched INSERT ... ON CONFLICT (content) DO NOTHING.
+    rows: dicts with content, language, source. Returns the contents actually inserted. Caller commits.
+    """
+    insert = dialect_insert(db.get_bind())
+    inserted = []
+    for chunk in _chunks(rows):
+        stmt = insert(Template).values(chunk).on_conflict_do_nothing(index_elements=["content"]).returning(Template.content)
+        inserted += [row[0] for row in db.execute(stmt)]
+    return inserted
+
+def _insert_sync(rows: list) -> list:
+    db = SessionLocal()
+    try:
+        inserted = insert_templates(db, rows)
+        db.commit()
+        return inserted
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+async def ingest_templates(redis_client, items, language: str = "es_mx") -> list:
+    """
+    Store (content, source) pairs: one batched upsert into Postgres, then one Redis pipeline.
+    Replies are SADDed even if already known (idempotent, heals a missing member); upstream
+    messages are RPUSHed only when new. Returns the newly stored contents.
+    If the Redis write fails, sync_templates repairs it from Postgres.
+    """
+    rows, seen = [], set()
+    for content, source in items:
+        if content and content not in seen:
+            seen.add(content)
+            rows.append({"content": content, "language": language, "source": source})
+    if not rows:
+        return []
+
+    inserted = await asyncio.get_running_loop().run_in_executor(None, _insert_sync, rows)
+    new = set(inserted)
+    for chunk in _chunks(rows):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for row in chunk:
+                key = redis_key(language, row["source"])
+                if row["source"] not in UPSTREAM_SOURCES:
+                    pipe.sadd(key, row["content"])
+                elif row["content"] in new:
+                    pipe.rpush(key, row["content"])
+            await pipe.execute()
+    return inserted
+
+def _load_chunk(language: str, after_id: int, limit: int) -> list:
+    db = SessionLocal()
+    try:
+        return (
+            db.query(Template.id, Template.content, Template.source, Template.is_active)
+            .filter(Template.language == language, Template.id > after_id)
+            .order_by(Template.id)
+            .limit(limit)
+            .all()
+        )
+    finally:
+        db.close()
+
+def load_near_duplicate_index(language: str = "es_mx", upstream: bool = False, threshold: float = None) -> NearDuplicateIndex:
+    """
+    MinHash/LSH index of the active templates of one kind (replies or upstream requests), read in id chunks.
+    """
+    index = NearDuplicateIndex(threshold)
+    last_id = 0
+    while True:
+        rows = _load_chunk(language, last_id, settings.TEMPLATE_BATCH_SIZE)
+        if not rows:
+            return index
+        last_id = rows[-1].id
+        for row in rows:
+            if row.is_active and (row.source in UPSTREAM_SOURCES) == upstream:
+                index.add(row.id, row.content)
+
+def _missing_in_db(contents: list) -> list:
+    db = SessionLocal()
+    try:
+        known = {row[0] for row in db.query(Template.content).filter(Template.content.in_(contents))}
+        return [c for c in contents if c not in known]
+    finally:
+        db.close()
+
+async def sync_templates(redis_client, language: str = "es_mx", dry_run: bool = False) -> dict:
+    """
+    Reconcile the templates table with the Redis template keys, in chunks:
+    1. Postgres -> Redis: active rows missing from Redis are added, inactive ones removed
+    2. Redis -> Postgres: members unknown to Postgres are inserted
+    Rebuilds an empty Redis from Postgres with one pipeline per chunk.
+    """
+    loop = asyncio.get_running_loop()
+    chunk_size = settings.TEMPLATE_BATCH_SIZE
+    down_key = templates_key(language)
+    up_key = upstream_templates_key(language)
+    report = {"added_to_redis": 0, "removed_from_redis": 0, "added_to_db": 0}
+
+    upstream = set()
+    for start in range(0, await redis_client.llen(up_key), chunk_size):
+        upstream.update(await redis_client.lrange(up_key, start, start + chunk_size - 1))
+
+    # 1. Postgres -> Redis (keyset over id)
+    last_id = 0
+    while True:
+        rows = await loop.run_in_executor(None, _load_chunk, language, last_id, chunk_size)
+        if not rows:
+            break
+        last_id = rows[-1].id
+        replies = [row for row in rows if row.source not in UPSTREAM_SOURCES]
+        flags = await redis_client.smismember(down_key, [row.content for row in replies]) if replies else []
+        to_add = [row.content for row, flag in zip(replies, flags) if row.is_active and not flag]
+        to_remove = [row.content for row, flag in zip(replies, flags) if not row.is_active and flag]
+        to_push = [row.content for row in rows if row.source in UPSTREAM_SOURCES and row.is_active and row.content not in upstream]
+        report["added_to_redis"] += len(to_add) + len(to_push)
+        report["removed_from_redis"] += len(to_remove)
+        if dry_run or not (to_add or to_remove or to_push):
+            continue
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if to_add:
+                pipe.sadd(down_key, *to_add)
+            if to_remove:
+                pipe.srem(down_key, *to_remove)
+            if to_push:
+                pipe.rpush(up_key, *to_push)
+            await pipe.execute()
+        upstream.update(to_push)
+
+    # 2. Redis -> Postgres
+    async def adopt(contents: list, source: str):
+        if dry_run:
+            report["added_to_db"] += len(await loop.run_in_executor(None, _missing_in_db, contents))
+            return
+        rows = [{"content": c, "language": language, "source": source} for c in contents]
+        report["added_to_db"] += len(await loop.run_in_executor(None, _insert_sync, rows))
+
+    cursor = 0
+    while True:
+        cursor, members = await redis_client.sscan(down_key, cursor, count=chunk_size)
+        if members:
+            await adopt(members, "ai_reply")
+        if cursor == 0:
+            break
+    for chunk in _chunks(sorted(upstream)):
+        await adopt(chunk, "ai_request")
+    return report
+
+def _template_filters(language: str, sources, older_than_days: float):
+    filters = [Template.language == language]
+    if sources:
+        filters.append(Template.source.in_(sources))
+    if older_than_days is not None:
+        filters.append(Template.created_at < datetime.utcnow() - timedelta(days=older_than_days))
+    return filters
+
+def _count_templates(language: str, sources, older_than_days: float) -> int:
+    db = SessionLocal()
+    try:
+        return db.query(Template).filter(*_template_filters(language, sources, older_than_days)).count()
+    finally:
+        db.close()
+
+def _delete_batch(language: str, sources, older_than_days: float, limit: int) -> list:
+    """
+    Delete up to `limit` matching rows (lowest ids first) in one short transaction; returns their (content, source).
+    """
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Template.id, Template.content, Template.source)
+            .filter(*_template_filters(language, sources, older_than_days))
+            .order_by(Template.id)
+            .limit(limit)
+            .all()
+        )
+        if rows:
+            db.query(Template).filter(Template.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            db.commit()
+        return [(row.content, row.source) for row in rows]
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+async def clear_templates(redis_client, language: str = "es_mx", sources=GENERATED_SOURCES, older_than_days: float = None,
+                          dry_run: bool = False, progress=print) -> dict:
+    """
+    Delete templates without stalling Redis or holding a long transaction.
+    - Postgres: TEMPLATE_BATCH_SIZE rows per transaction
+    - Redis: deleted replies are SREMed per batch, the upstream list is rebuilt once at the end
+      (see _rebuild_upstream); a full clear (sources=None, no age filter) UNLINKs the keys
+      instead (freed in the background)
+    """
+    loop = asyncio.get_running_loop()
+    down_key = templates_key(language)
+    up_key = upstream_templates_key(language)
+    full_clear = not sources and older_than_days is None
+    total = await loop.run_in_executor(None, _count_templates, language, sources, older_than_days)
+    report = {"matched": total, "deleted": 0, "redis_removed": 0}
+    deleted_requests = set()
+
+    if dry_run:
+        if full_clear:
+            report["redis_removed"] = await redis_client.scard(down_key) + await redis_client.llen(up_key)
+        return report
+
+    if full_clear:
+        report["redis_removed"] = await redis_client.scard(down_key) + await redis_client.llen(up_key)
+        await redis_client.unlink(down_key, up_key)
+        progress(f"[Redis] UNLINKed {down_key}, {up_key} ({report['redis_removed']} entries)")
+
+    while True:
+        rows = await loop.run_in_executor(None, _delete_batch, language, sources, older_than_days, settings.TEMPLATE_BATCH_SIZE)
+        if not rows:
+            break
+        report["deleted"] += len(rows)
+        if not full_clear:
+            replies = [content for content, source in rows if source not in UPSTREAM_SOURCES]
+            deleted_requests.update(content for content, source in rows if source in UPSTREAM_SOURCES)
+            if replies:
+                report["redis_removed"] += await redis_client.srem(down_key, *replies)
+        progress(f"[DB] Deleted {report['deleted']}/{total} templates")
+
+    if deleted_requests:
+        removed = await _rebuild_upstream(redis_client, up_key, deleted_requests)
+        report["redis_removed"] += removed
+        progress(f"[Redis] Rebuilt {up_key} without {removed} entries")
+    return report
+
+async def _rebuild_upstream(redis_client, up_key: str, deleted: set) -> int:
+    """
+    Drop `deleted` from the upstream list in one O(N) pass (an LREM per row is O(N) each):
+    the survivors are copied in TEMPLATE_BATCH_SIZE chunks to a temp key that then replaces
+    the list atomically (RENAME), or the list is UNLINKed when nothing survives.
+    Messages pushed meanwhile are lost from Redis only; sync_templates restores them from Postgres.
+    """
+    chunk_size = settings.TEMPLATE_BATCH_SIZE
+    tmp_key = f"{up_key}:rebuild" # Same hash tag as up_key (RENAME in cluster mode)
+    await redis_client.unlink(tmp_key)
+    start = removed = kept = 0
+    while True:
+        items = await redis_client.lrange(up_key, start, start + chunk_size - 1)
+        if not items:
+            break
+        start += len(items)
+        survivors = [item for item in items if item not in deleted]
+        removed += len(items) - len(survivors)
+        if survivors:
+            await redis_client.rpush(tmp_key, *survivors)
+            kept += len(survivors)
+    if not removed:
+        await redis_client.unlink(tmp_key)
+    elif kept:
+        await redis_client.rename(tmp_key, up_key)
+    else:
+        await redis_client.unlink(up_key, tmp_key)
+    return removed
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from .config import settings
+from .utils import redis_client
+from .database import SessionLocal, dialect_insert
+from .models import UsageRollup
+
+logger = logging.getLogger("echoid")
+
+COUNTERS_KEY = "usage:{period}:{bucket}:{tenant_id}"
+PHONES_KEY = "usage:hll:{period}:{bucket}:{tenant_id}"
+INDEX_KEY = "usage:index:{period}:{bucket}" # tenant ids billed in that bucket
+ROLLUP_LOCK_KEY = "usage:rollup:lock"
+ROLLUP_WATERMARK_KEY = "usage:rollup:watermark" # period -> oldest bucket the next rollup must (re)read
+
+PERIODS = {
+    "hour": ("%Y%m%d%H", timedelta(hours=1)),
+    "day": ("%Y%m%d", timedelta(days=1)),
+}
+METRICS = ("verifications", "cost_minor")
+ROLLUP_CHUNK_ROWS = 1000 # Rows per upsert statement (bound parameters stay far below the driver limits)
+
+def bucket_start(period: str, moment: datetime) -> datetime:
+    if period == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _bucket(period: str, moment: datetime) -> str:
+    return moment.strftime(PERIODS[period][0])
+
+class UsageMeter:
+    """
+    Per-tenant billed usage, pre-aggregated hourly and daily.
+    - record() only touches in-process dicts (called right after the charge commits)
+    - flush() pushes counters (HINCRBY) and unique-phone HyperLogLogs (PFADD) to Redis
+    - rollup() upserts every bucket since the watermark into usage_rollups, so /v1/usage
+      never scans logs and a stalled rollup is backfilled from the counters Redis still keeps
+    """
+    def __init__(self):
+        self._counters = {} # (period, bucket, tenant_id) -> {metric: n}
+        self._phones = {} # (period, bucket, tenant_id) -> set(phone)
+
+    def record(self, tenant_id, phone: str, cost_minor: int):
+        now = datetime.utcnow()
+        for period in PERIODS:
+            key = (period, _bucket(period, now), str(tenant_id))
+            counters = self._counters.setdefault(key, {})
+            counters["verifications"] = counters.get("verifications", 0) + 1
+            counters["cost_minor"] = counters.get("cost_minor", 0) + cost_minor
+            self._phones.setdefault(key, set()).add(phone)
+
+    def _restore(self, counters: dict, phones: dict):
+        # Billing metering: a failed flush is merged back and pushed next time, never dropped
+        for key, values in counters.items():
+            current = self._counters.setdefault(key, {})
+            for metric, value in values.items():
+                current[metric] = current.get(metric, 0) + value
+        for key, numbers in phones.items():
+            self._phones.setdefault(key, set()).update(numbers)
+
+    async def flush(self):
+        counters, self._counters = self._counters, {}
+        phones, self._phones = self._phones, {}
+        if not counters:
+            return
+        try:
+            await self._push(counters, phones)
+        except Exception:
+            self._restore(counters, phones)
+            raise
+
+    async def _push(self, counters: dict, phones: dict):
+        ttl = settings.ANALYTICS_RETENTION_DAYS * 86400
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for (period, bucket, tenant_id), values in counters.items():
+                key = COUNTERS_KEY.format(period=period, bucket=bucket, tenant_id=tenant_id)
+                hll_key = PHONES_KEY.format(period=period, bucket=bucket, tenant_id=tenant_id)
+                index_key = INDEX_KEY.format(period=period, bucket=bucket)
+                for metric, value in values.items():
+                    pipe.hincrby(key, metric, value)
+                pipe.pfadd(hll_key, *phones[(period, bucket, tenant_id)])
+                pipe.sadd(index_key, tenant_id)
+                for k in (key, hll_key, index_key):
+                    pipe.expire(k, ttl)
+            await pipe.execute()
+
+    async def rollup(self):
+        """
+        Upsert every hour/day bucket from the watermark up to now from Redis into usage_rollups
+        (absolute values, idempotent). Only one worker per interval does it.
+        The watermark moves to the previous bucket (late flushes may still land there) once the
+        rows are saved: after an outage, a DB error or a dead lock holder, the missed buckets
+        are backfilled, as far back as ANALYTICS_RETENTION_DAYS.
+        """
+        if not await redis_client.set(ROLLUP_LOCK_KEY, "1", nx=True, ex=max(1, settings.ANALYTICS_ROLLUP_INTERVAL - 1)):
+            return
+
+        now = datetime.utcnow()
+        retained = now - timedelta(days=settings.ANALYTICS_RETENTION_DAYS)
+        watermarks = await redis_client.hgetall(ROLLUP_WATERMARK_KEY)
+        loop = asyncio.get_running_loop()
+        for period, (fmt, step) in PERIODS.items():
+            since = datetime.strptime(watermarks[period], fmt) if period in watermarks else retained
+            moment, rows = bucket_start(period, max(since, retained)), []
+            while moment <= now:
+                rows += await self._bucket_rows(period, moment)
+                moment += step
+            saved = True
+            for start in range(0, len(rows), ROLLUP_CHUNK_ROWS): # A backfill can span days of buckets
+                saved = saved and await loop.run_in_executor(None, save_usage_rollups, rows[start:start + ROLLUP_CHUNK_ROWS])
+            if saved: # Otherwise the watermark stays: retried (and backfilled) next time
+                await redis_client.hset(ROLLUP_WATERMARK_KEY, period, _bucket(period, now - step))
+
+    async def _bucket_rows(self, period: str, moment: datetime) -> list:
+        bucket = _bucket(period, moment)
+        rows = []
+        for tenant_id in await redis_client.smembers(INDEX_KEY.format(period=period, bucket=bucket)):
+            counters = await redis_client.hgetall(COUNTERS_KEY.format(period=period, bucket=bucket, tenant_id=tenant_id))
+            phones = await redis_client.pfcount(PHONES_KEY.format(period=period, bucket=bucket, tenant_id=tenant_id))
+            row = {metric: int(counters.get(metric, 0)) for metric in METRICS}
+            row.update(
+                period=period,
+                bucket=moment,
+                tenant_id=int(tenant_id),
+                unique_phones=phones,
+                updated_at=datetime.utcnow(),
+            )
+            rows.append(row)
+        return rows
+
+    async def run(self, stop_event: asyncio.Event):
+        last_rollup = 0.0
+        loop = asyncio.get_running_loop()
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=settings.ANALYTICS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                if loop.time() - last_rollup >= settings.ANALYTICS_ROLLUP_INTERVAL:
+                    last_rollup = loop.time()
+                    await self.rollup()
+            except Exception as e:
+                logger.error(f"Usage meter error: {e}")
+
+def save_usage_rollups(rows: list) -> bool:
+    db = SessionLocal()
+    try:
+        insert = dialect_insert(db.get_bind())
+        stmt = insert(UsageRollup).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["tenant_id", "period", "bucket"],
+            set_={column: getattr(stmt.excluded, column) for column in METRICS + ("unique_phones", "updated_at")},
+        )
+        db.execute(stmt)
+        db.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error saving usage rollups: {e}")
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+usage_meter = UsageMeter()
@@ -1,11 +1,61 @@
 import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster
 import random
+import re
 import string
 import json
+from fastapi.responses import JSONResponse
 from .config import settings
+from .keys import session_key, reply_slot_key, lock_key, rate_limit_key, templates_key
+
+try:
+    import orjson
+except ImportError: # Optional outside the runtime image; stdlib json is the fallback
+    orjson = None
+
+def create_redis_client():
+    """
+    Standalone client, or a cluster client (slot routing, MOVED/ASK handling) with REDIS_CLUSTER.
+    """
+    if settings.REDIS_CLUSTER:
+        return RedisCluster.from_url(
+            settings.REDIS_URL, encoding="utf-8", decode_responses=True,
+            read_from_replicas=settings.REDIS_READ_FROM_REPLICAS,
+        )
+    return redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
 
 # Initialize Redis client
-redis_client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+redis_client = create_redis_client()
+
+async def mget(keys: list) -> list:
+    """
+    MGET that also works when the keys live on different cluster slots (one MGET per slot, values in key order).
+    """
+    if settings.REDIS_CLUSTER:
+        return await redis_client.mget_nonatomic(keys)
+    return await redis_client.mget(keys)
+
+FAST_JSON = orjson is not None and settings.FAST_JSON
+
+def json_dumps(obj) -> str:
+    if FAST_JSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj)
+
+def json_loads(data):
+    return orjson.loads(data) if FAST_JSON else json.loads(data)
+
+class FastJSONResponse(JSONResponse):
+    """
+    Default API response class: orjson rendering (stdlib json when FAST_JSON is off).
+    """
+    def render(self, content) -> bytes:
+        if FAST_JSON:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+# Token as it appears in user messages (see generate_token charset)
+TOKEN_PATTERN = re.compile(r"\b([A-HJ-KMNP-Z2-9]{6,10})\b", re.IGNORECASE)
 
 async def generate_token(length=None):
     """
@@ -65,7 +115,7 @@ def validate_pkce(verifier: str, challenge: str) -> bool:
 async def save_verification_session(token: str, phone: str, tenant_id: int = None, code_challenge: str = None, app_name: str = None, package_name: str = None):
     # PRD v5.0: Redis.setex("session:LOGIN-82910", SESSION_TTL, phone_number)
     # Update: Store JSON to include tenant_id for billing
-    key = f"session:{token}"
+    key = session_key(token)
     data = {"phone": phone}
     if tenant_id is not None:
         data["tenant_id"] = tenant_id
@@ -76,37 +126,80 @@ async def save_verification_session(token: str, phone: str, tenant_id: int = Non
     if package_name:
         data["package_name"] = package_name
         
-    await redis_client.setex(key, settings.SESSION_TTL, json.dumps(data))
+    await redis_client.setex(key, settings.SESSION_TTL, json_dumps(data))
 
 
-async def get_session_data(token: str):
-    key = f"session:{token}"
-    data_str = await redis_client.get(key)
+def parse_session_data(data_str: str):
     if not data_str:
         return None
     try:
-        return json.loads(data_str)
-    except json.JSONDecodeError:
+        return json_loads(data_str)
+    except json.JSONDecodeError: # orjson.JSONDecodeError subclasses it
         # Handle legacy string format
         return {"phone": data_str, "tenant_id": None}
 
+async def get_session_data(token: str):
+    key = session_key(token)
+    return parse_session_data(await redis_client.get(key))
+
+def extract_token_candidates(body: str) -> list:
+    """
+    All token-shaped words in a message (uppercased, de-duplicated, in order).
+    Users often write other 6-10 char words (e.g. Spanish words in caps) before the token.
+    """
+    candidates = []
+    for match in TOKEN_PATTERN.finditer(body or ""):
+        token = match.group(1).upper()
+        if token not in candidates:
+            candidates.append(token)
+    return candidates
+
+async def resolve_session(candidates: list):
+    """
+    Resolve every candidate against session:* with a single MGET.
+    Returns (token, session_data) for the first candidate with a live session, else (None, None).
+    """
+    if not candidates:
+        return None, None
+    values = await mget([session_key(token) for token in candidates])
+    for token, data_str in zip(candidates, values):
+        data = parse_session_data(data_str)
+        if data:
+            return token, data
+    return None, None
+
 async def get_session_phone(token: str):
     data = await get_session_data(token)
     if data:
         return data.get("phone")
     return None
 
-async def acquire_lock(msg_id: str, ttl=3600) -> bool:
+LOCK_TTL = 3600 # Seconds a processed message id stays locked
+
+async def acquire_lock(msg_id: str, ttl=LOCK_TTL) -> bool:
     # PRD v5.0: Redis.setnx("lock:{msg_id}", 1)
-    key = f"lock:{msg_id}"
+    key = lock_key(msg_id)
     success = await redis_client.setnx(key, "1")
     if success:
         await redis_client.expire(key, ttl)
     return success
 
+async def claim_reply_slot(token: str, sender: str, reply_id: str):
+    """
+    Coalesce repeated token messages from one sender into a single reply.
+    Returns None if this message owns the reply, else the id of the pending/recent reply.
+    """
+    key = reply_slot_key(token, sender)
+    if await redis_client.set(key, reply_id, nx=True, ex=settings.REPLY_COALESCE_WINDOW):
+        return None
+    return await redis_client.get(key) or reply_id
+
+async def release_reply_slot(token: str, sender: str):
+    await redis_client.delete(reply_slot_key(token, sender))
+
 async def get_random_template() -> str:
     # PRD v5.0: Redis.srandmember("templates:es_mx")
-    template = await redis_client.srandmember("templates:es_mx")
+    template = await redis_client.srandmember(templates_key("es_mx"))
     if not template:
         # Fallback
         return "Tu código {app_name} es {otp}. {link}"
@@ -117,7 +210,7 @@ async def check_rate_limit(identifier: str, limit: int, period: int) -> bool:
     Simple fixed window rate limiter.
     Returns True if allowed, False if limit exceeded.
     """
-    key = f"ratelimit:{identifier}"
+    key = rate_limit_key(identifier)
     current = await redis_client.incr(key)
     if current == 1:
         await redis_client.expire(key, period)
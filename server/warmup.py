@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import secrets
+import signal
+import threading
+import time
+from sqlalchemy import text
+from .config import settings
+from .utils import redis_client, extract_token_candidates, json_dumps, json_loads
+from .database import engine
+from .caches import template_cache, tenant_cache
+
+logger = logging.getLogger("echoid")
+
+WARMUP_KEY = "warmup:{nonce}"
+
+class Readiness:
+    """
+    Lifecycle of this worker as seen by the load balancer.
+    - starting -> warming -> ready (warm-up finished, see warm_up) -> draining (SIGTERM, see drain_on_sigterm)
+    - /healthz stays 503 until warmed up, /readyz is 503 unless ready
+    """
+    def __init__(self):
+        self.state = "starting"
+        self.warmup = {} # step -> ms / count, reported by /readyz
+        self.error = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def alive(self) -> bool:
+        return self.state in ("ready", "draining")
+
+    @property
+    def draining(self) -> bool:
+        return self.state == "draining"
+
+    def reset(self):
+        self.__init__()
+
+def _ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
+
+def _prefill_db_pool() -> int:
+    """
+    Open pool_size connections at once (so none is opened on the request path), then return them to the pool.
+    """
+    size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    connections = [engine.connect() for _ in range(size)]
+    try:
+        for connection in connections:
+            connection.execute(text("SELECT 1"))
+    finally:
+        for connection in connections:
+            connection.close()
+    return size
+
+def _db_round_trip():
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+async def _redis_round_trip():
+    key = WARMUP_KEY.format(nonce=secrets.token_hex(4))
+    payload = json_dumps({"ok": True})
+    await redis_client.set(key, payload, px=10000)
+    value = await redis_client.get(key)
+    await redis_client.delete(key)
+    if value is not None and json_loads(value) != {"ok": True}:
+        raise RuntimeError("Redis self-check returned a different value")
+
+async def warm_up():
+    """
+    Run before the worker accepts traffic (startup event):
+    1. Pre-fill the Postgres pool and open WARMUP_REDIS_CONNECTIONS Redis connections
+    2. Load the template and tenant caches
+    3. Self-check: Redis SET/GET/DEL and DB SELECT 1 round trips, one pass over the hot path helpers
+    """
+    loop = asyncio.get_running_loop()
+    if not readiness.draining:
+        readiness.state = "warming"
+    report = {}
+
+    # 1. Connection pools
+    started = time.perf_counter()
+    report["db_connections"] = await loop.run_in_executor(None, _prefill_db_pool)
+    report["db_pool_ms"] = _ms(started)
+    started = time.perf_counter()
+    await asyncio.gather(*(redis_client.ping() for _ in range(settings.WARMUP_REDIS_CONNECTIONS)))
+    report["redis_connections"] = settings.WARMUP_REDIS_CONNECTIONS
+    report["redis_pool_ms"] = _ms(started)
+
+    # 2. Caches
+    started = time.perf_counter()
+    report["templates"] = await template_cache.refresh()
+    report["tenants"] = await loop.run_in_executor(None, tenant_cache.load)
+    report["caches_ms"] = _ms(started)
+
+    # 3. Self-check
+    started = time.perf_counter()
+    await _redis_round_trip()
+    await loop.run_in_executor(None, _db_round_trip)
+    extract_token_candidates("Hola, mi código de verificación es AB2345")
+    (template_cache.choose() or "{app_name} {otp} {link}").format(app_name="EchoID", otp="0000", link="")
+    report["self_check_ms"] = _ms(started)
+
+    readiness.warmup = report
+    readiness.error = None
+    if not readiness.draining: # SIGTERM arrived while warming up: stay out of rotation
+        readiness.state = "ready"
+    logger.info(f"Warm-up done: {report}")
+    return report
+
+async def try_warm_up() -> bool:
+    """
+    warm_up() bounded by WARMUP_TIMEOUT; a failure is logged and reported by /readyz.
+    """
+    try:
+        await asyncio.wait_for(warm_up(), timeout=settings.WARMUP_TIMEOUT)
+        return True
+    except Exception as e:
+        readiness.error = str(e) or type(e).__name__
+        logger.error(f"Warm-up failed, retrying in {settings.WARMUP_RETRY_INTERVAL}s: {readiness.error}")
+        return False
+
+async def run_warm_up(stop_event: asyncio.Event):
+    """
+    Retry warm-up every WARMUP_RETRY_INTERVAL until it succeeds (the worker stays not ready meanwhile).
+    """
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=settings.WARMUP_RETRY_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if not stop_event.is_set() and await try_warm_up():
+            return
+
+def drain_on_sigterm(loop: asyncio.AbstractEventLoop, delay: float) -> bool:
+    """
+    Wrap the SIGTERM handler uvicorn installed (call from the startup event): readiness flips to
+    draining at once, so /readyz and the webhooks answer 503 while uvicorn keeps serving, and the
+    original handler (stop accepting, finish open requests, shutdown event) runs `delay` seconds later,
+    once the load balancer has taken this worker out of rotation. A second SIGTERM skips the delay.
+    """
+    original = signal.getsignal(signal.SIGTERM)
+    if not callable(original) or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handle_sigterm(sig, frame):
+        if readiness.draining:
+            original(sig, frame)
+            return
+        readiness.state = "draining"
+        logger.info(f"SIGTERM: draining, shutting down in {delay}s")
+        loop.call_soon_threadsafe(loop.call_later, delay, original, sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    return True
+
+async def check_dependencies() -> dict:
+    """
+    Redis PING and DB SELECT 1, each bounded by READINESS_CHECK_TIMEOUT: {name: {"ok", "latency_ms"}}.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def probe(name, check):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(check(), timeout=settings.READINESS_CHECK_TIMEOUT)
+            return name, {"ok": True, "latency_ms": _ms(started)}
+        except Exception as e:
+            return name, {"ok": False, "latency_ms": _ms(started), "error": str(e) or type(e).__name__}
+
+    results = await asyncio.gather(
+        probe("redis", redis_client.ping),
+        probe("database", lambda: loop.run_in_executor(None, _db_round_trip)),
+    )
+    return dict(results)
+
+readiness = Readiness()
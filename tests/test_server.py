@@ -15,6 +15,7 @@ os.environ["REDIS_URL"] = "redis://localhost:6379/0"
 
 from unittest.mock import patch, AsyncMock, MagicMock
 from fastapi.testclient import TestClient
+import asyncio
 import json
 
 # Mock redis before importing main
@@ -24,10 +25,56 @@ with patch('redis.asyncio.from_url') as mock_redis_factory:
     
     # Mock database
     with patch('server.database.SessionLocal') as mock_session_local:
-        from server.main import app, get_db
+        from server.main import app, get_db, deliver_reply
         from server.utils import redis_client
         from server.models import Tenant
 
+class FakeTemplateRedis:
+    """
+    In-memory stand-in for the set / list commands used by server.template_store.
+    """
+    def __init__(self):
+        self.sets, self.lists = {}, {}
+
+    def pipeline(self, transaction=False):
+        redis_self = self
+        class Pipe:
+            async def __aenter__(self):
+                self.ops = []
+                return self
+            async def __aexit__(self, *exc):
+                return False
+            def __getattr__(self, name):
+                return lambda *args: self.ops.append((name, args))
+            async def execute(self):
+                return [await getattr(redis_self, name)(*args) for name, args in self.ops]
+        return Pipe()
+
+    async def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+    async def srem(self, key, *members):
+        present = self.sets.get(key, set()) & set(members)
+        self.sets.get(key, set()).difference_update(members)
+        return len(present)
+    async def smismember(self, key, members):
+        return [int(m in self.sets.get(key, set())) for m in members]
+    async def sscan(self, key, cursor, count=10):
+        return 0, sorted(self.sets.get(key, set()))
+    async def scard(self, key):
+        return len(self.sets.get(key, set()))
+    async def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+    async def rename(self, key, new_key):
+        self.lists[new_key] = self.lists.pop(key)
+    async def llen(self, key):
+        return len(self.lists.get(key, []))
+    async def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1]
+    async def unlink(self, *keys):
+        for key in keys:
+            self.sets.pop(key, None)
+            self.lists.pop(key, None)
+
 class TestEchoIDFlow(unittest.TestCase):
     def setUp(self):
         self.client = TestClient(app)
@@ -35,21 +82,37 @@ class TestEchoIDFlow(unittest.TestCase):
         # Reset mocks
         redis_client.setex = AsyncMock()
         redis_client.get = AsyncMock()
+        redis_client.mget = AsyncMock(side_effect=self._mget) # MGET follows the GET mock
         redis_client.setnx = AsyncMock(return_value=True) # Default acquire lock success
         redis_client.srandmember = AsyncMock(return_value="Code: {otp} Link: {link}") # Mock template
         redis_client.incr = AsyncMock(return_value=1) # Default rate limit count
         redis_client.expire = AsyncMock()
+        redis_client.eval = AsyncMock(return_value=1)
+        redis_client.set = AsyncMock(return_value=True) # Default reply slot free (no coalescing)
 
         # Mock DB Session
         self.mock_db = MagicMock()
         self.mock_tenant = Tenant(id=1, api_key="test-key", balance=10.0, name="TestApp")
         self.mock_db.query.return_value.filter.return_value.first.return_value = self.mock_tenant
+        self.mock_db.query.return_value.filter.return_value.scalar.return_value = 1000 # Sum of balance shards (minor units)
         
         # Override get_db dependency
         def override_get_db():
             yield self.mock_db
         app.dependency_overrides[get_db] = override_get_db
 
+    async def _mget(self, keys):
+        return [await redis_client.get(key) for key in keys]
+
+    def _scheduled_job(self):
+        """
+        Return the last reply job stored by the scheduler (SCHEDULE_SCRIPT: id, body, due_at, tenant)
+        """
+        from server.scheduler import SCHEDULE_SCRIPT
+        calls = [c for c in redis_client.eval.call_args_list if c[0][0] == SCHEDULE_SCRIPT]
+        self.assertTrue(calls, "No reply job scheduled")
+        return json.loads(calls[-1][0][6])
+
     def test_init_returns_echoid_redirect_link(self):
         print("\n[10] Testing Init Returns EchoID Redirect Link")
         from server.utils import redis_client
@@ -184,7 +247,16 @@ class TestEchoIDFlow(unittest.TestCase):
         # 1. Check typing started
         mock_echob.start_typing.assert_called_once()
         print("    ✅ Typing indicator started")
-        
+
+        # Reply is scheduled in Redis, not sent inline
+        mock_echob.send_text.assert_not_called()
+        job = self._scheduled_job()
+        print("    ✅ Reply job scheduled")
+
+        # Run the scheduled job as the scheduler worker would
+        asyncio.run(deliver_reply(job))
+        mock_echob.stop_typing.assert_called_once()
+
         # 2. Check message sent
         mock_echob.send_text.assert_called_once()
         sent_text = mock_echob.send_text.call_args[0][2] # args: (instance, phone, text)
@@ -585,6 +657,1273 @@ class TestEchoIDFlow(unittest.TestCase):
         self.assertEqual(res.json().get("msg"), "phone_mismatch")
         print("    ✅ Phone Mismatch Blocked (Attacker cannot trigger OTP)")
 
+    def test_typing_delay_scales_with_length(self):
+        print("\n[11] Testing Typing Delay Scheduling")
+        from server.scheduler import compute_typing_delay
+        from server.config import settings
+
+        short_delays = [compute_typing_delay("Code 1234") for _ in range(50)]
+        long_delays = [compute_typing_delay("x" * 120) for _ in range(50)]
+
+        for delay in short_delays + long_delays:
+            self.assertGreaterEqual(delay, settings.TYPING_DELAY_MIN)
+            self.assertLessEqual(delay, settings.TYPING_DELAY_MAX)
+        self.assertGreater(sum(long_delays) / 50, sum(short_delays) / 50)
+        self.assertGreater(len(set(long_delays)), 1) # Jitter
+        print("    ✅ Delay grows with message length and is jittered")
+
+    @patch('server.main.echob_client')
+    def test_bot_pool_sticky_routing(self, mock_echob):
+        print("\n[12] Testing Bot Pool Sticky Routing")
+        from server.bot_pool import BotPool, parse_bot_pool
+        mock_echob.start_typing = AsyncMock()
+
+        pool = BotPool(parse_bot_pool("bot1:5211111111,bot2:5222222222", "525670061324"))
+        token = "ABCDEF2345"
+        redis_client.get.side_effect = None
+        redis_client.get.return_value = json.dumps({"phone": None, "tenant_id": 1, "bot_session": "bot2"})
+
+        with patch('server.main.bot_pool', pool):
+            # /v1/go keeps the bot already assigned to the token
+            res = self.client.get(f"/v1/go/{token}", follow_redirects=False)
+            self.assertIn("wa.me/5222222222", res.headers["location"])
+
+            # Reply goes out through the session that received the message
+            payload = {
+                "event": "message",
+                "session": "bot1",
+                "payload": {"from": "521555555555", "body": f"Verify {token}", "id": "MSG_BOT"}
+            }
+            res = self.client.post("/webhook/echob", json=payload)
+            self.assertEqual(res.json()["status"], "ok")
+
+        job = self._scheduled_job()
+        self.assertEqual(job["session"], "bot1")
+        mock_echob.start_typing.assert_called_once_with("bot1", "521555555555")
+        print("    ✅ Sticky bot on /v1/go, reply via receiving session")
+
+    def test_fair_sender_isolates_tenants(self):
+        print("\n[13] Testing Per-Tenant Fair Queuing")
+        from server.fair_queue import FairSender, PRIORITY_BULK
+
+        order = []
+
+        async def scenario():
+            sender = FairSender(concurrency=1, tenant_concurrency=1, bulk_tenants={"3"})
+
+            def make_send(tag):
+                async def send():
+                    order.append(tag)
+                return send
+
+            # Tenant 1 floods the queue, tenant 2 sends a single OTP, tenant 3 is bulk
+            tasks = [asyncio.create_task(sender.submit(1, make_send(f"t1-{i}"))) for i in range(5)]
+            tasks.append(asyncio.create_task(sender.submit(3, make_send("t3-0"), priority=PRIORITY_BULK)))
+            tasks.append(asyncio.create_task(sender.submit(2, make_send("t2-0"))))
+            await asyncio.gather(*tasks)
+            return sender.snapshot()
+
+        snapshot = asyncio.run(scenario())
+
+        # Tenant 2 is served right after tenant 1's first send, bulk goes last
+        self.assertLessEqual(order.index("t2-0"), 2)
+        self.assertEqual(order[-1], "t3-0")
+        self.assertEqual(snapshot["tenants"]["1"]["sent"], 5)
+        self.assertIn("wait_avg_ms", snapshot["tenants"]["2"])
+
+        # Idle tenants' metrics are evicted after metrics_ttl, busy ones kept
+        async def eviction():
+            sender = FairSender(concurrency=1, tenant_concurrency=1, metrics_ttl=0.05)
+            await sender.submit(1, AsyncMock())
+            blocker = asyncio.Event()
+            busy = asyncio.create_task(sender.submit(2, blocker.wait))
+            await asyncio.sleep(0.1)
+            tenants = set(sender.snapshot()["tenants"])
+            blocker.set()
+            await busy
+            return tenants
+
+        self.assertEqual(asyncio.run(eviction()), {"2"})
+        print(f"    ✅ Send order: {order}")
+
+    def test_inbound_partition_rebalance(self):
+        print("\n[14] Testing Sender Partitioning & Rebalance")
+        from server.inbound import assign_partitions, partition_for
+
+        # Same sender always maps to the same partition
+        self.assertEqual(partition_for("521555555555@c.us", 16), partition_for("521555555555@c.us", 16))
+
+        before = assign_partitions(["w1", "w2", "w3"], 64)
+        after = assign_partitions(["w1", "w2", "w3", "w4"], 64)
+        self.assertEqual(set(before.values()), {"w1", "w2", "w3"})
+
+        # Only partitions claimed by the new worker move
+        moved = [p for p in range(64) if before[p] != after[p]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[p] == "w4" for p in moved))
+
+        # A worker leaving hands back exactly its partitions
+        left = assign_partitions(["w1", "w3"], 64)
+        self.assertTrue(all(left[p] == before[p] for p in range(64) if before[p] != "w2"))
+        print(f"    ✅ {len(moved)}/64 partitions moved when a worker joined")
+
+    def test_failed_reply_is_dead_lettered(self):
+        print("\n[15] Testing Dead-Letter Queue for Failed Replies")
+        from server.scheduler import fail_reply, SCHEDULE_SCRIPT
+        from server.dead_letter import DLQ_KEY
+        from server.config import settings
+        redis_client.hset = AsyncMock()
+        redis_client.zrem = AsyncMock()
+
+        job = {"id": "job1", "token": "ABCDEF2345", "chat_id": "521555555555", "tenant_id": 1, "attempts": 0}
+
+        # First failure: retried (re-scheduled), not dead-lettered
+        asyncio.run(fail_reply(job, "boom"))
+        self.assertEqual(redis_client.eval.call_args[0][0], SCHEDULE_SCRIPT)
+        redis_client.hset.assert_not_called()
+
+        # Last attempt: dead-lettered with full context
+        job["attempts"] = settings.REPLY_MAX_ATTEMPTS - 1
+        asyncio.run(fail_reply(job, "boom"))
+        key, entry_id, raw = redis_client.hset.call_args[0]
+        entry = json.loads(raw)
+        self.assertEqual(key, DLQ_KEY)
+        self.assertEqual(entry["sender"], "521555555555")
+        self.assertEqual(entry["attempts"], settings.REPLY_MAX_ATTEMPTS)
+        self.assertEqual(entry["last_error"], "boom")
+
+        # Replay checks the session key the webhook wrote (hash-tagged in cluster mode)
+        from server.scripts.dead_letters import replay_entry
+        redis_client.ttl = AsyncMock(return_value=-2)
+        dlq_entry = {"id": "job1", "token": "ABCDEF2345", "job": job}
+        for cluster, key in ((False, "session:ABCDEF2345"), (True, "session:{ABCDEF2345}")):
+            with patch.object(settings, "REDIS_CLUSTER", cluster):
+                self.assertEqual(asyncio.run(replay_entry(dlq_entry, dry_run=True)), "expired")
+            redis_client.ttl.assert_awaited_with(key)
+        redis_client.ttl.return_value = 300
+        with patch.object(settings, "REDIS_CLUSTER", True):
+            self.assertEqual(asyncio.run(replay_entry(dlq_entry, dry_run=True)), "would_replay")
+        print("    ✅ Retried, then dead-lettered after max attempts")
+
+    @patch('server.main.echob_client')
+    def test_duplicate_token_messages_coalesced(self, mock_echob):
+        print("\n[16] Testing Duplicate Token Message Coalescing")
+        mock_echob.start_typing = AsyncMock()
+        token = "ABCDEF2345"
+        sender = "521555555555"
+        redis_client.get.side_effect = None
+        redis_client.get.return_value = json.dumps({"phone": sender, "tenant_id": 1})
+
+        payload = {"event": "message", "payload": {"from": sender, "body": f"Hola, mi código de verificación es {token}", "id": "MSG_1"}}
+        res = self.client.post("/webhook/echob", json=payload)
+        self.assertEqual(res.json()["status"], "ok")
+        reply_id = self._scheduled_job()["id"]
+
+        # Same message again with a new msg_id while the reply is pending
+        redis_client.set.return_value = None
+        redis_client.get.side_effect = lambda key: reply_id if key.startswith("reply:") else json.dumps({"phone": sender, "tenant_id": 1})
+        redis_client.eval.reset_mock()
+        mock_echob.start_typing.reset_mock()
+
+        payload["payload"]["id"] = "MSG_2"
+        res = self.client.post("/webhook/echob", json=payload)
+        self.assertEqual(res.json()["msg"], "coalesced")
+        self.assertEqual(res.json()["reply_id"], reply_id)
+        redis_client.eval.assert_not_called() # No second reply scheduled (no send, no billing)
+        mock_echob.start_typing.assert_not_called()
+        redis_client.get.side_effect = None
+        print("    ✅ Duplicate attached to the pending reply")
+
+    @patch('server.main.echob_client')
+    def test_batch_webhook(self, mock_echob):
+        print("\n[17] Testing Batch Webhook Ingestion")
+        mock_echob.start_typing = AsyncMock()
+        redis_client.get.side_effect = None
+        redis_client.get.return_value = json.dumps({"phone": "521555555555", "tenant_id": 1})
+
+        events = [
+            {"event": "message", "payload": {"from": "521555555555", "body": "Código ABCDEF2345", "id": "B1"}},
+            {"event": "message.ack", "payload": {"id": "B2"}},
+            {"event": "message", "payload": {"from": "521555555555", "body": "hola", "id": "B3"}},
+        ]
+        ndjson = "\n".join(json.dumps(e, ensure_ascii=False) for e in events) + "\n{broken"
+        res = self.client.post("/webhook/echob/batch", content=ndjson.encode("utf-8"))
+        results = res.json()["results"]
+        self.assertEqual([r["status"] for r in results], ["ok", "ignored", "ignored", "error"])
+        self.assertEqual(results[1]["msg"], "not_message")
+        self.assertEqual(results[2]["msg"], "no_token")
+        # Dropped events never touched Redis (only one rate-limit check)
+        self.assertEqual(redis_client.incr.call_count, 1)
+
+        # JSON array body gives the same results
+        res = self.client.post("/webhook/echob/batch", json=events)
+        self.assertEqual([r["msg"] for r in res.json()["results"][1:]], ["not_message", "no_token"])
+
+        # Array body in small chunks: a malformed element is skipped, the next ones still stream
+        from server.ingest import iter_batch_events, BatchParseError, _ArrayParser
+        from server.config import settings
+        async def parse(body: str, size: int = 7):
+            async def chunks():
+                for i in range(0, len(body), size):
+                    yield body[i:i + size].encode("utf-8")
+            return [e if not isinstance(e, BatchParseError) else str(e) async for e in iter_batch_events(chunks())]
+        body = '[{"id": 1}, {"id": 2, "text": "a, ] \\" }"}, {"id": oops, "x": [1, 2]}, 42, {"id": 3}]'
+        self.assertEqual(asyncio.run(parse(body)), [{"id": 1}, {"id": 2, "text": 'a, ] " }'}, "invalid_json", 42, {"id": 3}])
+        self.assertEqual(asyncio.run(parse('[{"id": 1}, {"id": 2')), [{"id": 1}, "truncated_array"])
+
+        # An element that never ends is rejected once it outgrows the cap, the rest is not buffered
+        parser = _ArrayParser()
+        with patch.object(settings, "WEBHOOK_BATCH_MAX_EVENT_BYTES", 64):
+            self.assertEqual(asyncio.run(parse('[{"id": 1}, {"text": "' + "x" * 1000 + '"}, {"id": 2}]')),
+                             [{"id": 1}, "event_too_large"])
+            self.assertEqual(asyncio.run(parse('{"id": 1}\n{"text": "' + "x" * 1000)), [{"id": 1}, "event_too_large"])
+            for _ in range(100):
+                parser.feed('{"text": "' + "x" * 10)
+            self.assertTrue(parser.done)
+            self.assertLess(len(parser.buffer), 100)
+        print("    ✅ Per-event results, non-token events dropped before Redis")
+
+    @patch('server.main.echob_client')
+    def test_token_among_other_candidates(self, mock_echob):
+        print("\n[18] Testing Multi-Candidate Token Extraction")
+        from server.utils import extract_token_candidates
+        mock_echob.start_typing = AsyncMock()
+        token = "ABCDEF2345"
+        body = f"BUENAS TARDES, mi código es {token}"
+        self.assertEqual(extract_token_candidates(body), ["BUENAS", "TARDES", token])
+
+        async def mock_get(key):
+            if key == f"session:{token}":
+                return json.dumps({"phone": "521555555555", "tenant_id": 1})
+            return None
+        redis_client.get.side_effect = mock_get
+
+        payload = {"event": "message", "payload": {"from": "521555555555", "body": body, "id": "MSG_CAND"}}
+        res = self.client.post("/webhook/echob", json=payload)
+        self.assertEqual(res.json()["status"], "ok")
+        self.assertEqual(self._scheduled_job()["token"], token)
+        redis_client.mget.assert_called_once_with(["session:BUENAS", "session:TARDES", f"session:{token}"])
+        redis_client.get.side_effect = None
+        print("    ✅ Token resolved with one MGET despite earlier candidates")
+
+    def test_domain_pool_health_weighting(self):
+        print("\n[19] Testing Health-Weighted Domain Rotation")
+        from server.domains import DomainPool, parse_link_domains
+        from server.config import settings
+
+        domains = parse_link_domains("https://good.cc, bad.cc/ ,https://good.cc", settings.HOST_URL)
+        self.assertEqual(domains, ["https://good.cc", "http://bad.cc"])
+        pool = DomainPool(domains)
+
+        # bad.cc links are sent but never clicked (flagged by WhatsApp)
+        quarantine = pool.apply_totals({
+            "https://good.cc": [1000, 400],
+            "http://bad.cc": [1000, 3],
+        })
+        self.assertEqual(quarantine, ["http://bad.cc"])
+
+        picks = [pool.choose() for _ in range(200)]
+        self.assertGreater(picks.count("https://good.cc"), 190)
+
+        # Quarantined domains are out of rotation entirely
+        pool.quarantined = {"http://bad.cc"}
+        self.assertTrue(all(pool.choose() == "https://good.cc" for _ in range(50)))
+        print("    ✅ Healthy domain preferred, collapsed CTR quarantined")
+
+    def test_click_analytics_and_funnel(self):
+        print("\n[20] Testing Buffered Click Analytics & Funnel")
+        from server.analytics import click_analytics
+        from server.models import ClickStat
+        from datetime import date
+        click_analytics._counters.clear()
+        click_analytics._uniques.clear()
+        from server.main import domain_pool
+        domain_pool._totals["https://d1.cc"] = (100, 0)
+
+        redis_client.get.side_effect = None
+        redis_client.get.return_value = json.dumps({"token": "TOK123", "otp": "1234", "domain": "https://d1.cc", "tenant_id": 1})
+        android = {"User-Agent": "Mozilla/5.0 (Linux; Android 10; SM-G960F)"}
+        self.client.get("/q/SLUG1", headers={"User-Agent": "WhatsApp/2.23.20 A"}, follow_redirects=False)
+        self.client.get("/q/SLUG1", headers=android, follow_redirects=False)
+        self.client.get("/q/SLUG1", headers=android, follow_redirects=False)
+
+        # Buffered in-process only; nothing written on the redirect path
+        (bucket, counters), = click_analytics._counters.items()
+        self.assertEqual(bucket[1:], ("1", "https://d1.cc"))
+        self.assertEqual(counters, {"preview_hits": 1, "clicks": 2})
+        self.assertEqual(len(click_analytics._uniques[bucket]), 1)
+        # Domain health only sees real clicks, not the WhatsApp preview fetch
+        self.assertEqual(domain_pool._pending.pop("https://d1.cc")[1], 2)
+        domain_pool._totals.pop("https://d1.cc")
+
+        # Redis down during a flush: buffers are kept (merged with new clicks) for the next one
+        with patch("server.analytics.redis_client.pipeline", new=MagicMock(side_effect=ConnectionError("redis down"))):
+            with self.assertRaises(ConnectionError):
+                asyncio.run(click_analytics.flush())
+        self.client.get("/q/SLUG1", headers=android, follow_redirects=False)
+        self.assertEqual(click_analytics._counters[bucket], {"preview_hits": 1, "clicks": 3})
+        self.assertEqual(len(click_analytics._uniques[bucket]), 1)
+        click_analytics._counters.clear()
+        click_analytics._uniques.clear()
+
+        # Funnel report from rollups
+        self.mock_db.query.return_value.filter.return_value.all.return_value = [
+            ClickStat(day=date.today(), tenant_id=1, domain="https://d1.cc", sent=100, clicks=40, preview_hits=90, unique_visitors=35, verified=30),
+            ClickStat(day=date.today(), tenant_id=1, domain="", sent=0, clicks=0, preview_hits=0, unique_visitors=0, verified=5),
+        ]
+        res = self.client.get("/v1/analytics/funnel", headers={"X-Api-Key": "test-key"})
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual(body["funnel"]["verified"], 35)
+        self.assertEqual(body["domains"]["https://d1.cc"]["ctr"], 0.4)
+        self.assertEqual(self.client.get("/v1/analytics/funnel").status_code, 422) # Missing API key
+        print("    ✅ Preview bots separated, funnel served from rollups")
+
+    def test_sharded_balance_ledger(self):
+        print("\n[21] Testing Sharded Balance Counters")
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from server.models import Base, LedgerEntry
+        from server.billing import charge, credit, get_balance_minor, migrate_legacy_balances, to_minor
+
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        try:
+            db.add(Tenant(id=7, api_key="legacy", name="Legacy", balance=1.0))
+            db.commit()
+            self.assertEqual(migrate_legacy_balances(db), 1)
+            self.assertEqual(migrate_legacy_balances(db), 0) # Idempotent
+
+            # A million 0.05 charges would drift as floats; integer minor units don't
+            for i in range(30):
+                charge(db, 7, to_minor(0.05), reference=f"TOK{i}")
+            credit(db, 7, to_minor(2.5))
+            db.commit()
+
+            self.assertEqual(get_balance_minor(db, 7), 100 - 30 * 5 + 250)
+            self.assertEqual(db.query(LedgerEntry).filter(LedgerEntry.tenant_id == 7).count(), 32)
+        finally:
+            db.close()
+        print("    ✅ Balance = sum of shards, every movement in the ledger")
+
+    def test_credit_reserved_in_redis(self):
+        print("\n[22] Testing Redis Credit Reservation")
+        from server.credit import RESERVE_SCRIPT, RECONCILE_SCRIPT, RELEASE_SCRIPT, EXPIRY_KEY, settle_credit, refund_expired_reservations
+        request_data = {"api_key": "test-key", "app_name": "App", "code_challenge": "challenge123"}
+
+        # Out of credit: rejected without touching Postgres
+        redis_client.eval = AsyncMock(return_value=0)
+        redis_client.zadd = AsyncMock()
+        redis_client.zrem = AsyncMock()
+        redis_client.hdel = AsyncMock()
+        res = self.client.post("/v1/init", json=request_data)
+        self.assertEqual(res.status_code, 402)
+        self.mock_db.query.return_value.filter.return_value.scalar.assert_not_called()
+
+        # Cold credit (-1): loaded once from the shard sum, then reserved
+        redis_client.eval = AsyncMock(side_effect=[-1, 995, 1])
+        redis_client.sadd = AsyncMock()
+        with patch('server.credit.SessionLocal', return_value=self.mock_db):
+            res = self.client.post("/v1/init", json=request_data)
+        self.assertEqual(res.status_code, 200)
+        scripts = [c[0][0] for c in redis_client.eval.call_args_list]
+        self.assertEqual(scripts, [RESERVE_SCRIPT, RECONCILE_SCRIPT, RESERVE_SCRIPT])
+        self.assertEqual(redis_client.eval.call_args_list[1][0][5], 1000) # DB balance
+        token = redis_client.eval.call_args_list[2][0][6]
+        self.assertEqual(redis_client.zadd.call_args[0][0], EXPIRY_KEY)
+
+        # Settling drops the reservation for that token (and its share of the outstanding total)
+        redis_client.eval = AsyncMock(return_value=5)
+        asyncio.run(settle_credit(1, token))
+        self.assertEqual(redis_client.eval.call_args[0],
+                         (RELEASE_SCRIPT, 3, "credit:1", "credit:reservations:1", "credit:outstanding:1", token, "settle"))
+        redis_client.zrem.assert_awaited_with(EXPIRY_KEY, f"1:{token}")
+
+        # Expired reservations: refunded in pipelined batches until none is left
+        expiry = {f"{i % 3}:tok{i}": 0 for i in range(1203)}
+        refunds = []
+        class Pipe:
+            def __init__(self):
+                self.ops = []
+            async def __aenter__(self):
+                return self
+            async def __aexit__(self, *exc):
+                return False
+            def eval(self, script, numkeys, *args):
+                self.ops.append(args)
+            def zrem(self, key, *members):
+                self.ops.append(("zrem",) + members)
+            async def execute(self):
+                for op in self.ops:
+                    if op[0] == "zrem":
+                        for member in op[1:]:
+                            del expiry[member]
+                    else:
+                        refunds.append(op)
+        async def zrangebyscore(key, low, high, start, num):
+            return list(expiry)[:num]
+        with patch.object(redis_client, "pipeline", new=MagicMock(side_effect=lambda transaction: Pipe())), \
+             patch.object(redis_client, "zrangebyscore", new=zrangebyscore):
+            self.assertEqual(asyncio.run(refund_expired_reservations(batch_size=500)), 1203)
+            self.assertEqual(redis_client.pipeline.call_count, 3)
+        self.assertEqual((len(expiry), len(refunds)), (0, 1203))
+        self.assertEqual(refunds[0], ("credit:0", "credit:reservations:0", "credit:outstanding:0", "tok0", "refund"))
+        print("    ✅ Credit checked and held in Redis, settled after billing, expired holds drained")
+
+    @patch('server.main.SessionLocal')
+    def test_log_partitions_and_otp_redaction(self, mock_session_local):
+        print("\n[23] Testing Logs Partitioning & OTP Redaction")
+        from datetime import date
+        from server.log_partitions import add_months, partition_name, expired_partitions
+        from server.main import log_transaction
+
+        self.assertEqual(partition_name(add_months(date(2025, 11, 1), 3)), "logs_y2026m02")
+        names = ["logs_y2025m01", "logs_y2025m04", "logs_y2025m05", "logs_default", "logs_y2025m06"]
+        # Keep 2 full months before June 2025 -> April and May stay
+        self.assertEqual(expired_partitions(names, date(2025, 6, 15), 2), ["logs_y2025m01"])
+
+        # Legacy copy only reads the columns the old table has; the OTP is masked only if stored
+        from server.log_partitions import copy_legacy_logs_sql, create_tables
+        with_otp = copy_legacy_logs_sql({"id", "tenant_id", "phone", "token", "otp", "template_snapshot", "cost", "created_at"})
+        self.assertIn("replace(template_snapshot, otp, '{otp}')", with_otp)
+        without_otp = copy_legacy_logs_sql({"id", "tenant_id", "phone", "template_snapshot", "created_at"})
+        self.assertNotIn("otp,", without_otp)
+        self.assertTrue(without_otp.startswith("INSERT INTO logs (id, tenant_id, phone, template_snapshot, created_at) SELECT"))
+
+        # Scripts create only what they need (never a plain logs table on Postgres)
+        from sqlalchemy import create_engine, inspect
+        from server.models import Template
+        engine = create_engine("sqlite://")
+        create_tables(engine, [Template.__table__])
+        self.assertEqual(inspect(engine).get_table_names(), ["templates"])
+
+        mock_bg_db = MagicMock()
+        mock_session_local.return_value = mock_bg_db
+        self.assertTrue(log_transaction(1, "521234567890", "LOGIN-ABC", "4821", "Code: 4821 Link: http://x/q/s", 5))
+        log_entry = mock_bg_db.add.call_args[0][0]
+        self.assertEqual(log_entry.template_snapshot, "Code: {otp} Link: http://x/q/s")
+        self.assertFalse(hasattr(log_entry, "otp"))
+        print("    ✅ Monthly partition names, retention cutoff, no OTP in stored rows")
+
+    def test_usage_rollups_api(self):
+        print("\n[24] Testing Usage Rollups & /v1/usage")
+        from datetime import datetime
+        from server.usage import usage_meter
+        from server.models import UsageRollup
+
+        usage_meter._counters.clear() # Drop anything recorded by earlier deliver_reply tests
+        usage_meter._phones.clear()
+        usage_meter.record(1, "521111111111", 5)
+        usage_meter.record(1, "521111111111", 5)
+        self.assertEqual(sorted(key[0] for key in usage_meter._counters), ["day", "hour"])
+        for key, counters in usage_meter._counters.items():
+            self.assertEqual(counters, {"verifications": 2, "cost_minor": 10})
+            self.assertEqual(len(usage_meter._phones[key]), 1)
+
+        # Pipeline fails once: the deltas survive and the next flush carries the totals
+        pushed, failures = {}, [ConnectionError("redis down")]
+        class Pipe:
+            async def __aenter__(self):
+                self.ops = []
+                return self
+            async def __aexit__(self, *exc):
+                return False
+            def hincrby(self, key, metric, value):
+                self.ops.append((key, metric, value))
+            def __getattr__(self, name):
+                return lambda *args: None
+            async def execute(self):
+                if failures:
+                    raise failures.pop()
+                for key, metric, value in self.ops:
+                    pushed[(key, metric)] = pushed.get((key, metric), 0) + value
+        with patch("server.usage.redis_client.pipeline", new=MagicMock(side_effect=lambda **kwargs: Pipe())):
+            with self.assertRaises(ConnectionError):
+                asyncio.run(usage_meter.flush())
+            usage_meter.record(1, "521222222222", 5)
+            asyncio.run(usage_meter.flush())
+        self.assertEqual(len(pushed), 4) # hour + day buckets x 2 metrics
+        self.assertEqual(sorted(set(pushed.values())), [3, 15])
+        self.assertEqual(usage_meter._counters, {})
+        usage_meter._counters.clear()
+        usage_meter._phones.clear()
+
+        # Rollups stalled for 5 hours: every bucket since the watermark is backfilled,
+        # the watermark only moves once the rows are saved
+        from datetime import timedelta
+        from server.usage import ROLLUP_WATERMARK_KEY
+        now = datetime.utcnow()
+        watermarks = {"hour": (now - timedelta(hours=5)).strftime("%Y%m%d%H"), "day": now.strftime("%Y%m%d")}
+        async def hgetall(key):
+            return dict(watermarks) if key == ROLLUP_WATERMARK_KEY else {"verifications": "2", "cost_minor": "10"}
+        async def hset(key, period, bucket):
+            watermarks[period] = bucket
+        saved, results = [], [False, True, True, True]
+        def save(rows):
+            saved.append(rows)
+            return results.pop(0)
+        with patch.object(redis_client, "set", new=AsyncMock(return_value=True)), \
+             patch.object(redis_client, "hgetall", new=hgetall), patch.object(redis_client, "hset", new=hset), \
+             patch.object(redis_client, "smembers", new=AsyncMock(return_value={"1"})), \
+             patch.object(redis_client, "pfcount", new=AsyncMock(return_value=1)), \
+             patch("server.usage.save_usage_rollups", side_effect=save):
+            asyncio.run(usage_meter.rollup()) # Hour rows fail to save, day rows saved
+            self.assertEqual([len(rows) for rows in saved], [6, 1])
+            self.assertEqual(watermarks["hour"], (now - timedelta(hours=5)).strftime("%Y%m%d%H"))
+            asyncio.run(usage_meter.rollup())
+            self.assertEqual([len(rows) for rows in saved[2:]], [6, 2]) # Day: the previous bucket is re-read
+            self.assertEqual(watermarks["hour"], (now - timedelta(hours=1)).strftime("%Y%m%d%H"))
+        self.assertEqual(saved[2][0]["bucket"], datetime.strptime((now - timedelta(hours=5)).strftime("%Y%m%d%H"), "%Y%m%d%H"))
+
+        # Served from rollups only
+        self.mock_db.query.return_value.filter.return_value.order_by.return_value.all.return_value = [
+            UsageRollup(tenant_id=1, period="day", bucket=datetime(2026, 1, 1), verifications=100, cost_minor=500, unique_phones=80),
+            UsageRollup(tenant_id=1, period="day", bucket=datetime(2026, 1, 2), verifications=20, cost_minor=100, unique_phones=20),
+        ]
+        res = self.client.get("/v1/usage?periods=30", headers={"X-Api-Key": "test-key"})
+        self.assertEqual(res.status_code, 200)
+        body = res.json()
+        self.assertEqual(body["totals"], {"verifications": 120, "cost": 6.0})
+        self.assertEqual(body["buckets"][0]["unique_phones"], 80)
+        self.mock_db.query.assert_called_with(UsageRollup)
+        self.assertEqual(self.client.get("/v1/usage?granularity=week", headers={"X-Api-Key": "test-key"}).status_code, 422)
+        print("    ✅ Hourly/daily usage from rollups")
+
+    def test_logs_export_keyset_stream(self):
+        print("\n[25] Testing Streaming Log Export")
+        from datetime import datetime, timedelta
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import StaticPool
+        from server.models import Base, Log
+        from server.config import settings
+
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        db = Session()
+        start = datetime(2026, 3, 1)
+        # Same timestamp for a run of rows: keyset must break ties on id
+        for i in range(7):
+            db.add(Log(tenant_id=1, phone=f"52{i}", token=f"TOK{i}", cost=0.05, created_at=start + timedelta(minutes=i // 3)))
+        db.add(Log(tenant_id=2, phone="other", token="OTHER", cost=0.05, created_at=start))
+        db.commit()
+        db.close()
+
+        with patch('server.log_export.SessionLocal', Session), patch.object(settings, "LOG_EXPORT_PAGE_SIZE", 2):
+            res = self.client.get(
+                "/v1/logs/export?since=2026-03-01T00:00:00&until=2026-03-02T00:00:00",
+                headers={"X-Api-Key": "test-key"},
+            )
+            self.assertEqual(res.status_code, 200)
+            lines = res.text.strip().splitlines()
+            self.assertEqual(lines[0], "id,created_at,token,phone,cost")
+            self.assertEqual([line.split(",")[2] for line in lines[1:]], [f"TOK{i}" for i in range(7)])
+
+            res = self.client.get(
+                "/v1/logs/export?format=ndjson&since=2026-03-01T00:01:00&until=2026-03-02T00:00:00",
+                headers={"X-Api-Key": "test-key"},
+            )
+            self.assertEqual([json.loads(line)["token"] for line in res.text.splitlines()], ["TOK3", "TOK4", "TOK5", "TOK6"])
+
+            # ISO 'Z' / offset timestamps are normalised to naive UTC (with and without until)
+            for query in ("since=2026-03-01T00:01:00Z", "since=2026-03-01T01:01:00%2B01:00&until=2026-03-02T00:00:00"):
+                res = self.client.get(f"/v1/logs/export?format=ndjson&{query}", headers={"X-Api-Key": "test-key"})
+                self.assertEqual(res.status_code, 200, query)
+                self.assertEqual([json.loads(line)["token"] for line in res.text.splitlines()], ["TOK3", "TOK4", "TOK5", "TOK6"])
+        print("    ✅ Pages chained on (created_at, id), tenant & time filtered")
+
+    def test_template_bulk_ingest_and_sync(self):
+        print("\n[26] Testing Template Bulk Ingest & Redis/Postgres Sync")
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import StaticPool
+        from server.models import Base, Template
+        from server.template_store import ingest_templates, sync_templates
+
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        fake = FakeTemplateRedis()
+
+        with patch('server.template_store.SessionLocal', Session):
+            saved = asyncio.run(ingest_templates(fake, [("A {otp} {link}", "ai_reply"), ("A {otp} {link}", "ai_reply"), ("Hola TOK", "ai_request")]))
+            self.assertEqual(sorted(saved), ["A {otp} {link}", "Hola TOK"])
+            self.assertEqual(asyncio.run(ingest_templates(fake, [("Hola TOK", "ai_request")])), []) # Already stored
+            self.assertEqual(fake.lists["templates:es_mx:upstream"], ["Hola TOK"])
+
+            # Redis flushed + one template only in Redis + one deactivated in Postgres
+            db = Session()
+            db.add(Template(content="B {otp} {link}", language="es_mx", source="ai_reply", is_active=False))
+            db.commit()
+            fake.sets = {"templates:es_mx": {"B {otp} {link}", "C {otp} {link}"}}
+            fake.lists = {}
+            report = asyncio.run(sync_templates(fake))
+            self.assertEqual(report, {"added_to_redis": 2, "removed_from_redis": 1, "added_to_db": 1})
+            self.assertEqual(fake.sets["templates:es_mx"], {"A {otp} {link}", "C {otp} {link}"})
+            self.assertEqual(fake.lists["templates:es_mx:upstream"], ["Hola TOK"])
+            self.assertEqual(db.query(Template).count(), 4)
+            db.close()
+        print("    ✅ Batched upsert, pipelined Redis writes, both sides repaired")
+
+    def test_near_duplicate_templates(self):
+        print("\n[27] Testing Near-Duplicate Template Detection")
+        from server.near_duplicates import NearDuplicateIndex, normalize_template, lsh_params
+
+        self.assertEqual(normalize_template("¡Código {otp}! Entra: {link}"), "codigo § entra §")
+        self.assertEqual(normalize_template("Hola, mi código es K7PQ2MXR"), "hola mi codigo es §")
+        self.assertEqual(lsh_params(64, 0.8), (8, 8))
+
+        index = NearDuplicateIndex(threshold=0.8)
+        self.assertIsNone(index.check_and_add(1, "Hola, tu código {app_name} es {otp}. Entra aquí: {link}"))
+        self.assertIsNone(index.check_and_add(2, "Código de seguridad {app_name}: {otp}. No lo compartas. {link}"))
+
+        # Reworded punctuation / accents / placeholder names -> duplicate of 1
+        match = index.check_and_add(3, "¡Hola! Tu codigo {app_name} es {code}, entra aqui {url}")
+        self.assertEqual(match[0], 1)
+        self.assertEqual(len(index), 2) # Not indexed
+        self.assertIsNone(index.query("¡Listo! Tu clave {app_name} es {otp}. Haz clic: {link}"))
+        print("    ✅ Reworded copies caught, distinct templates kept")
+
+    def test_clear_templates_batched(self):
+        print("\n[28] Testing Batched, Filtered Template Clear")
+        from datetime import datetime, timedelta
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import StaticPool
+        from server.config import settings
+        from server.models import Base, Template
+        from server.template_store import clear_templates
+
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        db = Session()
+        old = datetime.utcnow() - timedelta(days=40)
+        for i in range(5):
+            db.add(Template(content=f"R{i} {{otp}}", source="ai_reply", created_at=old if i < 3 else datetime.utcnow()))
+        db.add(Template(content="Hola ABCDEF", source="ai_request", created_at=old))
+        db.add(Template(content="Manual {otp}", source="manual", created_at=old))
+        db.commit()
+        fake = FakeTemplateRedis()
+        fake.sets["templates:es_mx"] = {f"R{i} {{otp}}" for i in range(5)} | {"Manual {otp}"}
+        fake.lists["templates:es_mx:upstream"] = ["Hola ABCDEF", "Kept 1", "Hola ABCDEF", "Kept 2", "Kept 3"]
+        lines = []
+
+        with patch('server.template_store.SessionLocal', Session), patch.object(settings, "TEMPLATE_BATCH_SIZE", 2):
+            report = asyncio.run(clear_templates(fake, sources=["ai_reply", "ai_request"], older_than_days=30, dry_run=True))
+            self.assertEqual(report["matched"], 4)
+            self.assertEqual(db.query(Template).count(), 7) # Untouched
+
+            report = asyncio.run(clear_templates(fake, sources=["ai_reply", "ai_request"], older_than_days=30, progress=lines.append))
+            self.assertEqual(report, {"matched": 4, "deleted": 4, "redis_removed": 5}) # Both copies of the request
+            self.assertEqual(len(lines), 3) # Two batches of 2, one upstream rebuild
+            self.assertEqual(fake.sets["templates:es_mx"], {"R3 {otp}", "R4 {otp}", "Manual {otp}"})
+            # Rebuilt in order (read in chunks of 2) and swapped in, no temp key left behind
+            self.assertEqual(fake.lists, {"templates:es_mx:upstream": ["Kept 1", "Kept 2", "Kept 3"]})
+
+            # Full clear: keys UNLINKed, every row of the language deleted
+            report = asyncio.run(clear_templates(fake, sources=None, progress=lines.append))
+            self.assertEqual(report["deleted"], 3)
+            self.assertEqual(fake.sets, {})
+            self.assertEqual(db.query(Template).count(), 0)
+        db.close()
+        print("    ✅ Filtered dry run, bounded batches, UNLINK for full clear")
+
+    def test_warm_up_gates_health_and_readiness(self):
+        print("\n[29] Testing Warm-up, /healthz and /readyz")
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import StaticPool
+        from server.models import Base
+        from server.warmup import readiness, warm_up, try_warm_up
+        from server.caches import template_cache, tenant_cache
+
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        db = Session()
+        db.add(Tenant(id=7, api_key="warm-key", name="Warm"))
+        db.commit()
+        db.close()
+
+        redis_client.ping = AsyncMock(side_effect=ConnectionError("redis down"))
+        redis_client.sscan = AsyncMock(return_value=(0, ["Hola {otp} {link}", "Code {otp} {link}"]))
+        redis_client.get = AsyncMock(return_value=json.dumps({"ok": True}))
+        redis_client.delete = AsyncMock()
+        readiness.reset()
+        try:
+            with patch('server.warmup.engine', engine), patch('server.caches.SessionLocal', Session):
+                self.assertEqual(self.client.get("/healthz").status_code, 503)
+                self.assertFalse(asyncio.run(try_warm_up()))
+                res = self.client.get("/readyz")
+                self.assertEqual(res.status_code, 503)
+                self.assertFalse(res.json()["checks"]["redis"]["ok"])
+                self.assertIn("redis down", res.json()["error"])
+
+                redis_client.ping = AsyncMock(return_value=True)
+                report = asyncio.run(warm_up())
+                self.assertEqual((report["templates"], report["tenants"]), (2, 1))
+                self.assertEqual(redis_client.ping.await_count, 10) # WARMUP_REDIS_CONNECTIONS
+                self.assertEqual(self.client.get("/healthz").status_code, 200)
+                res = self.client.get("/readyz")
+                self.assertEqual(res.status_code, 200)
+                self.assertTrue(res.json()["checks"]["database"]["ok"])
+                self.assertIn("latency_ms", res.json()["checks"]["redis"])
+
+            # Warm caches: no tenants query, no SRANDMEMBER
+            cached_db = MagicMock()
+            self.assertEqual(tenant_cache.get(cached_db, "warm-key").id, 7)
+            cached_db.query.assert_not_called()
+            self.assertIn(template_cache.choose(), ("Hola {otp} {link}", "Code {otp} {link}"))
+        finally:
+            readiness.reset()
+            template_cache.clear()
+            tenant_cache.clear()
+        print("    ✅ 503 until warmed up, pools / caches filled, dependency latencies reported")
+
+    def test_graceful_shutdown_drains_and_hands_off(self):
+        print("\n[30] Testing Graceful Shutdown Drain")
+        import server.main as main
+        from server.config import settings
+        from server.scheduler import reply_tracker, SCHEDULE_SCRIPT
+        from server.dead_letter import DLQ_KEY
+        from server.warmup import readiness
+        redis_client.hset = AsyncMock()
+        redis_client.zadd = AsyncMock()
+        redis_client.zrem = AsyncMock()
+        redis_client.aclose = AsyncMock()
+        billed = []
+
+        async def scenario():
+            async def stuck_scheduler(): # Claimed batch that outlives the drain deadline
+                await asyncio.sleep(60)
+            async def billing(): # Still running when the drain deadline passes
+                await asyncio.sleep(0.2)
+                billed.append("job3")
+
+            main.intake_workers.append(asyncio.create_task(stuck_scheduler()))
+            for job_id, phase in (("job1", "queued"), ("job2", "sending"), ("job3", "sent")):
+                reply_tracker.add({"id": job_id, "token": "ABCDEF2345", "chat_id": "521555555555"})
+                reply_tracker.mark(job_id, phase)
+            task = asyncio.ensure_future(billing())
+            main.billing_tasks.add(task)
+            task.add_done_callback(main.billing_tasks.discard)
+            return await main.shutdown_event()
+
+        try:
+            with patch.object(settings, "SHUTDOWN_DRAIN_TIMEOUT", 0.05):
+                report = asyncio.run(scenario())
+            self.assertEqual((report["drained"], report["handed_off"], report["abandoned"]), (1, 1, 1))
+            self.assertEqual((report["billing_flushed"], report["billing_abandoned"]), (1, 0))
+            self.assertEqual(billed, ["job3"])
+            self.assertEqual(len(reply_tracker), 0)
+            # Unsent reply re-queued for another worker, the one mid-send dead-lettered
+            requeued = [c for c in redis_client.eval.call_args_list if c[0][0] == SCHEDULE_SCRIPT]
+            self.assertEqual(json.loads(requeued[-1][0][6])["id"], "job1")
+            self.assertEqual(redis_client.hset.call_args[0][:2], (DLQ_KEY, "job2"))
+            redis_client.aclose.assert_awaited_once()
+
+            res = self.client.post("/webhook/echob", json={"event": "message", "payload": {}})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(self.client.get("/readyz").status_code, 503)
+        finally:
+            readiness.reset()
+            main.intake_stop.clear()
+            main.scheduler_stop.clear()
+        print(f"    ✅ Shutdown report: {report}")
+
+    def test_cluster_key_layout(self):
+        print("\n[31] Testing Redis Cluster Hash-Tagged Keys")
+        import importlib
+        from redis.crc import key_slot
+        import server.keys as keys
+        from server.config import settings
+        from server.utils import resolve_session
+
+        slot = lambda key: key_slot(key.encode("utf-8"))
+        # Single instance: key names unchanged
+        self.assertEqual((keys.session_key("AB2345"), keys.credit_key(7), keys.REPLY_JOBS_KEY),
+                         ("session:AB2345", "credit:7", "scheduler:replies:jobs"))
+        try:
+            with patch.object(settings, "REDIS_CLUSTER", True):
+                importlib.reload(keys)
+                token = "AB2345CD"
+                # One verification -> one slot; each multi-key script's keys -> one slot
+                groups = [
+                    [keys.session_key(token), keys.otp_key(token), keys.reply_slot_key(token, "521555555555")],
+                    [keys.credit_key(7), keys.credit_reservations_key(7), keys.credit_outstanding_key(7)],
+                    [keys.reply_queue_key("-"), keys.reply_queue_key(7), keys.REPLY_TENANTS_KEY,
+                     keys.REPLY_JOBS_KEY, keys.REPLY_INFLIGHT_KEY],
+                    [keys.reply_queue_key(7, 3), keys.reply_tenants_key(3), keys.reply_jobs_key(3), keys.reply_inflight_key(3)],
+                    [keys.templates_key("es_mx"), keys.upstream_templates_key("es_mx")],
+                ]
+                for group in groups:
+                    self.assertEqual(len({slot(key) for key in group}), 1, group)
+                self.assertNotEqual(slot(keys.credit_key(7)), slot(keys.credit_key(8)))
+                # Scheduler shards spread over the cluster
+                self.assertEqual(len({slot(keys.reply_jobs_key(shard)) for shard in range(4)}), 4)
+
+                # Candidate tokens live on different slots: MGET is split per slot
+                redis_client.mget_nonatomic = AsyncMock(return_value=[None, json.dumps({"phone": "52"})])
+                found, data = asyncio.run(resolve_session(["BUENASTARD", token]))
+                self.assertEqual((found, data["phone"]), (token, "52"))
+                redis_client.mget_nonatomic.assert_awaited_once()
+        finally:
+            importlib.reload(keys)
+        print("    ✅ Per-verification, per-tenant credit and per-shard scheduler keys share a slot")
+
+    def test_client_side_cache(self):
+        print("\n[32] Testing Client-Side Caching (CLIENT TRACKING)")
+        from redis.exceptions import ResponseError
+        from server.client_cache import ClientCache
+        from server.caches import TemplateCache
+        from server.config import settings
+
+        cache = ClientCache(["templates:", "domains:quarantine:"], max_bytes=1024)
+        templates = TemplateCache()
+        cache.on_invalidate(templates.mark_changed)
+        cache.enabled = True
+        store = {"domains:quarantine:http://a": "1", "domains:quarantine:http://b": None, "bot:x:drained": None}
+        calls = []
+        async def fake_mget(keys):
+            calls.append(list(keys))
+            return [store.get(key) for key in keys]
+
+        async def scenario():
+            with patch("server.client_cache.mget", side_effect=fake_mget):
+                keys = ["domains:quarantine:http://a", "domains:quarantine:http://b"]
+                self.assertEqual(await cache.mget(keys), ["1", None])
+                self.assertEqual(await cache.mget(keys), ["1", None]) # Both served locally, None included
+                self.assertEqual(len(calls), 1)
+                await cache.get("bot:x:drained") # Untracked prefix: always read from Redis
+                await cache.get("bot:x:drained")
+                self.assertEqual(len(calls), 3)
+
+                # Invalidation push drops the key and tells the listeners
+                cache.invalidate(["domains:quarantine:http://b", templates.key])
+                self.assertTrue(templates._changed.is_set())
+                store["domains:quarantine:http://b"] = "1"
+                self.assertEqual(await cache.get("domains:quarantine:http://b"), "1")
+
+                # Invalidated while the read was in flight: the (possibly stale) value is not kept
+                async def racing_mget(keys):
+                    cache.invalidate(keys)
+                    return ["old"]
+                with patch("server.client_cache.mget", side_effect=racing_mget):
+                    self.assertEqual(await cache.get("templates:new"), "old")
+                self.assertEqual(await cache.get("templates:new"), None)
+
+                # Memory cap: least recently used entries go first
+                for i in range(20):
+                    await cache.get(f"templates:{i}")
+                self.assertLessEqual(cache.snapshot()["bytes"], 1024)
+                self.assertNotIn("domains:quarantine:http://a", cache._entries)
+
+        asyncio.run(scenario())
+        snapshot = cache.snapshot()
+        self.assertEqual((snapshot["hits"], snapshot["misses"]), (2, 25))
+        self.assertEqual(snapshot["invalidations"], 3)
+
+        # Server without CLIENT TRACKING: permanent fallback to plain reads
+        class NoTrackingConnection:
+            def __init__(self, **kwargs):
+                self.sent = None
+            async def send_command(self, *args):
+                self.sent = args
+            async def read_response(self, **kwargs):
+                if self.sent[:2] == ("CLIENT", "TRACKING"):
+                    raise ResponseError("Unknown subcommand 'TRACKING'")
+                return 7 if self.sent == ("CLIENT", "ID") else ["subscribe", self.sent[1], 1]
+            async def disconnect(self):
+                pass
+
+        fallback = ClientCache(["templates:"], max_bytes=1024)
+        pool = MagicMock(connection_class=NoTrackingConnection, connection_kwargs={})
+        with patch.object(redis_client, "connection_pool", pool, create=True):
+            asyncio.run(asyncio.wait_for(fallback.run(asyncio.Event()), timeout=2))
+        self.assertFalse(fallback.enabled)
+        self.assertIn("TRACKING", fallback.unsupported)
+        with patch("server.client_cache.mget", side_effect=fake_mget):
+            asyncio.run(fallback.get("templates:x"))
+            asyncio.run(fallback.get("templates:x"))
+        self.assertEqual(fallback.snapshot()["hits"], 0)
+        res = self.client.get("/metrics/cache")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("hit_rate", res.json())
+
+        # Short links (opt-in prefix) on the request path: preview fetch and click, one Redis read
+        from server.client_cache import client_cache
+        redis_client.get = AsyncMock(return_value=json.dumps({"token": "TOK123", "otp": "OTP123"}))
+        try:
+            with patch.object(client_cache, "enabled", True), patch.object(client_cache, "prefixes", ["short:"]):
+                for agent in ("WhatsApp/2.23.20.0", "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0)"):
+                    res = self.client.get("/q/CACHED", headers={"User-Agent": agent}, follow_redirects=False)
+                    self.assertEqual(res.status_code, 302)
+            short_reads = [c for c in redis_client.get.await_args_list if c[0][0] == "short:CACHED"]
+            self.assertEqual(len(short_reads), 1)
+        finally:
+            client_cache.flush()
+        print(f"    ✅ Hit rate {snapshot['hit_rate']}, invalidations honoured, fallback: {fallback.unsupported}")
+
+    def test_redis_memory_analyzer(self):
+        print("\n[33] Testing Redis Memory Analyzer")
+        from server.scripts.redis_memory import analyze, build_parser, ttl_bucket
+
+        # key -> (pttl ms, MEMORY USAGE bytes)
+        keyspace = {f"session:T{i}": (300_000, 200) for i in range(40)}
+        keyspace.update({f"ratelimit:webhook:52{i}": (-1, 72) for i in range(5)}) # Lost their EXPIRE
+        keyspace.update({"templates:es_mx": (-1, 50_000), "lock:gone": (-2, None)})
+
+        class FakePipeline:
+            def __init__(self, redis):
+                self.redis, self.ops = redis, []
+            def pttl(self, key):
+                self.ops.append(keyspace[key][0])
+            def memory_usage(self, key, samples=None):
+                self.ops.append(keyspace[key][1])
+            def expire(self, key, ttl):
+                self.redis.expired.append((key, ttl))
+                self.ops.append(True)
+            async def execute(self):
+                return self.ops
+
+        class FakeRedis:
+            def __init__(self):
+                self.expired, self.scans, self.transactions = [], 0, set()
+            async def scan(self, cursor, match=None, count=None):
+                self.scans += 1
+                keys = sorted(keyspace)
+                return (cursor + count if cursor + count < len(keys) else 0), keys[cursor:cursor + count]
+            def pipeline(self, transaction=True):
+                self.transactions.add(transaction)
+                return FakePipeline(self)
+            async def info(self, section):
+                return {"used_memory": 123456}
+
+        fake = FakeRedis()
+        args = build_parser().parse_args(["--count", "10", "--sample", "0.5", "--sleep", "0", "--seed", "1"])
+        report = asyncio.run(analyze(fake, args)).to_dict()
+        self.assertEqual(fake.scans, 5) # Incremental: 47 keys, 10 per SCAN
+        self.assertEqual(fake.transactions, {False}) # Batches never run in MULTI
+        self.assertEqual((report["scanned"], report["vanished"]), (46, 1))
+        stats = {s["prefix"]: s for s in report["prefixes"]}
+        self.assertEqual(report["prefixes"][0]["prefix"], "templates")
+        self.assertEqual((stats["session"]["keys"], stats["session"]["ttls"]["<10m"], stats["session"]["no_ttl"]), (40, 40, 0))
+        self.assertEqual(stats["session"]["est_bytes"], 40 * 200) # Sample mean extrapolated
+        self.assertLess(stats["session"]["sampled"], 40)
+        self.assertEqual((stats["ratelimit"]["no_ttl"], stats["ratelimit"]["fixed"]), (5, 0))
+        self.assertIsNone(stats["templates"]["expected_ttl"]) # Persistent by design
+        self.assertEqual(fake.expired, [])
+        self.assertEqual(ttl_bucket(-1), "none")
+
+        # --fix-ttl: only namespaces that are always written with a TTL
+        args = build_parser().parse_args(["--count", "10", "--sleep", "0", "--fix-ttl"])
+        report = asyncio.run(analyze(fake, args)).to_dict()
+        self.assertEqual(len(fake.expired), 5)
+        self.assertTrue(all(key.startswith("ratelimit:") and ttl == 60 for key, ttl in fake.expired))
+        self.assertEqual([s["fixed"] for s in report["prefixes"] if s["prefix"] == "ratelimit"], [5])
+        print(f"    ✅ {report['scanned']} keys in 5 SCAN batches, 5 TTL-less rate limit keys repaired")
+
+    def test_template_pipeline_writer_failure(self):
+        print("\n[34] Testing Template Generation Pipeline Failure")
+        import argparse
+        import tempfile
+        import server.scripts.generate_templates as generate_templates
+
+        class NoDuplicates:
+            threshold = 0.8
+            def __len__(self):
+                return 0
+            def check_and_add(self, key, content):
+                return False
+
+        async def generate(client, limiter, kind, index, args, stats):
+            return f"template {index}"
+
+        args = argparse.Namespace(count=500, batch_size=2, concurrency=4, similarity=0.8)
+        stats = {"generated": 0, "saved": 0, "near_duplicates": 0, "failed": 0, "throttled": 0}
+        checkpoint = generate_templates.Checkpoint(os.path.join(tempfile.mkdtemp(), "checkpoint.json"), fresh=True)
+        with patch.object(generate_templates, "load_near_duplicate_index", return_value=NoDuplicates()), \
+             patch.object(generate_templates, "generate_with_retries", side_effect=generate), \
+             patch.object(generate_templates, "ingest_templates", AsyncMock(side_effect=RuntimeError("unique violation"))):
+            run = generate_templates.run_pipeline("downstream", None, None, None, checkpoint, args, stats)
+            # Writer dies on its first batch: the run fails fast instead of hanging on a full queue
+            with self.assertRaisesRegex(RuntimeError, "unique violation"):
+                asyncio.run(asyncio.wait_for(run, timeout=5))
+        self.assertEqual(checkpoint.completed("downstream"), set())
+        print("    ✅ Ingest error surfaces, workers cancelled")
+
+    @patch('server.main.echob_client')
+    def test_delivered_reply_never_resent(self, mock_echob):
+        print("\n[35] Testing Bookkeeping Failure After a Successful Send")
+        from server import main
+        from server.scheduler import run_reply_scheduler, SCHEDULE_SCRIPT, ACK_SCRIPT
+        mock_echob.stop_typing = AsyncMock()
+        mock_echob.send_text = AsyncMock(return_value={"id": "wamid.1"})
+        redis_client.eval.reset_mock()
+        job = {"id": "job-sent", "session": "bot1", "chat_id": "521555555555", "text": "Tu código 4821",
+               "token": "ABCDEF2345", "otp": "4821", "tenant_id": 1}
+
+        stop = asyncio.Event()
+        claims = [[job]]
+        async def claim(*args, **kwargs):
+            if claims:
+                return claims.pop()
+            stop.set()
+            return []
+
+        with patch("server.scheduler.claim_due_replies", side_effect=claim), \
+             patch("server.main.log_transaction", return_value=True) as log_transaction, \
+             patch("server.main.settle_credit", AsyncMock(side_effect=ConnectionError("redis down"))):
+            asyncio.run(asyncio.wait_for(run_reply_scheduler(main.deliver_reply, stop), timeout=5))
+
+        # One send, one charge, acked: the failed settle is logged, never retried as a send
+        mock_echob.send_text.assert_awaited_once()
+        log_transaction.assert_called_once()
+        scripts = [c[0][0] for c in redis_client.eval.call_args_list]
+        self.assertNotIn(SCHEDULE_SCRIPT, scripts)
+        self.assertIn(ACK_SCRIPT, scripts)
+        print("    ✅ Reply acked after the send; settle error did not re-queue it")
+
+    def test_scheduler_claims_round_robin_across_tenants(self):
+        print("\n[36] Testing Tenant-Aware Reply Claiming")
+        from server.config import settings
+        from server.keys import REPLY_TENANTS_KEY
+        from server.scheduler import run_reply_scheduler, CLAIM_DUE_SCRIPT, ACK_SCRIPT
+
+        # Tenant 1 has a 500 reply backlog, tenant 2 one OTP; the first reply of tenant 1 hangs
+        due = {"1": [{"id": f"t1-{i}", "tenant_id": 1} for i in range(500)], "2": [{"id": "t2-0", "tenant_id": 2}]}
+        acked, stop = [], asyncio.Event()
+
+        async def zrangebyscore(key, *args, **kwargs):
+            return [tenant for tenant, jobs in due.items() if jobs] if key == REPLY_TENANTS_KEY else []
+
+        async def eval_script(script, numkeys, *args):
+            if script == CLAIM_DUE_SCRIPT: # KEYS: due set, jobs, inflight, tenants; ARGV: now, limit, lease, tenant
+                jobs, tenant, limit = due[args[7]], args[7], int(args[5])
+                claimed, due[tenant] = jobs[:limit], jobs[limit:]
+                return [json.dumps(job) for job in claimed]
+            if script == ACK_SCRIPT:
+                acked.append(args[2])
+
+        hang = asyncio.Event()
+        async def handler(job):
+            if job["id"] == "t1-0":
+                await hang.wait()
+            else:
+                await asyncio.sleep(0.001)
+            if len(acked) >= 20:
+                stop.set()
+
+        async def scenario():
+            worker = asyncio.create_task(run_reply_scheduler(handler, stop))
+            await stop.wait()
+            hang.set()
+            await asyncio.wait_for(worker, timeout=5)
+
+        with patch.object(settings, "SCHEDULER_BATCH_SIZE", 4), \
+             patch.object(settings, "SCHEDULER_POLL_INTERVAL", 0.01), \
+             patch.object(redis_client, "zrangebyscore", new=zrangebyscore), \
+             patch.object(redis_client, "eval", new=eval_script):
+            asyncio.run(scenario())
+
+        # Tenant 2 is claimed next to tenant 1's first share, not behind its backlog
+        self.assertIn("t2-0", acked[:4])
+        # The hanging reply held one slot, not the whole batch
+        self.assertGreaterEqual(acked.index("t1-0"), 20)
+        print(f"    ✅ Small tenant served within the first claim, {len(acked)} replies acked past a stuck send")
+
+    def test_slow_send_keeps_its_lease(self):
+        print("\n[38] Testing Lease Renewal of Slow Replies")
+        import time
+        from server.config import settings
+        from server.keys import REPLY_TENANTS_KEY, REPLY_INFLIGHT_KEY
+        from server.scheduler import run_reply_scheduler, recover_interrupted_replies, CLAIM_DUE_SCRIPT, ACK_SCRIPT
+
+        due = {"1": [{"id": "slow", "tenant_id": 1}]}
+        inflight, expired_seen, acked = {}, [], []
+        stop, sent = asyncio.Event(), asyncio.Event()
+
+        async def zrangebyscore(key, low, high, **kwargs):
+            if key == REPLY_TENANTS_KEY:
+                return [tenant for tenant, jobs in due.items() if jobs]
+            return [job_id for job_id, deadline in inflight.items() if deadline <= high]
+
+        async def zadd(key, mapping, xx=False, **kwargs):
+            for job_id, deadline in mapping.items():
+                if not xx or job_id in inflight:
+                    inflight[job_id] = deadline
+
+        async def eval_script(script, numkeys, *args):
+            if script == CLAIM_DUE_SCRIPT:
+                claimed, due[args[7]] = due[args[7]], []
+                for job in claimed:
+                    inflight[job["id"]] = float(args[6])
+                return [json.dumps(job) for job in claimed]
+            if script == ACK_SCRIPT:
+                inflight.pop(args[2], None)
+                acked.append(args[2])
+
+        async def slow_send(job): # Waits in FairSender, then a slow EchoB call: 4 leases
+            await asyncio.sleep(0.8)
+            sent.set()
+            stop.set()
+
+        async def other_worker():
+            while not sent.is_set():
+                await asyncio.sleep(0.05)
+                expired_seen.extend(job_id for job_id, deadline in inflight.items() if deadline <= time.time())
+
+        async def scenario():
+            worker = asyncio.create_task(run_reply_scheduler(slow_send, stop))
+            await other_worker()
+            await asyncio.wait_for(worker, timeout=5)
+
+        with patch.object(settings, "REPLY_LEASE_SECONDS", 0.2), \
+             patch.object(settings, "SCHEDULER_POLL_INTERVAL", 0.01), \
+             patch.object(redis_client, "zrangebyscore", new=zrangebyscore), \
+             patch.object(redis_client, "zadd", new=zadd), \
+             patch.object(redis_client, "eval", new=eval_script), \
+             patch("server.scheduler.add_dead_letter", AsyncMock()) as dead_letter:
+            asyncio.run(scenario())
+            # A dead worker's job is still recovered once its lease runs out
+            inflight["gone"] = time.time() - 1
+            redis_client.hmget = AsyncMock(return_value=[None])
+            self.assertEqual(asyncio.run(recover_interrupted_replies()), 1)
+
+        self.assertEqual(expired_seen, [])
+        self.assertEqual(acked, ["slow", "gone"])
+        dead_letter.assert_awaited_once()
+        self.assertEqual(dead_letter.await_args[0][0]["id"], "gone")
+        print("    ✅ Lease renewed while the send was pending, only the orphaned job recovered")
+
+    def test_inbound_consumer_stops_when_lease_lapses(self):
+        print("\n[39] Testing Inbound Lease Fencing")
+        from server.inbound import InboundPartitions, RELEASE_LEASE_SCRIPT
+
+        inbound = InboundPartitions(1)
+        entries = [(f"1-{i}", {"payload": json.dumps({"sender": "521555555555", "n": i})}) for i in range(5)]
+        handled, acked = [], []
+        redis_client.xreadgroup = AsyncMock(side_effect=[[["inbound:0", entries]]] + [[]] * 1000)
+        redis_client.xack = AsyncMock(side_effect=lambda stream, group, entry_id: acked.append(entry_id))
+        redis_client.set = AsyncMock(return_value=True)
+        redis_client.eval = AsyncMock(return_value=1)
+        blocker = asyncio.Event()
+
+        async def handler(payload):
+            handled.append(payload["n"])
+            if payload["n"] == 1:
+                inbound.lease_until[0] = 0 # Renewal failed for longer than the lease
+            if payload["n"] == 0:
+                await blocker.wait()
+
+        async def scenario():
+            self.assertTrue(await inbound._hold_lease(0))
+            stop = asyncio.Event()
+            inbound.owned[0] = (asyncio.create_task(inbound._consume(0, handler, stop)), stop)
+            await asyncio.sleep(0.05)
+            # Releasing mid-event returns at once; the lease is given up once the event is done
+            release = inbound._release(0)
+            await asyncio.sleep(0.05)
+            self.assertFalse(release.done())
+            self.assertNotIn(0, inbound.owned)
+            blocker.set()
+            await asyncio.wait_for(release, timeout=2)
+
+            # Lease lapses mid-batch: the rest of the batch is left for the next owner
+            self.assertTrue(await inbound._hold_lease(0))
+            stop = asyncio.Event()
+            redis_client.xreadgroup.side_effect = [[["inbound:0", entries[1:]]]] + [[]] * 1000
+            task = asyncio.create_task(inbound._consume(0, handler, stop))
+            await asyncio.sleep(0.3)
+            stop.set()
+            await asyncio.wait_for(task, timeout=2)
+
+        asyncio.run(scenario())
+        self.assertEqual(handled, [0, 1])
+        self.assertEqual(acked, ["1-0", "1-1"])
+        self.assertEqual(redis_client.eval.call_args[0][0], RELEASE_LEASE_SCRIPT)
+        print("    ✅ Released without blocking, no event handled after the lease lapsed")
+
+    def test_scheduler_shards_spread_tenants(self):
+        print("\n[40] Testing Sharded Reply Scheduler")
+        from server.config import settings
+        from server.keys import reply_tenants_key, reply_queue_key, reply_inflight_key
+        from server.scheduler import schedule_reply, claim_due_replies, ack_reply, reply_shard_for
+        from server.scheduler import SCHEDULE_SCRIPT, CLAIM_DUE_SCRIPT, ACK_SCRIPT
+
+        # Fake Redis: due set key -> jobs; the scripts only ever see one shard's keys
+        queues, tenants, claimed, acked = {}, {}, [], []
+
+        async def eval_script(script, numkeys, *args):
+            if script == SCHEDULE_SCRIPT: # KEYS: due set, jobs, tenants; ARGV: id, body, due, tenant
+                queues.setdefault(args[0], []).append(args[4])
+                tenants.setdefault(args[2], set()).add(args[6])
+            elif script == CLAIM_DUE_SCRIPT: # KEYS: due set, jobs, inflight, tenants
+                self.assertIn(args[7], tenants.get(args[3], ()))
+                claimed.append(args[0])
+                return queues.pop(args[0], [])
+            elif script == ACK_SCRIPT: # KEYS: inflight, jobs; ARGV: id
+                acked.append((args[0], args[2]))
+
+        async def zrangebyscore(key, *args, **kwargs):
+            return sorted(tenants.get(key, ()))
+
+        async def scenario():
+            for tenant_id in range(1, 9):
+                await schedule_reply({"id": f"r{tenant_id}", "tenant_id": tenant_id}, delay=0)
+            jobs = await claim_due_replies(limit=20)
+            for job in jobs:
+                await ack_reply(job)
+            return jobs
+
+        with patch.object(settings, "SCHEDULER_SHARDS", 4), \
+             patch.object(redis_client, "zrangebyscore", new=zrangebyscore), \
+             patch.object(redis_client, "eval", new=eval_script):
+            jobs = asyncio.run(scenario())
+            shards = {tenant_id: reply_shard_for(str(tenant_id)) for tenant_id in range(1, 9)}
+            used = {reply_tenants_key(shard) for shard in shards.values()}
+            self.assertEqual(set(tenants), used)
+            self.assertGreater(len(used), 1)
+            # Every reply claimed once, from its tenant's shard, and acked there
+            self.assertEqual(sorted(job["id"] for job in jobs), [f"r{t}" for t in range(1, 9)])
+            self.assertEqual(sorted(claimed), sorted(reply_queue_key(str(t), shard) for t, shard in shards.items()))
+            self.assertEqual(sorted(acked), sorted((reply_inflight_key(shards[job["tenant_id"]]), job["id"]) for job in jobs))
+        print(f"    ✅ 8 tenants over {len(used)} shards, each reply claimed and acked in its own shard")
+
+    def test_sigterm_drains_before_shutdown(self):
+        print("\n[37] Testing SIGTERM Drain Delay")
+        import signal
+        import time
+        from server.warmup import readiness, drain_on_sigterm
+        uvicorn_exits = []
+        previous = signal.signal(signal.SIGTERM, lambda sig, frame: uvicorn_exits.append(time.monotonic()))
+        readiness.state = "ready"
+
+        async def scenario():
+            self.assertTrue(drain_on_sigterm(asyncio.get_running_loop(), 0.1))
+            signal.raise_signal(signal.SIGTERM)
+            signaled = time.monotonic()
+            # Still serving, but out of rotation
+            self.assertTrue(readiness.draining)
+            self.assertEqual(self.client.get("/readyz").status_code, 503)
+            res = self.client.post("/webhook/echob", json={"event": "message", "payload": {}})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(uvicorn_exits, [])
+            await asyncio.sleep(0.2)
+            return signaled
+
+        try:
+            signaled = asyncio.run(scenario())
+            # uvicorn's handler ran once, after the delay
+            self.assertEqual(len(uvicorn_exits), 1)
+            self.assertGreaterEqual(uvicorn_exits[0] - signaled, 0.09)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            readiness.reset()
+        print("    ✅ /readyz 503 right after SIGTERM, uvicorn shutdown after the drain delay")
 
 
 if __name__ == '__main__':